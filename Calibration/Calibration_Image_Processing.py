@@ -3,6 +3,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 #import a savgol filter to smooth the data
 from scipy.signal import savgol_filter
+import Hardware_API.Crosssection as Crosssection
 
 
 def Open_Image(filename):
@@ -12,12 +13,16 @@ def Open_Image(filename):
 
 
 def Get_Image_Crosssection(filename, crosssection_position, crosssection_width):
+    return Get_Image_Crosssection_Band(filename, crosssection_position, crosssection_width).mean
+
+#The cross section band with its saturated pixels per column and noise (Crosssection.Band)
+def Get_Image_Crosssection_Band(filename, crosssection_position, crosssection_width):
     image = Open_Image(filename)
     if crosssection_position == 'middle':
-        crosssection = np.mean(image[int(image.shape[0]/2)-int(crosssection_width/2):int(image.shape[0]/2)+int(crosssection_width/2), :], axis=0)
+        center = int(image.shape[0]/2)
     else:
-        crosssection = np.mean(image[int(crosssection_position)-int(crosssection_width/2):int(crosssection_position)+int(crosssection_width/2), :], axis=0)
-    return crosssection
+        center = int(crosssection_position)
+    return Crosssection.extract_bands(image, [Crosssection.centered_band(center, crosssection_width)])[0]
 
 def Plot_Image(filename, axis, crosssection_position, crosssection_width):
     axis.set_ylabel('Pixel Y')
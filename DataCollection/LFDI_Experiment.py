@@ -1,6 +1,8 @@
 
 import numpy as np
 import Hardware_API.LFDI_API as LFDI
+import Hardware_API.TCB_Telemetry_Log as TCB_Telemetry_Log
+import Hardware_API.TCB_Thermal_Model as TCB_Thermal_Model
 import time
 import Hardware_API.Spectrograph as Spectrograph
 import os
@@ -32,11 +34,8 @@ def Temp_Compensation(spectrometer : Spectrograph.Spectrometer,LFDI_TCB: LFDI, s
     temperatures = np.append(temperatures, np.arange(end_temp, start_temp, -step))
     print(f"Temps: {temperatures}")
     wavelengths = np.arange(20, 420, 50)
-    # Create a list to store the filenames of the images
-    filename = f"{folder}\\TCB_Out.tsv"
-    file = open(filename, "w")
-    file.write(f"{LFDI_TCB.header_format}\n")
-    file.close()
+    # Create a binary log to store the TCB data
+    telemetry = TCB_Telemetry_Log.Telemetry_Writer(f"{folder}\\TCB_Out.tlm", LFDI_TCB)
     # Cycle through the temperatures. Take a measurement while the temperature is moving hold at each temperature for 5 minutes
     # Turn on the Auto Compensator Algo on compensator 3
     LFDI_TCB.set_compensator_auto(3)
@@ -48,49 +47,96 @@ def Temp_Compensation(spectrometer : Spectrograph.Spectrometer,LFDI_TCB: LFDI, s
     # Go through all of our wavelengths
     for wavelength in wavelengths:
         # Set the Compensator to the current wavelength
-        LFDI_TCB.set_compensator_wavelength(3,wavelength)
+        try:
+            LFDI_TCB.set_compensator_wavelength(3,wavelength)
+        except LFDI.TCB_Desync_Error as e:
+            print(f"Skipping {wavelength}Pos, the TCB did not respond: {e}")
+            continue
         # Go through the temperatures
         for temperature in temperatures:
-            # Set the temperature
-            LFDI_TCB.set_controller_setpoint(controller_number = 1, setpoint = temperature)
-            LFDI_TCB.set_controller_enable(controller_number = 1, enable = True)
-            temporal_resolution = 1*60 #1 minute
-            # Continuously output until we reach the set point
-            while not TCB_at_temp(temperature, LFDI_TCB, tolerance):
-                # Get the Current time and output the spectrograph for a minute
+            try:
+                # Set the temperature
+                LFDI_TCB.set_controller_setpoint(controller_number = 1, setpoint = temperature)
+                LFDI_TCB.set_controller_enable(controller_number = 1, enable = True)
+                temporal_resolution = 1*60 #1 minute
+                # Continuously output until we reach the set point
+                while not TCB_at_temp(temperature, LFDI_TCB, tolerance):
+                    # Get the Current time and output the spectrograph for a minute
+                    now = time.time()
+                    spectrometer.continuous_output(refresh_rate=1, end_trigger=partial(wait_time, now, temporal_resolution))
+                    # Take a measurement
+                    # Get the Current Temp From LFDI
+                    telemetry.record(LFDI_TCB)
+                    current_temp = LFDI_TCB.Controllers[0].average
+                    # Format the Current Temp to be a string with 2 decimal places
+                    current_temp = f"{float(current_temp):.2f}"
+                    os.rename(spectrometer.current_crosssection, f"{folder}/Slew_{LFDI_TCB.Compensators[2].wave}Pos_{str(time.time())}_{str(current_temp)}C_{LFDI_TCB.Compensators[2].voltage}V.csv")
+                print(f"Reached {temperature}C")
+                print("Waiting 5 minutes")
+                # Wait For the Crystal to warm through out
                 now = time.time()
-                spectrometer.continuous_output(refresh_rate=1, end_trigger=partial(wait_time, now, temporal_resolution))
-                # Take a measurement
-                # Get the Current Temp From LFDI
-                file = open(filename,"a")
-                file.write(f"{LFDI_TCB.get_info()}\n")
-                file.close()
-                current_temp = LFDI_TCB.Controllers[0].average
-                # Format the Current Temp to be a string with 2 decimal places
-                current_temp = f"{float(current_temp):.2f}"
-                os.rename(spectrometer.current_crosssection, f"{folder}/Slew_{LFDI_TCB.Compensators[2].wave}Pos_{str(time.time())}_{str(current_temp)}C_{LFDI_TCB.Compensators[2].voltage}V.csv")
-            print(f"Reached {temperature}C")
-            print("Waiting 5 minutes")
-            # Wait For the Crystal to warm through out
-            now = time.time()
-            seconds_to_wait = 300 # wait for 5 min
-            while not wait_time(now, seconds_to_wait):
-                current_time = time.time()
-                spectrometer.continuous_output(refresh_rate=1, end_trigger=partial(wait_time, current_time, temporal_resolution))
-                file = open(filename, "a")
-                file.write(f"{LFDI_TCB.get_info()}\n")
-                file.close()
-                current_temp = LFDI_TCB.Controllers[0].average
-                # Format the Current Temp to be a string with 2 decimal places
-                current_temp = f"{float(current_temp):.2f}"
-                os.rename(spectrometer.current_crosssection, f"{folder}/Hold_{LFDI_TCB.Compensators[2].wave}Pos_{str(time.time())}_{str(current_temp)}C_{LFDI_TCB.Compensators[2].voltage}V.csv")
+                seconds_to_wait = 300 # wait for 5 min
+                while not wait_time(now, seconds_to_wait):
+                    current_time = time.time()
+                    spectrometer.continuous_output(refresh_rate=1, end_trigger=partial(wait_time, current_time, temporal_resolution))
+                    telemetry.record(LFDI_TCB)
+                    current_temp = LFDI_TCB.Controllers[0].average
+                    # Format the Current Temp to be a string with 2 decimal places
+                    current_temp = f"{float(current_temp):.2f}"
+                    os.rename(spectrometer.current_crosssection, f"{folder}/Hold_{LFDI_TCB.Compensators[2].wave}Pos_{str(time.time())}_{str(current_temp)}C_{LFDI_TCB.Compensators[2].voltage}V.csv")
+            except LFDI.TCB_Desync_Error as e:
+                print(f"Skipping {temperature}C at {wavelength}Pos, the TCB did not respond: {e}")
+                continue
             print("Finished Waiting")
             print(f"Finished {temperature}C")
         print(f"Finished {wavelength}Pos")
+    telemetry.close()
+    LFDI_TCB.dump_stats(f"{folder}\\TCB_Stats.json")
     return
 
 
-def Total_Data_Collection(spectrometer : Spectrograph.Spectrometer,LFDI_TCB: LFDI, start_temp: float, end_temp: float, step_temp: float, tolerance: float, start_voltage: float, end_voltage: float, step_voltage : float, folder):
+# Slew to a temperature and soak there, saving a frame every temporal_resolution seconds
+# The slew ends as soon as the poller sees the temperature settle and the soak ends once the thermal model says the crystal
+# is near equilibrium and the spectral peak has stopped drifting (or after seconds_to_wait)
+# suffix: end of the filenames ie "CompOff_0nm"
+def slew_and_soak(spectrometer : Spectrograph.Spectrometer, LFDI_TCB: LFDI.LFDI_TCB, telemetry, temperature, tolerance, folder, suffix,
+                  controller_number = 1, compensator_number = 3, stability_window = 60, soak_fraction = 0.02, seconds_to_wait = 600,
+                  temporal_resolution = 60):
+    # Save the newest frame named after the newest snapshot
+    def save(prefix):
+        snapshot = LFDI_TCB.get_latest_snapshot()
+        telemetry.record(LFDI_TCB, snapshot)
+        current_temp = f"{float(snapshot.averages[controller_number-1]):.2f}"
+        voltage = snapshot.voltages[compensator_number-1]
+        spectrometer.save_image_async(spectrometer.current_frame, f"{folder}/{prefix}_{str(time.time())}_{voltage}V_{current_temp}C_{suffix}.png")
+        return
+
+    LFDI_TCB.set_controller_setpoint(controller_number = controller_number, setpoint = temperature)
+    LFDI_TCB.set_controller_enable(controller_number = controller_number, enable = True)
+    settled = partial(LFDI_TCB.is_settled, controller_number, temperature, tolerance, stability_window)
+    while not settled():
+        now = time.time()
+        spectrometer.continuous_output(refresh_rate=1, end_trigger=lambda: wait_time(now, temporal_resolution) or settled(), save_temp_files=False)
+        save("Slew")
+
+    print(f"Reached {temperature}C")
+    print(f"Soaking for up to {seconds_to_wait/60:.0f} minutes")
+    soak = TCB_Thermal_Model.Soak_Predictor(fraction=soak_fraction, max_hold=seconds_to_wait)
+    soak.start()
+    soaked = partial(soak.is_done, LFDI_TCB, controller_number)
+    track_peak = lambda crosssection: soak.add_peak(time.time(), spectrometer.get_peak_position(crosssection))
+    while not soaked():
+        now = time.time()
+        spectrometer.continuous_output(refresh_rate=1, end_trigger=lambda: wait_time(now, temporal_resolution) or soaked(), on_frame=track_peak,
+                                       save_temp_files=False)
+        print(soak.format_status())
+        save("Hold")
+    print("Finished Waiting")
+    return
+
+
+def Total_Data_Collection(spectrometer : Spectrograph.Spectrometer,LFDI_TCB: LFDI, start_temp: float, end_temp: float, step_temp: float, tolerance: float, start_voltage: float, end_voltage: float, step_voltage : float, folder,
+                          compensator_number = 3, controller_number = 1, stability_window = 60, soak_fraction = 0.02, seconds_to_wait = 600):
     
     print(f"Start Temp {start_temp}")
     print(f"End Temp {end_temp}")
@@ -109,130 +155,91 @@ def Total_Data_Collection(spectrometer : Spectrograph.Spectrometer,LFDI_TCB: LFD
     voltages = np.arange(start_voltage, end_voltage, step_voltage)
     print(f"Voltages: {voltages}")
     
-    # Create a file to store the data
-    filename = f"{folder}\\TCB_Out.tsv"
-    file = open(filename, "w")
-    file.write(f"{LFDI_TCB.header_format}\n")
-    file.close()
+    # Create a binary log to store the TCB data
+    telemetry = TCB_Telemetry_Log.Telemetry_Writer(f"{folder}\\TCB_Out.tlm", LFDI_TCB)
+    # Settling and soaking are judged from the poller's history
+    started_polling = LFDI_TCB.poll_thread is None
+    if started_polling:
+        LFDI_TCB.start_polling()
+    soak_options = dict(controller_number = controller_number, compensator_number = compensator_number, stability_window = stability_window,
+                        soak_fraction = soak_fraction, seconds_to_wait = seconds_to_wait)
 
     # First go through the temperatures without the Compensation Algorythm
-    # Cycle through the temperatures. Take a measurement while the temperature is moving hold at each temperature for 5 minutes
     #Tun on the output for the First Compensator 
-    LFDI_TCB.set_compensator_enable(3, True)
+    LFDI_TCB.set_compensator_enable(compensator_number, True)
+    # Steps the TCB stopped answering for even after recovery are logged and skipped so one bad step doesn't end the run
+    skipped = []
     # Go through the temperatures
     for temperature in temperatures:
-        # Change to a known state
-        LFDI.Compensators[2].voltage = 3
-        LFDI.Compensators[2].enable = True
-        
-        # Set the temperature
-        LFDI_TCB.set_controller_setpoint(controller_number=1, setpoint=temperature)
-        LFDI_TCB.set_controller_enable(controller_number=1, enable=True)
-        temporal_resolution = 1*60 # 1 minute
-        while not TCB_at_temp(temperature, LFDI_TCB, tolerance):
-            # Get the Current time and output the spectrograph for a minute
-            now = time.time()
-            spectrometer.continuous_output(refresh_rate=1, end_trigger=partial(wait_time, now, temporal_resolution))
-            # Take a measurement
-            # Get the Current Temp From LFDI
-            file = open(filename, "a")
-            file.write(f"{LFDI_TCB.get_info()}\n")
-            file.close()
-            current_temp = LFDI_TCB.Controllers[0].average
-            current_temp = f"{float(current_temp):.2f}"
-            filename = f"Slew_{str(time.time())}_{LFDI_TCB.Compensators[2].voltage}V_{current_temp}C_CompOff_0nm.png"
-            os.rename(spectrometer.current_image, f"{folder}/{filename}")
-        
-        print(f"Reached {temperature}C")
-        print("Waiting 5 minutes")
-        #Wait For the Crystal to warm through out
-        now = time.time()
-        seconds_to_wait = 600 #wait for 10 min
-        while not wait_time(now, seconds_to_wait):
-            current_time = time.time()
-            spectrometer.continuous_output(refresh_rate=1, end_trigger=partial(wait_time, current_time, temporal_resolution))
-            file = open(filename, "a")
-            file.write(f"{LFDI_TCB.get_info()}\n")
-            file.close()
-            current_temp = LFDI_TCB.Controllers[0].average
-            current_temp = f"{float(current_temp):.2f}"
-            filename = f"Hold_{str(time.time())}_{LFDI_TCB.Compensators[2].voltage}V_{current_temp}C_CompOff_0nm.png"
-            os.rename(spectrometer.current_image, f"{folder}/{filename}")
-
-        print("Finished Waiting")
+        try:
+            # Change to a known state
+            LFDI_TCB.set_compensator_voltage(compensator_number, 3)
+            LFDI_TCB.set_compensator_enable(compensator_number, True)
+            slew_and_soak(spectrometer, LFDI_TCB, telemetry, temperature, tolerance, folder, "CompOff_0nm", **soak_options)
+        except LFDI.TCB_Desync_Error as e:
+            print(f"Skipping {temperature}C, the TCB did not respond: {e}")
+            skipped.append(f"{temperature}C CompOff")
+            continue
+
         print("Cycling through Voltages")
         for voltage in voltages:
             #Set the voltage
-            LFDI_TCB.set_compensator_voltage(3, voltage)
+            try:
+                LFDI_TCB.set_compensator_voltage(compensator_number, voltage)
+            except LFDI.TCB_Desync_Error as e:
+                print(f"Skipping {voltage}V at {temperature}C, the TCB did not respond: {e}")
+                skipped.append(f"{temperature}C {voltage}V CompOff")
+                continue
+            set_time = time.time()
             #Wait for the voltage to settle
             time.sleep(2)
             #Take a measurement
-            now = time.time()
-            spectrometer.single_output()
-            file = open(filename, "a")
-            file.write(f"{LFDI_TCB.get_info()}\n")
-            file.close()
-            current_temp = LFDI_TCB.Controllers[0].average
-            current_temp = f"{float(current_temp):.2f}"
-            filename = f"Hold_{str(time.time())}_{LFDI_TCB.Compensators[2].voltage}V_{current_temp}C_CompOff_0nm.png"
-            os.rename(spectrometer.current_image, f"{folder}/{filename}")
+            image = spectrometer.take_image()
+            #The temperature from a dump read after the voltage was set
+            snapshot = LFDI_TCB.wait_for_snapshot(set_time)
+            if snapshot is None:
+                print(f"No TCB reading since {voltage}V was set, using the last one")
+                snapshot = LFDI_TCB.get_latest_snapshot()
+            telemetry.record(LFDI_TCB, snapshot)
+            current_temp = f"{float(snapshot.averages[controller_number-1]):.2f}"
+            filename = f"Hold_{str(time.time())}_{round(float(voltage), 3)}V_{current_temp}C_CompOff_0nm.png"
+            spectrometer.save_image_async(image, f"{folder}/{filename}")
 
         print(f"Finished {temperature}C")
     print("Finished Temp Cycle")
 
 
     #Now go through the temperatures with the Compensation Algorythm
-    #Cycle through the temperatures. Take a measurement while the temperature is moving hold at each temperature for 5 minutes
-    
-    LFDI_TCB.set_compensator_enable(3,True)
-    LFDI_TCB.toggle_compensator_auto(3)
-    LFDI_TCB.set_compensator_wavelength(3, 100)
+    LFDI_TCB.set_compensator_enable(compensator_number, True)
+    LFDI_TCB.toggle_compensator_auto(compensator_number)
+    LFDI_TCB.set_compensator_wavelength(compensator_number, 100)
 
     #Go through the temperatures
     for temperature in temperatures:
-        #Change to a known state
-        #Set the temperature
-        LFDI_TCB.set_controller_setpoint(controller_number = 1, setpoint = temperature)
-        LFDI_TCB.set_controller_enable(controller_number = 1, enable = True)
-        temporal_resolution = 1*60
-        while not TCB_at_temp(temperature, LFDI_TCB, tolerance):
-            #Get the Current time and output the spectrograph for a minute
-            now = time.time()
-            spectrometer.continuous_output(refresh_rate=1, end_trigger=partial(wait_time, now, temporal_resolution))
-            #Take a measurement
-            #Get the Current Temp From LFDI
-            file = open(filename,"a")
-            file.write(f"{LFDI_TCB.get_info()}\n")
-            file.close()
-            current_temp = LFDI_TCB.Controllers[0].average
-            current_temp = f"{float(current_temp):.2f}"
-            filename = f"Slew_{str(time.time())}_{LFDI_TCB.Compensators[2].voltage}V_{current_temp}C_CompOn_100nm.png"
-            os.rename(spectrometer.current_image, f"{folder}/{filename}")
-
-        print(f"Reached {temperature}C")
-        print("Waiting 5 minutes")
-        #Wait For the Crystal to warm through out
-        now = time.time()
-        seconds_to_wait = 600 #wait for 10 min
-        while not wait_time(now, seconds_to_wait):
-            current_time = time.time()
-            spectrometer.continuous_output(refresh_rate=1, end_trigger=partial(wait_time, current_time, temporal_resolution))
-            file = open(filename, "a")
-            file.write(f"{LFDI_TCB.get_info()}\n")
-            file.close()
-            current_temp = LFDI_TCB.Controllers[0].average
-            current_temp = f"{float(current_temp):.2f}"
-            filename = f"Hold_{str(time.time())}_{LFDI_TCB.Compensators[2].voltage}V_{current_temp}C_CompOn_100nm.png"
-            os.rename(spectrometer.current_image, f"{folder}/{filename}")
+        try:
+            slew_and_soak(spectrometer, LFDI_TCB, telemetry, temperature, tolerance, folder, "CompOn_100nm", **soak_options)
+        except LFDI.TCB_Desync_Error as e:
+            print(f"Skipping {temperature}C, the TCB did not respond: {e}")
+            skipped.append(f"{temperature}C CompOn")
+            continue
+        print(f"Finished {temperature}C")
+    print("Finished Compensated Temp Cycle")
+    for step in skipped:
+        print(f"Skipped {step}")
+
+    # Make sure every image is on disk
+    spectrometer.writer.flush()
+    if started_polling:
+        LFDI_TCB.stop_polling()
+    telemetry.close()
+    LFDI_TCB.dump_stats(f"{folder}\\TCB_Stats.json")
+    return
 
 
 
 def Run_Endurance_Test(spectrometer : Spectrograph.Spectrometer,LFDI_TCB: LFDI, tolerance, folder):
     
-    filename = f"{folder}\\TCB_Out.tsv"
-    file = open(filename, "a")
-    file.write(f"{LFDI_TCB.header_format}\n")
-    file.close()
+    telemetry = TCB_Telemetry_Log.Telemetry_Writer(f"{folder}\\TCB_Out.tlm", LFDI_TCB)
     LFDI_TCB.set_compensator_auto(3)
     #Enable the Compensator        
     while True:
@@ -244,46 +251,50 @@ def Run_Endurance_Test(spectrometer : Spectrograph.Spectrometer,LFDI_TCB: LFDI,
         #random_compensator = np.random.randint(0,6)
         #pick a random wavelength between 20 and 500
         random_wavelength = np.random.randint(20,415)
-        #Set the Compensator to the random wavelength
-        LFDI_TCB.set_compensator_wavelength(3,random_wavelength)
-        #Set the temperature
-        LFDI_TCB.set_controller_enable(controller_number = 1, enable = True)
-        #Turn on the Auto Compensator Algo on compensator 3
+        try:
+            #Set the Compensator to the random wavelength
+            LFDI_TCB.set_compensator_wavelength(3,random_wavelength)
+            #Set the temperature
+            LFDI_TCB.set_controller_enable(controller_number = 1, enable = True)
+            #Turn on the Auto Compensator Algo on compensator 3
 
-        LFDI_TCB.set_compensator_enable(3,True)
+            LFDI_TCB.set_compensator_enable(3,True)
+        except LFDI.TCB_Desync_Error as e:
+            print(f"Skipping {random_wavelength}Pos, the TCB did not respond: {e}")
+            continue
         #Continuously output until we reach the set point
         for temp in temperatures:
-            LFDI_TCB.set_controller_setpoint(controller_number = 1, setpoint = temp)
-
-            while not TCB_at_temp(temp, LFDI_TCB, tolerance):
-                #Get the Current time and output the spectrograph for a minute
-                now = time.time()
-                spectrometer.continuous_output(refresh_rate=1, end_trigger=partial(wait_time, now, 60))
-                #Take a measurement
-                file = open(filename, "a")
-                file.write(f"{LFDI_TCB.get_info()}\n")
-                file.close()
-                #Get the Current Temp From LFDI
-                current_temp = LFDI_TCB.Controllers[0].average
+            try:
+                LFDI_TCB.set_controller_setpoint(controller_number = 1, setpoint = temp)
+
+                while not TCB_at_temp(temp, LFDI_TCB, tolerance):
+                    #Get the Current time and output the spectrograph for a minute
+                    now = time.time()
+                    spectrometer.continuous_output(refresh_rate=1, end_trigger=partial(wait_time, now, 60))
+                    #Take a measurement
+                    telemetry.record(LFDI_TCB)
+                    #Get the Current Temp From LFDI
+                    current_temp = LFDI_TCB.Controllers[0].average
                 
-                #Format the Current Temp to be a string with 2 decimal places
-                current_temp = f"{float(current_temp):.2f}"
-                os.rename(spectrometer.current_crosssection, f"{folder}/Slew_{LFDI_TCB.Compensators[2].wave}Pos_{str(time.time())}_{str(current_temp)}C_{LFDI_TCB.Compensators[2].voltage}V.csv")
-            print(f"Reached {temp}C")
-            print("Waiting 5 minutes")
-            #Wait For the Crystal to warm through out
-            now = time.time()
-            seconds_to_wait = 300 #wait for 5 min
-            while not wait_time(now, seconds_to_wait):
-                current_time = time.time()
-                spectrometer.continuous_output(refresh_rate=1, end_trigger=partial(wait_time, current_time, 60))
-                current_temp = LFDI_TCB.Controllers[0].average
-                file = open(filename, "a")
-                file.write(f"{LFDI_TCB.get_info()}\n")
-                file.close()
-                #Format the Current Temp to be a string with 2 decimal places
-                current_temp = f"{float(current_temp):.2f}"
-                os.rename(spectrometer.current_crosssection, f"{folder}/Hold_{LFDI_TCB.Compensators[2].wave}Pos_{str(time.time())}_{str(current_temp)}C_{LFDI_TCB.Compensators[2].voltage}V.csv")
+                    #Format the Current Temp to be a string with 2 decimal places
+                    current_temp = f"{float(current_temp):.2f}"
+                    os.rename(spectrometer.current_crosssection, f"{folder}/Slew_{LFDI_TCB.Compensators[2].wave}Pos_{str(time.time())}_{str(current_temp)}C_{LFDI_TCB.Compensators[2].voltage}V.csv")
+                print(f"Reached {temp}C")
+                print("Waiting 5 minutes")
+                #Wait For the Crystal to warm through out
+                now = time.time()
+                seconds_to_wait = 300 #wait for 5 min
+                while not wait_time(now, seconds_to_wait):
+                    current_time = time.time()
+                    spectrometer.continuous_output(refresh_rate=1, end_trigger=partial(wait_time, current_time, 60))
+                    current_temp = LFDI_TCB.Controllers[0].average
+                    telemetry.record(LFDI_TCB)
+                    #Format the Current Temp to be a string with 2 decimal places
+                    current_temp = f"{float(current_temp):.2f}"
+                    os.rename(spectrometer.current_crosssection, f"{folder}/Hold_{LFDI_TCB.Compensators[2].wave}Pos_{str(time.time())}_{str(current_temp)}C_{LFDI_TCB.Compensators[2].voltage}V.csv")
+            except LFDI.TCB_Desync_Error as e:
+                print(f"Skipping {temp}C at {random_wavelength}Pos, the TCB did not respond: {e}")
+                continue
 
 
 # Sweep the temperature of the TCB and the Voltage applied from the DAC; take an image at each state
@@ -302,8 +313,12 @@ def SquareWave_Sweep(spectrometer : Spectrograph.Spectrometer,LFDI_TCB: LFDI, st
     #Cycle through the temperatures
     for temperature in temperatures:
         #Set the temperature
-        LFDI_TCB.set_controller_setpoint(1, temperature)
-        LFDI_TCB.set_controller_enable(1, True)
+        try:
+            LFDI_TCB.set_controller_setpoint(1, temperature)
+            LFDI_TCB.set_controller_enable(1, True)
+        except LFDI.TCB_Desync_Error as e:
+            print(f"Skipping {temperature}C, the TCB did not respond: {e}")
+            continue
         #Continuously output until we reach the set point
         spectrometer.continuous_output(refresh_rate=0.5, end_trigger=partial(TCB_at_temp, temperature, LFDI_TCB, tolerance))
         #Wait For the Crystal to warm through out
@@ -312,14 +327,20 @@ def SquareWave_Sweep(spectrometer : Spectrograph.Spectrometer,LFDI_TCB: LFDI, st
         spectrometer.continuous_output(refresh_rate=0.5, end_trigger=partial(wait_time, now, seconds_to_wait))
         for voltage in voltages:
             #Rename the spectrometers current image, graph and Crosssection with the temperature and move them to the experiment folder
-            LFDI_TCB.set_compensator_voltage(3, voltage)
+            try:
+                LFDI_TCB.set_compensator_voltage(3, voltage)
+            except LFDI.TCB_Desync_Error as e:
+                print(f"Skipping {voltage}V at {temperature}C, the TCB did not respond: {e}")
+                continue
             seconds_to_wait = 10
             spectrometer.continuous_output(refresh_rate=0.5, end_trigger=partial(wait_time, now, seconds_to_wait))
-            os.rename(spectrometer.current_image, f"{folder}/{str(temperature)}C_{voltage}V.tif")
+            spectrometer.save_image_async(spectrometer.current_frame, f"{folder}/{str(temperature)}C_{voltage}V.tif")
             os.rename(spectrometer.current_graph, f"{folder}/{str(temperature)}C_{voltage}V.png")
             os.rename(spectrometer.current_crosssection, f"{folder}/{str(temperature)}C_{voltage}V.csv")
             print(f"Finished Voltage {voltage}V")
         print(f"Finished {temperature}C")
+    # Make sure every image is on disk
+    spectrometer.writer.flush()
     return
 
 # Cycle through Temperatures and take an image at each temperature
@@ -334,8 +355,12 @@ def temperature_cycle(spectrometer,LFDI_TCB, start_temp, end_temp, step, toleran
     #Cycle through the temperatures
     for temperature in temperatures:
         #Set the temperature
-        LFDI_TCB.set_controller_setpoint(1,temperature)
-        LFDI_TCB.set_controller_enable(1,True)
+        try:
+            LFDI_TCB.set_controller_setpoint(1,temperature)
+            LFDI_TCB.set_controller_enable(1,True)
+        except LFDI.TCB_Desync_Error as e:
+            print(f"Skipping {temperature}C, the TCB did not respond: {e}")
+            continue
         #Continuously output until we reach the set point
         spectrometer.continuous_output(refresh_rate=0.5, end_trigger=partial(TCB_at_temp, temperature, LFDI_TCB, tolerance))
         #Wait For the Crystal to warm through out
@@ -365,9 +390,13 @@ def wait_time(start, wait_time):
 
 # Check to see if the TCB temp is at the set point
 def TCB_at_temp(temp, LFDI_TCB, tolerance):
-    #Get the current temperature
+    #Get the current temperature. Use the background poller if it is running so we don't touch the port
+    snapshot = LFDI_TCB.get_latest_snapshot()
     try:
-        current_temp = float(LFDI_TCB.Controllers[0].average)
+        if snapshot is not None:
+            current_temp = float(snapshot.averages[0])
+        else:
+            current_temp = float(LFDI_TCB.Controllers[0].average)
     except ValueError as e:
         print(f"Value Error {e} board request may have desynced")
         return False
@@ -394,11 +423,18 @@ def make_experiment_folder():
 
 
 # This Function will set the camera gain and exposure
-def calibrate_camera(spectrometer):
+# auto finds the exposure from the cross section first and only falls back to entering it by hand if the user rejects it
+def calibrate_camera(spectrometer, auto = True):
     print("Adjust the Camera settings until the image is in focus\r\nClose the Graph to adjust")
 
     #Set the camera exposure
     camera_exposure_good = False
+    if auto:
+        spectrometer.auto_expose()
+        spectrometer.single_output(show = True)
+        response = input("Is the Camera Exposure Good? (y/n): ")
+        if response == "y":
+            camera_exposure_good = True
     while not camera_exposure_good:
         camera_exposure = input("Enter the Camera Exposure in seconds (default .3 sec): ")
         try:
@@ -425,7 +461,7 @@ def calibrate_spectrometer(spectrometer, folder):
     print("Adjust the Spectrometer until the H-Alph line is centered\r\nClose the Graph when adjusted")
     spectrometer.continuous_output()
     os.mkdir(f"{folder}/H-Alpha Calibration")
-    os.rename(spectrometer.current_image, f"{folder}/H-Alpha Calibration/Calibration.tif")
+    spectrometer.save_image_async(spectrometer.current_frame, f"{folder}/H-Alpha Calibration/Calibration.tif")
     os.rename(spectrometer.current_graph, f"{folder}/H-Alpha Calibration/Calibration.png")
     os.rename(spectrometer.current_crosssection, f"{folder}/H-Alpha Calibration/Calibration.csv")
     return    
@@ -437,7 +473,7 @@ def calibrate_LED(spectrometer, folder):
     spectrometer.continuous_output()
     #make a sub folder in the experiment folder to store the calibration images
     os.mkdir(f"{folder}/LED Calibration")
-    os.rename(spectrometer.current_image, f"{folder}/LED Calibration/Calibration.tif")
+    spectrometer.save_image_async(spectrometer.current_frame, f"{folder}/LED Calibration/Calibration.tif")
     os.rename(spectrometer.current_graph, f"{folder}/LED Calibration/Calibration.png")
     os.rename(spectrometer.current_crosssection, f"{folder}/LED Calibration/Calibration.csv")
     
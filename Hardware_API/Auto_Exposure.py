@@ -0,0 +1,78 @@
+#Software auto exposure from the histogram of the cross section rows
+#The SDK auto exposure is slow to settle and looks at the whole frame. This only looks at the rows the cross section
+#is taken from and steps straight to the exposure that should put them at target, so it settles in a few frames
+#
+#The level is a high percentile of the pixels as a fraction of full scale, so a few hot pixels don't count
+#If more than max_saturated of the pixels are at full scale the exposure is cut hard first (the level can't be trusted)
+#
+#Example:
+#   auto_exposure = Auto_Exposure(target = 0.6)
+#   exposure = 0.1
+#   while not auto_exposure.done:
+#       exposure = auto_exposure.update(exposure, band_pixels)
+#       camera.set_exposure(exposure)
+import numpy as np
+
+
+#(level, saturated) of some pixels. level is the percentile pixel as a fraction of full scale,
+#saturated is the fraction of pixels at or above saturation (fraction of full scale)
+def measure_histogram(pixels, percentile=99.5, saturation=0.98, full_scale=None):
+    pixels = np.asarray(pixels).ravel()
+    if full_scale is None:
+        full_scale = np.iinfo(pixels.dtype).max if np.issubdtype(pixels.dtype, np.integer) else float(np.max(pixels))
+    if np.issubdtype(pixels.dtype, np.unsignedinteger):
+        #Counting the values is much faster than sorting them
+        histogram = np.bincount(pixels)
+        cumulative = np.cumsum(histogram)
+        value = int(np.searchsorted(cumulative, cumulative[-1] * percentile / 100))
+        saturated = cumulative[-1] - cumulative[min(int(np.ceil(full_scale * saturation)) - 1, len(cumulative) - 1)]
+        return value / full_scale, saturated / len(pixels)
+    value = np.percentile(pixels, percentile)
+    return float(value) / full_scale, float(np.count_nonzero(pixels >= full_scale * saturation)) / len(pixels)
+
+
+class Auto_Exposure:
+    #target: level to aim for (fraction of full scale)
+    #tolerance: done once the level is within this fraction of target
+    #max_saturated: fraction of saturated pixels allowed
+    #min_exposure/max_exposure: limits (s)
+    #max_step: largest factor the exposure changes by in one frame
+    def __init__(self, target=0.6, tolerance=0.1, percentile=99.5, max_saturated=0.001, min_exposure=32e-6, max_exposure=5,
+                 max_step=8, max_iterations=10):
+        self.target = target
+        self.tolerance = tolerance
+        self.percentile = percentile
+        self.max_saturated = max_saturated
+        self.min_exposure = min_exposure
+        self.max_exposure = max_exposure
+        self.max_step = max_step
+        self.max_iterations = max_iterations
+        self.reset()
+        return
+
+    def reset(self):
+        self.iterations = 0
+        self.level = None
+        self.saturated = None
+        self.done = False
+        self.converged = False
+        return
+
+    #Measure a frame taken at exposure (s) and return the exposure for the next one
+    def update(self, exposure, pixels, full_scale=None):
+        self.iterations += 1
+        self.level, self.saturated = measure_histogram(pixels, self.percentile, full_scale=full_scale)
+        if self.saturated > self.max_saturated:
+            step = 1 / self.max_step
+        elif self.level <= 0:
+            step = self.max_step
+        else:
+            step = min(max(self.target / self.level, 1 / self.max_step), self.max_step)
+        self.converged = self.saturated <= self.max_saturated and abs(self.level - self.target) <= self.tolerance * self.target
+        new_exposure = min(max(exposure * step, self.min_exposure), self.max_exposure)
+        if self.converged:
+            new_exposure = exposure
+        #Stuck at a limit, the light level is out of range
+        pinned = new_exposure == exposure and not self.converged
+        self.done = self.converged or pinned or self.iterations >= self.max_iterations
+        return new_exposure
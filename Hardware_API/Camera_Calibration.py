@@ -0,0 +1,173 @@
+#Master dark and flat frames for the ZWO camera and the correction (frame - dark) / flat applied as frames come in
+#Darks are kept per exposure, gain and binning. Flats per binning, they are normalised so they don't depend on exposure
+#Masters are taken with whatever ROI is set. A band or any other ROI inside it is corrected with the matching slice
+#so take them on the full frame if you switch between band and full frames
+#
+#Example:
+#   calibration = Calibration_Manager()
+#   input("Cover the camera")
+#   calibration.acquire_darks(spectrometer.camera, exposures = [0.05, 0.1, 0.2])
+#   input("Point the camera at the flat field source")
+#   calibration.acquire_flat(spectrometer.camera)
+#   calibration.save("Calibration_Frames")
+#   spectrometer.calibration = calibration
+import os
+import json
+import numpy as np
+try:
+    import Hardware_API.Frame_Stack as Frame_Stack
+except:
+    import Frame_Stack
+
+
+#A master frame and where it sits on the sensor
+class Master_Frame:
+    __slots__ = ("image", "roi")
+
+    def __init__(self, image, roi):
+        self.image = image
+        self.roi = roi
+        return
+
+    #The part of the master under a frame taken with roi. None if the frame is not inside the master
+    def get_slice(self, roi):
+        if roi is None:
+            return self.image
+        if roi["bins"] != self.roi["bins"]:
+            return None
+        x = roi["start_x"] - self.roi["start_x"]
+        y = roi["start_y"] - self.roi["start_y"]
+        if x < 0 or y < 0 or x + roi["width"] > self.roi["width"] or y + roi["height"] > self.roi["height"]:
+            return None
+        return self.image[y:y+roi["height"], x:x+roi["width"]]
+
+
+class Calibration_Manager:
+    #min_flat: flat pixels below this (dead pixels) are not corrected instead of being blown up
+    def __init__(self, min_flat=0.05):
+        self.min_flat = min_flat
+        self.darks = {} #(exposure us, gain, bins): Master_Frame
+        self.flats = {} #bins: Master_Frame
+        self.missing = set() #Keys we already warned about
+        return
+
+    def dark_key(self, exposure_us, gain, bins):
+        return (int(exposure_us), int(gain), int(bins))
+
+    #Stack count frames from the camera with its current settings
+    def stack_frames(self, camera, count, method):
+        stack = Frame_Stack.Frame_Stack(count, method)
+        while not stack.is_full():
+            stack.add(camera.capture_array())
+        return stack.combine()[0]
+
+    #Take a master dark at the camera's current exposure and gain. The camera has to be covered
+    def acquire_dark(self, camera, count=16):
+        settings = camera.get_control_values()
+        roi = camera.get_roi_geometry()
+        print(f"Taking {count} dark frames at {settings['Exposure']}us gain {settings['Gain']}")
+        dark = self.stack_frames(camera, count, 'median')
+        self.darks[self.dark_key(settings['Exposure'], settings['Gain'], roi["bins"])] = Master_Frame(dark, roi)
+        self.missing.clear()
+        return dark
+
+    #A master dark for each exposure (s). The exposure the camera was on is put back at the end
+    def acquire_darks(self, camera, exposures, count=16):
+        exposure = camera.get_camera_exposure()
+        try:
+            for e in exposures:
+                camera.set_exposure(e)
+                self.acquire_dark(camera, count)
+        finally:
+            camera.set_exposure(exposure)
+        return
+
+    #Take a master flat with the camera looking at an even source. The matching dark is taken off if there is one
+    #The flat is normalised to a mean of 1
+    def acquire_flat(self, camera, count=16):
+        settings = camera.get_control_values()
+        roi = camera.get_roi_geometry()
+        print(f"Taking {count} flat frames at {settings['Exposure']}us gain {settings['Gain']}")
+        flat = self.stack_frames(camera, count, 'mean')
+        dark = self.get_dark(settings['Exposure'], settings['Gain'], roi)
+        if dark is not None:
+            flat -= dark
+        flat /= np.mean(flat)
+        flat[flat < self.min_flat] = 1
+        self.flats[roi["bins"]] = Master_Frame(flat, roi)
+        return flat
+
+    def get_dark(self, exposure_us, gain, roi):
+        key = self.dark_key(exposure_us, gain, 1 if roi is None else roi["bins"])
+        if key not in self.darks:
+            return None
+        return self.darks[key].get_slice(roi)
+
+    def get_flat(self, roi):
+        bins = 1 if roi is None else roi["bins"]
+        if bins not in self.flats:
+            return None
+        return self.flats[bins].get_slice(roi)
+
+    #Correct a frame taken with settings (the camera's Control Values) and roi (see ZWO_Camera.get_roi_geometry)
+    #Raw frames are converted to float32 once and everything else happens in that buffer. Float frames (ie stacks) are
+    #corrected in place. Returns (image, {"dark": used a dark, "flat": used a flat})
+    def apply(self, image, settings, roi=None):
+        dark = self.get_dark(settings['Exposure'], settings['Gain'], roi)
+        flat = self.get_flat(roi)
+        self.warn_missing(settings, roi, dark, flat)
+        if image.dtype != np.float32:
+            image = image.astype(np.float32)
+        if dark is not None and dark.shape == image.shape:
+            np.subtract(image, dark, out=image)
+        else:
+            dark = None
+        if flat is not None and flat.shape == image.shape:
+            np.divide(image, flat, out=image)
+        else:
+            flat = None
+        return image, {"dark": dark is not None, "flat": flat is not None}
+
+    #A variance goes through the flat squared, the dark does not change it
+    def apply_variance(self, variance, roi=None):
+        flat = self.get_flat(roi)
+        if flat is not None and flat.shape == variance.shape:
+            np.divide(variance, flat * flat, out=variance)
+        return variance
+
+    #Only say once per exposure, gain and binning that there is nothing to correct with
+    def warn_missing(self, settings, roi, dark, flat):
+        missing = [name for name, frame in (("dark", dark), ("flat", flat)) if frame is None]
+        key = (self.dark_key(settings['Exposure'], settings['Gain'], 1 if roi is None else roi["bins"]), tuple(missing))
+        if len(missing) > 0 and key not in self.missing:
+            self.missing.add(key)
+            print(f"No {' or '.join(missing)} for {settings['Exposure']}us gain {settings['Gain']}, the frame is not fully corrected")
+        return
+
+    #Write the masters to a folder, one .npy per frame with an index of what they are
+    def save(self, folder):
+        os.makedirs(folder, exist_ok=True)
+        index = {"darks": [], "flats": []}
+        for (exposure, gain, bins), master in self.darks.items():
+            filename = f"Dark_{exposure}us_Gain{gain}_Bin{bins}.npy"
+            np.save(os.path.join(folder, filename), master.image)
+            index["darks"].append({"file": filename, "exposure": exposure, "gain": gain, "bins": bins, "roi": master.roi})
+        for bins, master in self.flats.items():
+            filename = f"Flat_Bin{bins}.npy"
+            np.save(os.path.join(folder, filename), master.image)
+            index["flats"].append({"file": filename, "bins": bins, "roi": master.roi})
+        with open(os.path.join(folder, "Calibration_Frames.json"), 'w') as f:
+            json.dump(index, f, indent=1)
+        return
+
+    #Read masters written by save into the cache
+    def load(self, folder):
+        with open(os.path.join(folder, "Calibration_Frames.json")) as f:
+            index = json.load(f)
+        for entry in index["darks"]:
+            image = np.load(os.path.join(folder, entry["file"]))
+            self.darks[self.dark_key(entry["exposure"], entry["gain"], entry["bins"])] = Master_Frame(image, entry["roi"])
+        for entry in index["flats"]:
+            self.flats[entry["bins"]] = Master_Frame(np.load(os.path.join(folder, entry["file"])), entry["roi"])
+        self.missing.clear()
+        return self
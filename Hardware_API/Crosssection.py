@@ -0,0 +1,106 @@
+#Cross section extraction shared by acquisition (Spectrograph), Calibration and Level2
+#A cross section is the mean of a band of rows. Several bands can be taken from one frame at once: overlapping bands are
+#merged into groups and each group is converted to float once, the bands are then reduced out of that block
+#Rows outside every band are never touched
+#Alongside the mean each band gets the number of saturated pixels in every column and the noise of the mean
+#Calibrated frames are float so saturation is counted on the frame from before calibration (raw) when it is given
+#
+#Example:
+#   bands = extract_bands(image, [centered_band(1760, 20), centered_band(1760, 47), (100, 120)])
+#   crosssection = bands[0].mean
+#   if bands[0].saturated.any(): print("Clipping")
+import numpy as np
+
+
+#One band of rows [start, stop) of a frame
+class Band:
+    __slots__ = ("start", "stop", "mean", "saturated", "noise")
+
+    def __init__(self, start, stop, mean, saturated, noise):
+        self.start = start
+        self.stop = stop
+        self.mean = mean #Mean of each column (float64)
+        self.saturated = saturated #Pixels at or above saturation in each column, None if the level is not known
+        self.noise = noise #Standard error of each column's mean from the spread of the rows
+        return
+
+    @property
+    def rows(self):
+        return self.stop - self.start
+
+
+#The rows the cross section at center takes with width rows averaged, same as it has always been sliced
+def centered_band(center, width):
+    return (int(center) - int(width/2), int(center) + int(width/2))
+
+
+#Integer frames saturate near the top of their range (the 12 bit ASI sensors are shifted up to 16 bit so they
+#stop short of 65535). Where a float frame saturates is not known from its type, pass the raw frame or the sensor's level
+def saturation_level(dtype, fraction=0.98):
+    if np.issubdtype(dtype, np.integer):
+        return int(np.iinfo(dtype).max * fraction)
+    return None
+
+
+#Keep a band inside the frame
+def clip_band(band, height):
+    start = max(int(band[0]), 0)
+    stop = min(int(band[1]), height)
+    if stop <= start:
+        raise ValueError(f"Band {band} has no rows in a frame {height} rows tall")
+    return (start, stop)
+
+
+#Overlapping or touching bands as (start, stop, [indexes of the bands in it])
+def group_bands(bands):
+    order = sorted(range(len(bands)), key=lambda i: bands[i][0])
+    groups = []
+    for i in order:
+        start, stop = bands[i]
+        if len(groups) > 0 and start <= groups[-1][1]:
+            groups[-1][1] = max(groups[-1][1], stop)
+            groups[-1][2].append(i)
+        else:
+            groups.append([start, stop, [i]])
+    return groups
+
+
+#Take every band (start row, stop row) from a 2D frame. Returns a Band for each, in the same order
+#saturation: pixel value counted as saturated, defaults to saturation_level of the frame's type (of raw if it is given)
+#raw: the same frame before calibration, saturated pixels are counted on it instead
+def extract_bands(image, bands, saturation=None, raw=None):
+    image = np.asarray(image)
+    if image.ndim != 2:
+        raise ValueError(f"Expected a 2D frame got {image.shape}")
+    if raw is None:
+        raw = image
+    elif raw.shape != image.shape:
+        raise ValueError(f"Raw frame is {raw.shape} the frame is {image.shape}")
+    if saturation is None:
+        saturation = saturation_level(raw.dtype)
+    bands = [clip_band(band, image.shape[0]) for band in bands]
+    results = [None] * len(bands)
+    for group_start, group_stop, indexes in group_bands(bands):
+        block = image[group_start:group_stop]
+        values = block.astype(np.float64)
+        for i in indexes:
+            start, stop = bands[i][0] - group_start, bands[i][1] - group_start
+            rows = stop - start
+            band = values[start:stop]
+            mean = band.sum(axis=0) / rows
+            if rows > 1:
+                squares = np.einsum('ij,ij->j', band, band)
+                variance = np.clip(squares - rows * mean * mean, 0, None) / (rows - 1)
+                noise = np.sqrt(variance / rows)
+            else:
+                noise = np.zeros_like(mean)
+            saturated = None
+            if saturation is not None:
+                saturated = np.count_nonzero(raw[bands[i][0]:bands[i][1]] >= saturation, axis=0)
+            results[i] = Band(bands[i][0], bands[i][1], mean, saturated, noise)
+    return results
+
+
+#The mean of one band, the plain cross section
+def extract_crosssection(image, center, width):
+    return extract_bands(image, [centered_band(center, width)])[0].mean
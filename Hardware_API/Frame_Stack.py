@@ -0,0 +1,126 @@
+#Co-adds frames in memory so N exposures become one image instead of N files that are averaged later
+#Only the combined image and its variance are kept once the stack is done
+#
+#mean: running sums, the frames themselves are not kept
+#median and sigma_clip: need every frame so they are kept in one preallocated buffer (in the camera's own dtype)
+#
+#Example:
+#   stack = Frame_Stack(count = 10, method = 'sigma_clip')
+#   while not stack.is_full():
+#       stack.add(camera.capture_array())
+#   image, variance = stack.combine()
+import math
+import numpy as np
+
+
+methods = ('mean', 'median', 'sigma_clip')
+
+
+class Frame_Stack:
+    #count: frames in the stack
+    #sigma: pixels further than this many standard deviations from the median are left out of a sigma_clip
+    #iterations: times the sigma_clip is repeated
+    def __init__(self, count, method='mean', sigma=3, iterations=3):
+        if method not in methods:
+            raise ValueError(f"Unknown stack method {method} methods are {methods}")
+        if count < 1:
+            raise ValueError("A stack needs at least one frame")
+        self.count = count
+        self.method = method
+        self.sigma = sigma
+        self.iterations = iterations
+        self.frames = 0
+        self.shape = None
+        self.sum = None
+        self.sum_of_squares = None
+        self.buffer = None
+        return
+
+    def __len__(self):
+        return self.frames
+
+    def is_full(self):
+        return self.frames >= self.count
+
+    #The buffers are made on the first frame once we know its size
+    def allocate(self, image):
+        self.shape = image.shape
+        if self.method == 'mean':
+            #Integer frames are summed exactly, uint32 holds 65536 16 bit frames
+            self.sum = np.zeros(image.shape, dtype=np.uint32 if np.issubdtype(image.dtype, np.integer) else np.float64)
+            self.sum_of_squares = np.zeros(image.shape, dtype=np.float64)
+        else:
+            self.buffer = np.empty((self.count,) + image.shape, dtype=image.dtype)
+        return
+
+    def add(self, image):
+        if self.is_full():
+            raise ValueError(f"Stack already has {self.count} frames")
+        if self.shape is None:
+            self.allocate(image)
+        elif image.shape != self.shape:
+            raise ValueError(f"Frame is {image.shape} the stack is {self.shape}")
+        if self.method == 'mean':
+            self.sum += image
+            image = image.astype(np.float64)
+            self.sum_of_squares += image * image
+        else:
+            self.buffer[self.frames] = image
+        self.frames += 1
+        return
+
+    #Returns (image, variance) as float32. The variance is of the combined image, not of a single frame
+    def combine(self):
+        if self.frames == 0:
+            raise ValueError("No frames in the stack")
+        if self.method == 'mean':
+            return self.combine_mean()
+        frames = self.buffer[:self.frames]
+        if self.method == 'median':
+            return self.combine_median(frames)
+        return self.combine_sigma_clip(frames)
+
+    def combine_mean(self):
+        n = self.frames
+        mean = self.sum / n
+        if n < 2:
+            return mean.astype(np.float32), np.zeros(self.shape, dtype=np.float32)
+        variance = np.clip(self.sum_of_squares - n * mean * mean, 0, None) / (n - 1)
+        return mean.astype(np.float32), (variance / n).astype(np.float32)
+
+    #The spread comes from the median absolute deviation so outliers don't inflate it
+    #The median of normal noise is pi/2 times noisier than the mean
+    def combine_median(self, frames):
+        n = len(frames)
+        median = np.median(frames, axis=0)
+        if n < 2:
+            return median.astype(np.float32), np.zeros(self.shape, dtype=np.float32)
+        variance = (1.4826 * np.median(np.abs(frames - median), axis=0)) ** 2
+        return median.astype(np.float32), (variance * math.pi / (2 * n)).astype(np.float32)
+
+    #Mean of each pixel after throwing away the frames where it is an outlier (cosmic rays, hot pixels)
+    def combine_sigma_clip(self, frames):
+        data = frames.astype(np.float32)
+        keep = np.ones(data.shape, dtype=bool)
+        for i in range(self.iterations):
+            clipped = np.where(keep, data, np.nan)
+            center = np.nanmedian(clipped, axis=0)
+            spread = np.nanstd(clipped, axis=0)
+            new_keep = np.abs(data - center) <= self.sigma * spread
+            if np.array_equal(new_keep, keep):
+                break
+            keep = new_keep
+        kept = np.maximum(np.sum(keep, axis=0), 1)
+        clipped = np.where(keep, data, 0)
+        mean = np.sum(clipped, axis=0, dtype=np.float64) / kept
+        squares = np.sum(np.where(keep, (data - mean) ** 2, 0), axis=0, dtype=np.float64)
+        variance = np.where(kept > 1, squares / np.maximum(kept - 1, 1), 0) / kept
+        return mean.astype(np.float32), variance.astype(np.float32)
+
+    #Start a new stack of the same size, the buffers are reused
+    def reset(self):
+        self.frames = 0
+        if self.sum is not None:
+            self.sum[...] = 0
+            self.sum_of_squares[...] = 0
+        return
@@ -0,0 +1,116 @@
+#Writes frames to disk on a pool of worker threads so encoding never holds up acquisition
+#The number of frames waiting to be written is bounded. When it is full write() waits for a free slot
+#so a slow disk slows the experiment down instead of filling up memory
+#
+#Example:
+#   writer = Frame_Writer()
+#   writer.write(image, "Hold_25C.png", callback=lambda filename, error: print(f"Saved {filename}"))
+#   writer.write(image, "Hold_25C.tif")
+#   writer.write(image, "Hold_25C.raw") #just the pixels, see write_raw
+#   writer.flush()
+import os
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+
+
+#PIL picks PNG or TIFF from the extension
+def write_image(image, filename):
+    Image.fromarray(np.ascontiguousarray(image)).save(filename)
+    return
+
+#The pixels exactly as they are in memory with a small JSON file next to them describing the shape and type
+def write_raw(image, filename):
+    image = np.ascontiguousarray(image)
+    image.tofile(filename)
+    with open(os.path.splitext(filename)[0] + '.json', 'w') as f:
+        json.dump({"shape": list(image.shape), "dtype": image.dtype.str}, f)
+    return
+
+#Read back a frame written by write_raw
+def read_raw(filename):
+    with open(os.path.splitext(filename)[0] + '.json') as f:
+        header = json.load(f)
+    return np.fromfile(filename, dtype=np.dtype(header["dtype"])).reshape(header["shape"])
+
+def write_npy(image, filename):
+    np.save(filename, image)
+    return
+
+formats = {
+    '.png': write_image,
+    '.tif': write_image,
+    '.tiff': write_image,
+    '.raw': write_raw,
+    '.npy': write_npy,
+}
+
+
+class Frame_Writer:
+    def __init__(self, workers=2, max_pending=16):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="Frame_Writer")
+        self.slots = threading.Semaphore(max_pending)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.idle = threading.Event()
+        self.idle.set()
+        self.written = 0
+        self.failed = 0
+        return
+
+    #Run function(*args) on the pool. callback(name, error) is called when it is done, error is None if it worked
+    #Returns a Future. Waits if max_pending jobs are already queued
+    def submit(self, function, *args, name=None, callback=None):
+        self.slots.acquire()
+        with self.lock:
+            self.pending += 1
+            self.idle.clear()
+        future = self.pool.submit(function, *args)
+        future.add_done_callback(lambda future: self._done(future, name, callback))
+        return future
+
+    #Queue an image to be written. The format comes from the extension (.png, .tif, .tiff, .raw, .npy)
+    #The image must not be changed after it is queued
+    #sidecar: text to write to a .txt file with the same name (ie the camera control values)
+    def write(self, image, filename, callback=None, sidecar=None):
+        extension = os.path.splitext(filename)[1].lower()
+        if extension not in formats:
+            raise ValueError(f"Can't write {filename} formats are {list(formats.keys())}")
+        return self.submit(self._write, formats[extension], image, filename, sidecar, name=filename, callback=callback)
+
+    def _write(self, write_function, image, filename, sidecar):
+        write_function(image, filename)
+        if sidecar is not None:
+            with open(os.path.splitext(filename)[0] + '.txt', 'w') as f:
+                f.write(sidecar)
+        return filename
+
+    def _done(self, future, name, callback):
+        error = future.exception()
+        with self.lock:
+            if error is None:
+                self.written += 1
+            else:
+                self.failed += 1
+            self.pending -= 1
+            if self.pending == 0:
+                self.idle.set()
+        self.slots.release()
+        if error is not None:
+            print(f"Could not write {name} {error}")
+        if callback is not None:
+            try:
+                callback(name, error)
+            except Exception as e:
+                print(f"Frame writer callback failed {e}")
+        return
+
+    #Wait until everything queued so far is on disk. Returns False if timeout seconds pass first
+    def flush(self, timeout=None):
+        return self.idle.wait(timeout)
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+        return
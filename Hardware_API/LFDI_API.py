@@ -17,12 +17,71 @@ from time import time
 from time import strftime
 import time
 from datetime import datetime
-
+import threading
+import re
+import json
+
+
+#Finds the channel number in the first column of a raw data line ("Cont2" -> 2)
+channel_number_pattern = re.compile(r"\d+")
+
+#Temperatures come back from the TCB with a trailing C ("25.03C")
+def parse_temperature(term:str):
+    return float(term.strip().rstrip('C'))
+
+#Fields that are usually numbers but can come back as text ("OFF")
+def parse_value(term:str):
+    term = term.strip()
+    try:
+        return float(term)
+    except ValueError:
+        return term
+
+#Enabled/Auto flags come back as text ("True", "False", "1", "0")
+def parse_bool(term):
+    if isinstance(term, bool):
+        return term
+    return str(term).strip().lower() in ("true", "1", "enabled", "on", "yes")
+
+#Text fields are kept as they came back
+def parse_text(term:str):
+    return term.strip()
+
+#Setpoints come back like temperatures but can also be text
+def parse_setpoint(term:str):
+    return parse_value(term.strip().rstrip('C'))
+
+#Store the columns of a raw data line on a channel. columns: ((index, attribute, parser), ...)
+#Columns past the end of a short line are skipped and keep their last values
+#Every present column is parsed before anything is stored so a bad value raises ValueError and changes nothing
+def update_columns(channel, data, columns):
+    values = [(name, parse(data[index])) for index, name, parse in columns if index < len(data)]
+    for name, value in values:
+        setattr(channel, name, value)
+    return
+
+#Compare a value from the raw dump to the value we want it to be
+def config_value_matches(current, desired):
+    if isinstance(desired, bool):
+        return parse_bool(current) == desired
+    try:
+        return abs(float(current) - float(desired)) <= 1e-3 * max(1, abs(float(desired)))
+    except (TypeError, ValueError):
+        return str(current).strip() == str(desired).strip()
 
 #This is the Controller Class Mostly used as a data class
 # All data for the Controllers are stored here and will be polled for LFDI's get info class
 # This will also compose commands for the TCB 
 class Controller(object):
+    __slots__ = ("number", "kp", "ki", "kd", "error_p", "error_d", "error_i", "effort", "temp", "average",
+                 "enabled", "setpoint", "i2c", "history", "frequency", "period", "offset", "sensor")
+    header = "Cont\tkp\tkd\tki\tep\ted\tei\teffort\ttemp\taverage\ttarget\ti2c\thist\tfreq\tenabled\tsensor"
+    #The raw data line has more columns than the header
+    #Cont kp kd ki li ep ed ei effort current temp average slew target i2c period offset enabled sensor
+    columns = ((1, "kp", float), (2, "kd", float), (3, "ki", float), (5, "error_p", float), (6, "error_d", float),
+               (7, "error_i", float), (8, "effort", float), (10, "temp", parse_temperature), (11, "average", parse_temperature),
+               (13, "setpoint", parse_setpoint), (14, "i2c", parse_text), (15, "period", parse_text), (16, "offset", parse_text),
+               (17, "enabled", parse_text), (18, "sensor", parse_text))
 
     def __init__(self, number):
         self.number = number
@@ -40,8 +99,9 @@ class Controller(object):
         self.i2c = 0
         self.history = 0
         self.frequency = 0
+        self.period = 0
+        self.offset = 0
         self.sensor = 0
-        self.header = "Cont\tkp\tkd\tki\tep\ted\tei\teffort\ttemp\taverage\ttarget\ti2c\thist\tfreq\tenabled\tsensor"
         
         return
 
@@ -49,36 +109,10 @@ class Controller(object):
     def __del__(self):
         return
 
+    #Update from a line of the raw data split on tabs
+    #A short line only updates the columns it has, enabled and sensor are the last two columns (17 and 18)
     def update_data(self, data):
-        try:
-            self.kp = float(data[1].strip(' '))
-            self.kd = float(data[2].strip(' '))
-            self.ki = float(data[3].strip(' '))
-            #self.li = float(data[4].strip(' '))
-            self.error_p = float(data[5].strip(' '))
-            self.error_d = float(data[6].strip(' '))
-            self.error_i = float(data[7].strip(' '))
-            self.effort = float(data[8].strip(' '))
-            #self.current = float(data[9].strip(' '))
-            self.temp = float(data[10].strip(' ').strip('C'))
-            self.average = float(data[11].strip(' ').strip('C'))
-            #self.slew = data[12].strip(' ')
-            #bad Way of doing this but will work for now
-            try:
-                self.setpoint = float(data[13].strip(' ').strip('C'))
-            except:
-                self.setpoint = data[13]
-            self.i2c = data[14].strip(' ')
-            self.period = data[15].strip(' ')
-            self.offset = data[16].strip(' ')
-            self.enabled = data[17].strip(' ')
-            self.sensor = data[18].strip(' ')
-            #self.history = float(data[12].strip(' '))
-            #self.frequency = float(data[13].strip(' '))
-            self.enabled = data[14].strip(' ')
-            self.sensor = data[15].strip(' ')
-        except:
-            print("Could not parse Controller Data")
+        update_columns(self, data, self.columns)
         return
 
     def get_kp_command(self, kp:float):
@@ -136,11 +170,14 @@ class Controller(object):
 # This Works as a data class for the Compensators #Controlling the Peak to Peak Voltage applied to the Optic
 #         
 class Compensator(object):
-
+    __slots__ = ("number", "voltage", "wave", "temp", "avg", "auto", "useAverage", "i2c", "enabled", "sensor")
+    header = "Comp\tPeak2Peak\tWave\tTemp\tAvg\tAuto\tUseAverage\ti2c\tenabled\tsensor"
+    columns = ((1, "voltage", parse_value), (2, "wave", parse_value), (3, "temp", parse_temperature), (4, "avg", parse_temperature),
+               (5, "auto", parse_text), (6, "useAverage", parse_text), (7, "i2c", parse_text), (8, "enabled", parse_text),
+               (9, "sensor", parse_text))
 
     def __init__(self, number):
         self.number = number
-        self.header = "Comp\tPeak2Peak\tWave\tTemp\tAvg\tAuto\tUseAverage\ti2c\tenabled\tsensor"
         self.voltage = 0
         self.wave = 0
         self.temp = 0
@@ -156,16 +193,9 @@ class Compensator(object):
 
         return
 
+    #Update from a line of the raw data split on tabs
     def update_data(self, data):
-        self.voltage = data[1]
-        self.wave = data[2]
-        self.temp = float(data[3].strip(' ').strip("C"))
-        self.avg = float(data[4].strip(" ").strip('C'))
-        self.auto = data[5]
-        self.useAverage = data[6]
-        self.i2c = data[7]
-        self.enabled = data[8]
-        self.sensor = data[9]
+        update_columns(self, data, self.columns)
         return
 
     def get_voltage_command(self, voltage):
@@ -224,18 +254,21 @@ class Compensator(object):
     
     # Data Class for the GPIOs
 class GPIO(object):
+    __slots__ = ("number", "state")
+    header = "GPIO\tEnabled"
+    columns = ((1, "state", parse_text),)
 
     def __init__(self, number):
         self.number = number
-        self.header = "GPIO\tEnabled"
         self.state = False
         return
 
     def __del__(self):
         return
 
+    #Update from a line of the raw data split on whitespace
     def update_data(self, data):
-        self.state = data[1]
+        update_columns(self, data, self.columns)
         return
 
     def get_info(self):
@@ -253,10 +286,12 @@ class GPIO(object):
 
 
 class Bipolar(object):
+    __slots__ = ("number", "frequency", "pulses", "voltage", "enabled")
+    header = "Bipolar\tfrequency\tpulses\tPeak2Peak\tEnabled"
+    columns = ((1, "frequency", parse_value), (2, "pulses", parse_value), (3, "voltage", parse_value), (4, "enabled", parse_text))
 
     def __init__(self, number):
         self.number = number
-        self.header = "Bipolar\tfrequency\tpulses\tPeak2Peak\tEnabled"
         self.frequency = 0
         self.pulses = 0
         self.voltage = 0
@@ -267,11 +302,9 @@ class Bipolar(object):
     def __del__(self):
         return
 
+    #Update from a line of the raw data split on whitespace
     def update_data(self, data):
-        self.frequency = data[1]
-        self.pulses = data[2]
-        self.voltage = data[3]
-        self.enabled = data[4]
+        update_columns(self, data, self.columns)
         return
     
     def get_info(self):
@@ -286,24 +319,84 @@ class Bipolar(object):
     
 
 
-class LFDI_TCB(object):
+#One poll of the TCB taken by the background poller
+#info is the same tab separated line get_info returns, the numbers are pulled out so they don't have to be parsed again
+class TCB_Snapshot(object):
+    __slots__ = ("timestamp", "info", "temps", "averages", "efforts", "setpoints", "voltages")
 
+    def __init__(self, timestamp, info, temps, averages, efforts, setpoints, voltages):
+        self.timestamp = timestamp
+        self.info = info
+        self.temps = temps
+        self.averages = averages
+        self.efforts = efforts
+        self.setpoints = setpoints
+        self.voltages = voltages
+        return
 
-    def __init__(self, com_port, baud_rate = 9600, silent = False):
-        self.com_port = com_port
-        self.baud_rate = baud_rate
-        self.OpenConnection()
-        self.silent = silent
-        self.ser.timeout = 1
-        self.ser.write_timeout = 1
-        
+
+#Fixed size ring buffer of snapshots. Once it is full the oldest snapshot gets overwritten
+class Snapshot_Buffer(object):
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = [None] * size
+        self.index = 0 #where the next snapshot goes
+        self.count = 0
+        self.appended = 0 #every snapshot ever added, used to wait for the next one
+        self.lock = threading.Condition()
+        return
+
+    def __len__(self):
+        return self.count
+
+    def append(self, snapshot:TCB_Snapshot):
+        with self.lock:
+            self.entries[self.index] = snapshot
+            self.index = (self.index + 1) % self.size
+            self.count = min(self.count + 1, self.size)
+            self.appended += 1
+            self.lock.notify_all()
+        return
+
+    #Block until there are more than seen snapshots or timeout seconds pass. Returns the number appended so far
+    def wait_for_new(self, seen, timeout = None):
+        with self.lock:
+            self.lock.wait_for(lambda: self.appended > seen, timeout)
+            return self.appended
+
+    #The newest snapshot or None if there are none yet
+    def latest(self):
+        with self.lock:
+            if self.count == 0:
+                return None
+            return self.entries[self.index - 1]
+
+    #All the snapshots we still have from oldest to newest
+    def get_history(self):
+        with self.lock:
+            if self.count < self.size:
+                return self.entries[:self.count]
+            return self.entries[self.index:] + self.entries[:self.index]
+
+
+# Holds the state of everything on the TCB and knows how to parse the raw data dump into it
+# Shared by LFDI_TCB and the asyncio client in LFDI_API_Async
+class TCB_Data(object):
+    #Fields apply_config can set as (setter suffix, field in the raw dump or None if the dump does not report it)
+    #In the order they are sent. The setpoint goes in before a controller is enabled
+    #and a compensator is enabled before its voltage is set since disabling it zeros the voltage
+    controller_config_fields = (("kp", "kp"), ("ki", "ki"), ("kd", "kd"), ("hist", None), ("frequency", None),
+                                ("i2c", "i2c"), ("setpoint", "setpoint"), ("enable", "enabled"))
+    compensator_config_fields = (("i2c", "i2c"), ("wavelength", "wave"), ("enable", "enabled"), ("voltage", "voltage"), ("auto", "auto"))
+
+    def __init__(self):
         self.Controllers = [Controller(1), Controller(2), Controller(3)] # Create the Controllers
         self.Compensators = [Compensator(1), Compensator(2), Compensator(3), Compensator(4), Compensator(5), Compensator(6)] #Create the Compensators
         self.GPIOs = [GPIO(1), GPIO(2), GPIO(3), GPIO(4), GPIO(5)]
         self.Bipolars = [Bipolar(1), Bipolar(2)]
-        self.current_context = "main"
-        self.valid_contexts = ["main", "controller", "compensator"]
-        
+        self.parse_errors = [] #(line, reason) for every line the last parse could not use
+        self.last_update = None #time.time() of the last raw dump that parsed cleanly
         self.header_format = f"Date\tTime\t"
         #add controller headers
         for controller in self.Controllers:
@@ -317,432 +410,741 @@ class LFDI_TCB(object):
         #add bipolar headers
         for bipolar in self.Bipolars:
             self.header_format += f"{bipolar.header}\t"
+        return
+
+    #Parse the Raw Data in a single pass
+    #Each section starts at its header line. Data lines are matched to their channel by the number in the first column
+    #Lines that can't be parsed are kept in parse_errors and the channel keeps its last good values
+    #Returns 0 if everything parsed, -1 if a section is missing or a line was bad (possible desync)
+    def parse_raw_data(self, raw_data:str):
+        self.parse_errors = []
+        if raw_data is None:
+            self.parse_errors.append(("", "No data"))
+            print("possible Desync Error with TCB output: no data")
+            return -1
+        section = None
+        found_controller_header = False
+        found_compensator_header = False
+        found_gpio_header = False
+        found_bipolar_header = False
+        for line in raw_data.split("\n"):
+            line = line.rstrip("\r")
+            #Section Headers
+            if Controller.header in line:
+                section = self.Controllers
+                found_controller_header = True
+                continue
+            if Compensator.header in line:
+                section = self.Compensators
+                found_compensator_header = True
+                continue
+            if not found_gpio_header and "GPIO" in line:
+                section = self.GPIOs
+                found_gpio_header = True
+                continue
+            if not found_bipolar_header and "Bipolar" in line:
+                section = self.Bipolars
+                found_bipolar_header = True
+                continue
+            if section is None:
+                continue
+
+            #Data Lines
+            if section is self.Controllers or section is self.Compensators:
+                terms = line.split("\t")
+            else:
+                terms = line.split()
+            if len(terms) == 0:
+                continue
+            number = channel_number_pattern.search(terms[0])
+            #Not a data line (blank line, prompt, menu text)
+            if number is None:
+                continue
+            number = int(number.group())
+            if number < 1 or number > len(section):
+                self.parse_errors.append((line, f"No channel {number}"))
+                continue
+            try:
+                section[number-1].update_data(terms)
+            except ValueError as e:
+                self.parse_errors.append((line, str(e)))
+
+        if not found_controller_header or not found_compensator_header:
+            self.parse_errors.append(("", "Missing Controller or Compensator header"))
+        for line, error in self.parse_errors:
+            print(f"possible Desync Error with TCB output {error}: {line!r}")
+        if len(self.parse_errors) > 0:
+            return -1
+        self.last_update = time.time()
+        return 0
+
+    #Compare a configuration to the last parsed raw dump
+    #controllers/compensators: {channel number: {field: value}} ie {1: {"kp": 5, "setpoint": 25, "enable": True}}
+    #Returns (context, number, field, desired, current) for every field that differs in the order they should be sent
+    #Fields the raw dump does not report are always included (current is None) unless include_unreported is False
+    def diff_config(self, controllers:dict = None, compensators:dict = None, include_unreported = True):
+        differences = []
+        for context, channels, config, config_fields in (("controller", self.Controllers, controllers, self.controller_config_fields),
+                                                         ("compensator", self.Compensators, compensators, self.compensator_config_fields)):
+            if config is None:
+                continue
+            known_fields = [field for field, dump_field in config_fields]
+            for number in sorted(config.keys()):
+                if number < 1 or number > len(channels):
+                    raise ValueError(f"No {context} {number}")
+                for field in config[number]:
+                    if field not in known_fields:
+                        raise ValueError(f"Unknown {context} field {field} expected one of {known_fields}")
+                channel = channels[number-1]
+                for field, dump_field in config_fields:
+                    if field not in config[number]:
+                        continue
+                    desired = config[number][field]
+                    if dump_field is None:
+                        if include_unreported:
+                            differences.append((context, number, field, desired, None))
+                        continue
+                    current = getattr(channel, dump_field)
+                    if not config_value_matches(current, desired):
+                        differences.append((context, number, field, desired, current))
+        return differences
+
+    #Copy the current state into a snapshot
+    def take_snapshot(self):
+        return TCB_Snapshot(time.time(), self.format_info(),
+                            tuple(controller.temp for controller in self.Controllers),
+                            tuple(controller.average for controller in self.Controllers),
+                            tuple(controller.effort for controller in self.Controllers),
+                            tuple(controller.setpoint for controller in self.Controllers),
+                            tuple(compensator.voltage for compensator in self.Compensators))
+
+    #Everything we know about the TCB in tab separated format (matches header_format)
+    def format_info(self):
+        #Get the Current Date Time in tab seperated format
+        info = datetime.now().strftime("%m/%d/%Y\t%H:%M:%S")
+        info = info + '\t'
+        #Get the info from all the controllers
+        for controller in self.Controllers:
+            info += controller.get_info() + '\t'
+        #Get the info from all the compensators
+        for compensator in self.Compensators:
+            info += compensator.get_info() + '\t'
+        for gpio in self.GPIOs:
+            info += gpio.get_info() + '\t'
+        for bipolar in self.Bipolars:
+            info += bipolar.get_info() + '\t'
+        return info
+
+
+
+#Round trip latency and traffic of one type of command ("kp", "v", "c", "r", ...)
+#Latencies go into a fixed histogram so recording is cheap no matter how long the run is
+class Command_Metrics(object):
+    __slots__ = ("count", "total", "minimum", "maximum", "histogram", "retries", "desyncs", "failures", "bytes_sent", "bytes_received")
+    #Upper edges of the histogram buckets (ms). The last bucket catches everything slower
+    bucket_edges = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.histogram = [0] * (len(self.bucket_edges) + 1)
+        self.retries = 0
+        self.desyncs = 0
+        self.failures = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        return
+
+    def record(self, latency, bytes_sent, bytes_received):
+        ms = latency * 1000
+        self.count += 1
+        self.total += ms
+        if self.minimum is None or ms < self.minimum:
+            self.minimum = ms
+        if self.maximum is None or ms > self.maximum:
+            self.maximum = ms
+        bucket = 0
+        while bucket < len(self.bucket_edges) and ms > self.bucket_edges[bucket]:
+            bucket += 1
+        self.histogram[bucket] += 1
+        self.bytes_sent += bytes_sent
+        self.bytes_received += bytes_received
+        return
+
+    #Upper edge of the bucket the percentile falls in (ms), never more than the slowest command
+    def percentile(self, percent):
+        if self.count == 0:
+            return None
+        target = self.count * percent / 100
+        seen = 0
+        for bucket, count in enumerate(self.histogram):
+            seen += count
+            if seen >= target:
+                return min(self.bucket_edges[bucket], self.maximum) if bucket < len(self.bucket_edges) else self.maximum
+        return self.maximum
+
+    #{"<=1": count, ... ">5000": count}
+    def get_histogram(self):
+        histogram = {f"<={edge}": count for edge, count in zip(self.bucket_edges, self.histogram)}
+        histogram[f">{self.bucket_edges[-1]}"] = self.histogram[-1]
+        return histogram
+
+    def get_stats(self):
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count if self.count > 0 else None,
+            "min_ms": self.minimum,
+            "max_ms": self.maximum,
+            "p50_ms": self.percentile(50),
+            "p99_ms": self.percentile(99),
+            "histogram_ms": self.get_histogram(),
+            "retries": self.retries,
+            "desyncs": self.desyncs,
+            "failures": self.failures,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+        }
+
+
+#Finds the command type in a command ("kp5" -> "kp", "tg25.5" -> "tg", "c2" -> "c")
+command_type_pattern = re.compile(r"[A-Za-z]*")
+
+#All the Command_Metrics of a TCB plus the time spent changing menus
+class TCB_Metrics(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+        return
+
+    def reset(self):
+        with self.lock:
+            self.commands = {}
+            self.context_changes = 0
+            self.context_time = 0.0
+            self.start_time = time.time()
+        return
+
+    def get_command(self, command):
+        command_type = command_type_pattern.match(command).group()
+        if command_type == "":
+            command_type = "prompt"
+        metrics = self.commands.get(command_type)
+        if metrics is None:
+            metrics = Command_Metrics()
+            self.commands[command_type] = metrics
+        return metrics
+
+    def record_command(self, command, latency, bytes_sent, bytes_received):
+        with self.lock:
+            self.get_command(command).record(latency, bytes_sent, bytes_received)
+        return
+
+    def record_desync(self, command):
+        with self.lock:
+            self.get_command(command).desyncs += 1
+        return
+
+    def record_retry(self, command):
+        with self.lock:
+            self.get_command(command).retries += 1
+        return
+
+    def record_failure(self, command):
+        with self.lock:
+            self.get_command(command).failures += 1
+        return
+
+    def record_context_change(self, duration):
+        with self.lock:
+            self.context_changes += 1
+            self.context_time += duration
+        return
+
+    def get_stats(self):
+        with self.lock:
+            commands = {command_type: metrics.get_stats() for command_type, metrics in self.commands.items()}
+            return {
+                "elapsed_s": time.time() - self.start_time,
+                "commands": commands,
+                "total_commands": sum(stats["count"] for stats in commands.values()),
+                "bytes_sent": sum(stats["bytes_sent"] for stats in commands.values()),
+                "bytes_received": sum(stats["bytes_received"] for stats in commands.values()),
+                "context_changes": self.context_changes,
+                "context_time_s": self.context_time,
+            }
+
+    #One line per command type
+    def format_stats(self):
+        stats = self.get_stats()
+        text = f"{'command':<12}{'count':>8}{'mean ms':>10}{'p50 ms':>9}{'p99 ms':>9}{'max ms':>9}{'retries':>9}{'desyncs':>9}{'failed':>8}\n"
+        for command_type, command in sorted(stats["commands"].items()):
+            text += (f"{command_type:<12}{command['count']:>8}{command['mean_ms'] or 0:>10.2f}{command['p50_ms'] or 0:>9.1f}"
+                     f"{command['p99_ms'] or 0:>9.1f}{command['max_ms'] or 0:>9.1f}{command['retries']:>9}{command['desyncs']:>9}{command['failures']:>8}\n")
+        text += (f"{stats['total_commands']} commands, {stats['bytes_sent']} bytes sent, {stats['bytes_received']} bytes received, "
+                 f"{stats['context_time_s']:.2f}s in {stats['context_changes']} menu changes")
+        return text
+
+
+#Raised when a command's expected response never came back even after every recovery step
+class TCB_Desync_Error(Exception):
+
+    def __init__(self, command, expected_response, response):
+        self.command = command
+        self.expected_response = expected_response
+        self.response = response
+        Exception.__init__(self, f"No response {expected_response!r} to command {command!r} after recovery, last response {response!r}")
+        return
+
+
+class LFDI_TCB(TCB_Data):
+
+
+    def __init__(self, com_port, baud_rate = 9600, silent = False):
+        self.com_port = com_port
+        self.baud_rate = baud_rate
+        #Nothing to close until the port is open
+        self.closed = True
+        self.poll_thread = None
+        self.OpenConnection()
+        self.closed = False
+        self.silent = silent
+        self.ser.timeout = 1
+        self.ser.write_timeout = 1
+        #Read timing for send_command. Reads return as soon as the expected response or the prompt shows up
+        self.prompt = ">" #The TCB prints this when it is ready for the next command
+        self.command_timeout = 1 #Longest we wait on a single command (s)
+        self.raw_data_timeout = 3 #The raw dump is much longer than a normal response (s)
+        self.quiet_time = 0.05 #If nothing new comes in for this long the response is done (s)
+        self.raw_data_quiet_time = 0.25 #The TCB can pause between sections of the raw dump (s)
+        self.poll_interval = 0.002 #How often we check the port for new bytes (s)
+        #Desync recovery. The wait before each recovery step doubles from recovery_backoff up to recovery_backoff_max (s)
+        self.recovery_backoff = 0.05
+        self.recovery_backoff_max = 0.5
+        self.recovery_counts = {"drain": 0, "resync": 0, "reopen": 0, "failed": 0}
+        self.last_recovery = None #The recovery step the last command needed, None if it went through first time
+        self.recovering = False
+        self.auto_toggled_at = None #time.time() the last comp went out, the auto state in the dump before it is stale
+        #Per command latency, retries and traffic. Commands are only printed when echo_commands is set
+        self.metrics = TCB_Metrics()
+        self.echo_commands = False
+        #Only one thread talks to the TCB at a time (the background poller or the caller)
+        self.lock = threading.RLock()
+        self.snapshots = None
+        self.stop_polling_event = threading.Event()
+        
+        TCB_Data.__init__(self)
+        #Cached menu state of the TCB so we only send the menu changes that are needed
+        self.current_context = "main"
+        self.selected_channel = None
+        self.valid_contexts = ["main", "controller", "compensator"]
+        #The TCB could have been left in any menu so start from a known state
+        self.resync()
             
 
     def OpenConnection(self):
-        self.ser = serial.Serial(self.com_port, self.baud_rate, timeout = 2)
+        #A Virtual_TCB from TCB_Simulator can be passed in place of the com port name
+        if isinstance(self.com_port, str):
+            self.ser = serial.Serial(self.com_port, self.baud_rate, timeout = 2)
+        else:
+            self.ser = self.com_port
+            self.ser.open()
         self.ser.flushInput()
         self.ser.flushOutput()
         return
 
 
     def __del__(self):
-        #Disable all controllers
-        for controller in self.Controllers:
-            self.set_controller_enable(controller.number, False)
-        #Disable all compensators
-        for compensator in self.Compensators:
-            self.set_compensator_enable(compensator.number, False)
+        self.close()
+        return
+
+    #Stop polling, disable all controllers and compensators and close the port. Does nothing if it is already closed
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.stop_polling()
+        try:
+            #Disable all controllers
+            for controller in self.Controllers:
+                self.set_controller_enable(controller.number, False)
+            #Disable all compensators
+            for compensator in self.Compensators:
+                self.set_compensator_enable(compensator.number, False)
+        except TCB_Desync_Error as e:
+            print(f"Could not disable the TCB {e}")
         self.ser.close()
         print("LFDI_TCB closed")
 
 
     #Switches the Context Menu of the TCB
+    #Only sends the menu changes that are needed to get from where we think the TCB is to the new context
     def change_context(self, context:str):
         context = context.lower()
         if context not in self.valid_contexts:
             print(f"Context {context} is not valid")
             return
+        #Already there nothing to send
+        if context == self.current_context:
+            return
+        start = time.perf_counter()
         if self.current_context != "main":
             #Go back to main
             self.send_command("m")
+            self.current_context = "main"
+            self.selected_channel = None
 
         #if we are going to main we are there
-        if context == "main":
+        if context != "main":
+            #Go to the context
+            self.send_command(context)
             self.current_context = context
-            return
-        
-        #Go to the context
-        self.send_command(context)
-        self.current_context = context
+            self.selected_channel = None
+        self.metrics.record_context_change(time.perf_counter() - start)
         return
 
-    #Sends Command to the Controller
-    def send_command(self, command, print_command =True, expected_response = None, attempts = 0):
-        if attempts > 3:
-            print(f"Too many attempts to send command {command}\nRestarting Connection")
-            self.ser.close()
-            self.OpenConnection()
+    #Select a Controller or Compensator in the current context. Skipped if it is already selected
+    def select_channel(self, number:int):
+        if self.selected_channel == number:
             return
-         #try to send command   
+        self.send_command(f"c{number}")
+        self.selected_channel = number
+        return
+
+    #Forget the cached menu state and put the TCB back in the main menu
+    def resync(self):
+        with self.lock:
+            self.send_command("m")
+            self.current_context = "main"
+            self.selected_channel = None
+        return
+
+    #Send a command to a single Controller or Compensator
+    #If the expected response never comes back send_command works through the recovery steps and puts us back in this context and channel
+    #retry: False for commands that can't be sent twice (toggles), see send_command
+    def send_channel_command(self, context:str, number:int, command, expected_response = None, retry = True):
+        with self.lock:
+            self.change_context(context)
+            self.select_channel(number)
+            r = self.send_command(command, expected_response = expected_response, context = context, number = number, retry = retry)
+        return r
+
+    #Read from the port until the response is complete instead of sleeping a fixed amount
+    #The response is complete when the prompt shows up, or (when we are not waiting on anything specific) the port goes quiet
+    #The expected response line is not the end: the prompt comes in right behind it and if it was left on the port it would
+    #end the next command's read. So once the line is in we keep reading until the prompt, or until the port goes quiet
+    #for a TCB that does not print one. Gives up after timeout seconds
+    def read_response(self, expected_response = None, timeout = None, quiet_time = None):
+        if timeout is None:
+            timeout = self.command_timeout
+        if quiet_time is None:
+            quiet_time = self.quiet_time
+        deadline = time.monotonic() + timeout
+        val = ""
+        last_rx = None
+        have_response = expected_response is None
+        while True:
+            now = time.monotonic()
+            waiting = self.ser.in_waiting
+            if waiting:
+                val += self.ser.read(waiting).decode('utf-8', errors = 'ignore')
+                last_rx = now
+                #The Prompt means the TCB is done talking
+                if self.prompt is not None and val.rstrip().endswith(self.prompt):
+                    return val
+                #Wait for the rest of the line so the value that was set comes back with it
+                if not have_response:
+                    index = val.find(expected_response)
+                    if index != -1 and "\n" in val[index:]:
+                        if self.prompt is None:
+                            return val
+                        have_response = True
+            elif have_response and last_rx is not None and now - last_rx > quiet_time:
+                return val
+            if now > deadline:
+                return val
+            sleep(self.poll_interval)
+
+    #Write a command and read back its response. Returns None if the port itself failed
+    def exchange(self, command, print_command = True, expected_response = None, timeout = None, quiet_time = None):
         self.ser.flushInput()
         self.ser.flushOutput()
-        
-        if print_command:
+        if print_command and self.echo_commands:
             print(f"{command}")
+        data = f"{command}\r".encode('utf-8')
+        start = time.perf_counter()
         try:
-            self.ser.write(f"{command}\r".encode('utf-8'))
-            sleep(.5)
-        except:
-            print("Issue Sending Command")
-
-        try:
-            val = self.ser.read_all().decode('utf-8', errors = 'ignore')
-        except:
-            print(f"Lost Connection With port")
-            self.ser.close()
-            self.OpenConnection()
-        #Check to see we got the right stuff back
-        if expected_response is None:
-            return val
-        #If our response doesnot contain the expected response we are out of sync
-        if expected_response not in val:
-            print(f"Expected response: {expected_response} not Response: {val}")        
-            val = self.send_command(command, print_command, expected_response, attempts=attempts+1)
-            return val
+            self.ser.write(data)
+            val = self.read_response(expected_response, timeout, quiet_time)
+        except Exception as e:
+            print(f"Lost Connection With port {e}")
+            return None
+        self.metrics.record_command(command, time.perf_counter() - start, len(data), len(val))
         return val
-             
-        
 
+    #Sends Command to the Controller
+    #If the expected response does not come back we work through the recovery steps until it does
+    #context and number are the menu and channel the command belongs in so the TCB can be put back there
+    #Returns the response or raises TCB_Desync_Error if none of the recovery steps worked
+    #retry: False for commands that change state every time they are sent (comp toggles auto compensation). If the response
+    #is lost the board may still have run it, so recovery only gets the TCB back to a known menu and TCB_Desync_Error is
+    #raised without sending it again. The caller has to read the state back
+    def send_command(self, command, print_command =True, expected_response = None, timeout = None, quiet_time = None, context = None, number = None,
+                     retry = True):
+        with self.lock:
+            self.last_recovery = None
+            val = self.exchange(command, print_command, expected_response, timeout, quiet_time)
+            #Nothing to check against
+            if expected_response is None and val is not None:
+                return val
+            if val is not None and expected_response in val:
+                return val
+            print(f"Expected response: {expected_response} not Response: {val}")
+            self.metrics.record_desync(command)
+            #Menu changes made by a recovery step don't start their own recovery
+            if self.recovering:
+                return val
+            return self.recover(command, print_command, expected_response, timeout, quiet_time, context, number, port_failed = val is None,
+                                resend = retry)
+
+    #Escalating recovery for a command whose response did not come back
+    #   drain   - throw away whatever is left on the port, get a fresh prompt and resend
+    #   resync  - put the TCB back in the main menu, go back to the context and channel and resend
+    #   reopen  - close and reopen the port, resync and resend
+    #Waits a little longer before each step (capped at recovery_backoff_max) to let the TCB finish whatever it was doing
+    #resend: False stops after the first step that works without sending the command again and raises TCB_Desync_Error
+    def recover(self, command, print_command, expected_response, timeout, quiet_time, context = None, number = None, port_failed = False,
+                resend = True):
+        steps = [("drain", self.drain_and_reprompt), ("resync", self.resync_context), ("reopen", self.reopen)]
+        #A dead port won't come back from a drain or a menu change
+        if port_failed:
+            steps = steps[2:]
+        val = None
+        self.recovering = True
+        try:
+            for index, (step, action) in enumerate(steps):
+                sleep(min(self.recovery_backoff * 2**index, self.recovery_backoff_max))
+                try:
+                    action(context, number)
+                except Exception as e:
+                    print(f"Recovery step {step} failed {e}")
+                    continue
+                if not resend:
+                    #Back in a known menu, whether the command ran is up to the caller to find out
+                    self.recovery_counts[step] += 1
+                    self.last_recovery = step
+                    raise TCB_Desync_Error(command, expected_response, val)
+                self.metrics.record_retry(command)
+                val = self.exchange(command, print_command, expected_response, timeout, quiet_time)
+                if val is not None and (expected_response is None or expected_response in val):
+                    print(f"Recovered command {command} with {step}")
+                    self.recovery_counts[step] += 1
+                    self.last_recovery = step
+                    return val
+        finally:
+            self.recovering = False
+        #We have no idea what menu the TCB is in so the next command starts from main
+        self.recovery_counts["failed"] += 1
+        self.metrics.record_failure(command)
+        self.last_recovery = "failed"
+        self.current_context = None
+        self.selected_channel = None
+        raise TCB_Desync_Error(command, expected_response, val)
+
+    #Read everything still coming in until the port goes quiet then send an empty line to get a fresh prompt
+    def drain_and_reprompt(self, context = None, number = None):
+        self.read_response(timeout = self.quiet_time)
+        self.exchange("", print_command = False)
+        return
 
+    #Back to main then back to the context and channel the command was for
+    def resync_context(self, context = None, number = None):
+        self.resync()
+        if context is not None:
+            self.change_context(context)
+            if number is not None:
+                self.select_channel(number)
+        return
 
-    #Set the Compensator Voltage
-    def set_compensator_voltage(self, compensator_number:int, voltage:float):
-        self.change_context("compensator")
-        self.send_command(f"c{compensator_number}")
-        expected_response = self.Compensators[compensator_number-1].get_voltage_response()
-        r = self.send_command(self.Compensators[compensator_number-1].get_voltage_command(voltage), expected_response = expected_response)
-        if not self.silent:
-            print(r)
-        self.change_context("main")
+    #Close and reopen the port then resync
+    def reopen(self, context = None, number = None):
+        print("Restarting Connection")
+        try:
+            self.ser.close()
+        except Exception:
+            pass
+        self.OpenConnection()
+        self.resync_context(context, number)
         return
 
+
+    #comp flips auto compensation so it is never sent again blindly. If its response is lost the auto state is read back
+    #once the TCB is in a known menu and comp only goes out again if the state did not flip
+    def send_auto_toggle(self, compensator_number):
+        compensator = self.Compensators[compensator_number-1]
+        command = compensator.get_auto_command()
+        expected_response = compensator.get_auto_response()
+        with self.lock:
+            #Need the state from before the toggle to tell if it went through
+            if self.last_update is None or (self.auto_toggled_at is not None and self.last_update < self.auto_toggled_at):
+                self.refresh()
+            before = compensator.auto
+            try:
+                r = self.send_channel_command("compensator", compensator_number, command, expected_response = expected_response, retry = False)
+            except TCB_Desync_Error as e:
+                self.refresh()
+                if compensator.auto != before:
+                    print(f"Compensator {compensator_number} auto compensation toggled, its response was lost")
+                    r = e.response
+                else:
+                    print(f"Compensator {compensator_number} auto compensation did not toggle, sending {command} again")
+                    r = self.send_channel_command("compensator", compensator_number, command, expected_response = expected_response, retry = False)
+            self.auto_toggled_at = time.time()
+        return r
+
     #Set the Compensator compensate
     def toggle_compensator_auto(self, compensator_number):
-        self.change_context("compensator")
-        r = self.send_command(f"c{compensator_number}")
+        r = self.send_auto_toggle(compensator_number)
         if not self.silent:
             print(r)
-        expected_response = self.Compensators[compensator_number-1].get_auto_response()
-        self.send_command(self.Compensators[compensator_number-1].get_auto_command(), expected_response = expected_response)
-        if not self.silent:
-            print(r)
-        self.change_context("main")
         return
 
     def set_compensator_useAverage(self, compensator_number, useAverage):
         print("Not Implemented")
         return
 
-    #Set the Compensator i2c address
-    def set_compensator_i2c(self, compensator_number, i2c):
-        self.change_context("compensator")
-        self.send_command(f"c{compensator_number}")
-        expected_response = self.Compensators[compensator_number-1].get_i2c_response()
-        r = self.send_command(self.Compensators[compensator_number-1].get_i2c_command(i2c), expected_response = expected_response)
-        if not self.silent:
-            print(r)
-        self.change_context("main")
-        return
-    
-    #Set the Compensator enable
-    def set_compensator_enable(self, compensator_number, enable):
-        self.change_context("compensator")
-        self.send_command(f"c{compensator_number}")
-        expected_response = self.Compensators[compensator_number-1].get_enable_response(enable)
-        r = self.send_command(self.Compensators[compensator_number-1].get_enable_command(enable), expected_response=expected_response)
-        if not self.silent:
-            print(r)
-        self.change_context("main")
-        return
-    
-    #Set the Controller enable
-    def set_controller_enable(self, controller_number, enable):
-        self.change_context("controller")
-        self.send_command(f"c{controller_number}")
-        expected_response = self.Controllers[controller_number-1].get_enable_response(enable)
-        r = self.send_command(self.Controllers[controller_number-1].get_enable_command(enable), expected_response=expected_response)
-        if not self.silent:
-            print(r)
-        self.change_context("main")
-        return
-    
-    #Set the Controller i2c address
-    def set_controller_i2c(self, controller_number, i2c):
-        self.change_context("controller")
-        self.send_command(f"c{controller_number}")
-        expected_response = self.Controllers[controller_number-1].get_i2c_response()
-        r = self.send_command(self.Controllers[controller_number-1].get_i2c_command(i2c), expected_response = expected_response)
-        if not self.silent:
-            print(r)
-        self.change_context("main")
-        return
-    
-    #Set the Controller Kp
-    def set_controller_kp(self, controller_number, kp):
-        self.change_context("controller")
-        self.send_command(f"c{controller_number}")
-        expected_response = self.Controllers[controller_number-1].get_kp_response()
-        print(self.send_command(self.Controllers[controller_number-1].get_kp_command(kp), expected_response = expected_response))
-        self.change_context("main")
-        return
-    
-    #Set the Controller Ki
-    def set_controller_ki(self, controller_number, ki):
-        self.change_context("controller")
-        self.send_command(f"c{controller_number}")
-        expected_response = self.Controllers[controller_number-1].get_ki_response()
-        print(self.send_command(self.Controllers[controller_number-1].get_ki_command(ki), expected_response=expected_response))
-        self.change_context("main")
-        return
-    
-    #Set the Controller Kd
-    def set_controller_kd(self, controller_number, kd):
-        self.change_context("controller")
-        self.send_command(f"c{controller_number}")
-        expected_response = self.Controllers[controller_number-1].get_kd_response()
-        print(self.send_command(self.Controllers[controller_number-1].get_kd_command(kd), expected_response=expected_response))
-        self.change_context("main")
-        return
-
-    #Set the Controller hist
-    def set_controller_hist(self, controller_number, hist):
-        self.change_context("controller")
-        self.send_command(f"c{controller_number}")
-        expected_response = self.Controllers[controller_number-1].get_hist_response()
-        print(self.send_command(self.Controllers[controller_number-1].get_hist_command(hist), expected_response=expected_response))
-        self.change_context("main")
-        return
-    
-    #set the Conteller frequency
-    def set_controller_frequency(self, controller_number, frequency):
-        self.change_context("controller")
-        self.send_command(f"c{controller_number}")
-        expected_response = self.Controllers[controller_number-1].get_frequency_response()
-        print(self.send_command(self.Controllers[controller_number-1].get_frequency_command(frequency), expected_response=expected_response))
-        self.change_context("main")
-        return
-
     #set the Controller kp
     def set_controller_kp(self, controller_number, kp):
-        self.change_context("controller")
-        self.send_command(f"c{controller_number}")
         expected_response = self.Controllers[controller_number-1].get_kp_response()
-        print(self.send_command(self.Controllers[controller_number-1].get_kp_command(kp), expected_response=expected_response))
-        self.change_context("main")
+        print(self.send_channel_command("controller", controller_number, self.Controllers[controller_number-1].get_kp_command(kp), expected_response=expected_response))
         return
     
     #set the Controller ki
     def set_controller_ki(self, controller_number, ki):
-        self.change_context("controller")
-        self.send_command(f"c{controller_number}")
         expected_response = self.Controllers[controller_number-1].get_ki_response()
-        print(self.send_command(self.Controllers[controller_number-1].get_ki_command(ki), expected_response=expected_response))
-        self.change_context("main")
+        print(self.send_channel_command("controller", controller_number, self.Controllers[controller_number-1].get_ki_command(ki), expected_response=expected_response))
         return
 
     #set the Controller kd
     def set_controller_kd(self, controller_number, kd):
-        self.change_context("controller")
-        self.send_command(f"c{controller_number}")
         expected_response = self.Controllers[controller_number-1].get_kd_response()
-        print(self.send_command(self.Controllers[controller_number-1].get_kd_command(kd), expected_response=expected_response))
-        self.change_context("main")
+        print(self.send_channel_command("controller", controller_number, self.Controllers[controller_number-1].get_kd_command(kd), expected_response=expected_response))
         return
     
     #set the Controller hist
     def set_controller_hist(self, controller_number, hist):
-        self.change_context("controller")
-        self.send_command(f"c{controller_number}")
         expected_response = self.Controllers[controller_number-1].get_hist_response()
-        print(self.send_command(self.Controllers[controller_number-1].get_hist_command(hist), expected_response=expected_response))
-        self.change_context("main")
+        print(self.send_channel_command("controller", controller_number, self.Controllers[controller_number-1].get_hist_command(hist), expected_response=expected_response))
         return
 
     #set the Controller frequency
     def set_controller_frequency(self, controller_number, frequency):
-        self.change_context("controller")
-        self.send_command(f"c{controller_number}")
         expected_response = self.Controllers[controller_number-1].get_frequency_response()
-        print(self.send_command(self.Controllers[controller_number-1].get_frequency_command(frequency), expected_response=expected_response))
-        self.change_context("main")
+        print(self.send_channel_command("controller", controller_number, self.Controllers[controller_number-1].get_frequency_command(frequency), expected_response=expected_response))
         return
 
     #set the Controller setpoint
     def set_controller_setpoint(self, controller_number, setpoint):
-        self.change_context("controller")
-        self.send_command(f"c{controller_number}")
         expected_response = self.Controllers[controller_number-1].get_setpoint_response()
-        print(self.send_command(self.Controllers[controller_number-1].get_setpoint_command(setpoint), expected_response=expected_response))
-        self.change_context("main")
+        print(self.send_channel_command("controller", controller_number, self.Controllers[controller_number-1].get_setpoint_command(setpoint), expected_response=expected_response))
         return
         
     #set the Controller i2c address
     def set_controller_i2c(self, controller_number, i2c):
-        self.change_context("controller")
-        self.send_command(f"c{controller_number}")
         expected_response = self.Controllers[controller_number-1].get_i2c_response()
-        print(self.send_command(self.Controllers[controller_number-1].get_i2c_command(i2c), expected_response=expected_response))
-        self.change_context("main")
+        print(self.send_channel_command("controller", controller_number, self.Controllers[controller_number-1].get_i2c_command(i2c), expected_response=expected_response))
         return
 
     #Set the Controller enable
     def set_controller_enable(self, controller_number, enable:bool):
-        self.change_context("controller")
-        self.send_command(f"c{controller_number}")
         expected_response = self.Controllers[controller_number-1].get_enable_response(enable)
-        print(self.send_command(self.Controllers[controller_number-1].get_enable_command(enable), expected_response=expected_response))
-        self.change_context("main")
+        print(self.send_channel_command("controller", controller_number, self.Controllers[controller_number-1].get_enable_command(enable), expected_response=expected_response))
         return
 
     #set the Compensator Auto
     def set_compensator_auto(self, compensator_number):
-        self.change_context("compensator")
-        self.send_command(f"c{compensator_number}")
-        expected_response = self.Compensators[compensator_number-1].get_auto_response()
-        print(self.send_command(self.Compensators[compensator_number-1].get_auto_command(), expected_response=expected_response))
-        self.change_context("main")
+        print(self.send_auto_toggle(compensator_number))
         return
 
     #set the Compensator Voltage
     def set_compensator_voltage(self, compensator_number, voltage):
-        self.change_context("compensator")
-        self.send_command(f"c{compensator_number}")
         expected_response = self.Compensators[compensator_number-1].get_voltage_response()
-        r = self.send_command(self.Compensators[compensator_number-1].get_voltage_command(voltage), expected_response=expected_response)
+        r = self.send_channel_command("compensator", compensator_number, self.Compensators[compensator_number-1].get_voltage_command(voltage), expected_response=expected_response)
         if not self.silent:
             print(r)
-        self.change_context("main")
         return
 
     #set the Compensator Wavelength
     def set_compensator_wavelength(self, compensator_number, wavelength):
-        self.change_context("compensator")
-        self.send_command(f"c{compensator_number}")
         expected_response = self.Compensators[compensator_number-1].get_wavelength_response()
-        print(self.send_command(self.Compensators[compensator_number-1].get_wavelength_command(wavelength), expected_response=expected_response))
-        self.change_context("main")
+        print(self.send_channel_command("compensator", compensator_number, self.Compensators[compensator_number-1].get_wavelength_command(wavelength), expected_response=expected_response))
         return
 
     #set the Compensator i2c address
     def set_compensator_i2c(self, compensator_number, i2c):
-        self.change_context("compensator")
-        self.send_command(f"c{compensator_number}")
         expected_response = self.Compensators[compensator_number-1].get_i2c_response()
-        print(self.send_command(self.Compensators[compensator_number-1].get_i2c_command(i2c), expected_response=expected_response))
-        self.change_context("main")
+        print(self.send_channel_command("compensator", compensator_number, self.Compensators[compensator_number-1].get_i2c_command(i2c), expected_response=expected_response))
         return
     
     #set the Compensator enable
     def set_compensator_enable(self, compensator_number, enable:bool):
         if not enable:
             self.set_compensator_voltage(compensator_number=compensator_number, voltage=0)
-        self.change_context("compensator")
-        self.send_command(f"c{compensator_number}")
         expected_response = self.Compensators[compensator_number-1].get_enable_response(enable)
-        r = self.send_command(self.Compensators[compensator_number-1].get_enable_command(enable), expected_response=expected_response)
+        r = self.send_channel_command("compensator", compensator_number, self.Compensators[compensator_number-1].get_enable_command(enable), expected_response=expected_response)
         if not self.silent:
             print(r)
-        
-        self.change_context("main")
         return
     
+    #Bring the TCB to a configuration in one go
+    #controllers/compensators: {channel number: {field: value}} with the fields named after the setters ie
+    #   lfdi.apply_config(controllers = {1: {"kp": 5, "ki": 0, "kd": 0.75, "setpoint": 25, "enable": True}},
+    #                     compensators = {3: {"voltage": 0, "enable": True}})
+    #Only the fields that differ from the last raw dump are sent (hist and frequency are not in the dump so they are always sent)
+    #All the controller changes go out before the compensator changes so each menu is only entered once
+    #Everything is checked with a single read of the TCB afterwards
+    #Returns the fields that still do not match as (context, number, field, desired, current), empty if the TCB took the whole config
+    def apply_config(self, controllers:dict = None, compensators:dict = None, refresh = True):
+        with self.lock:
+            #Start from a fresh dump unless the poller just read the TCB
+            if self.last_update is None or (refresh and self.get_latest_snapshot() is None):
+                self.refresh()
+            changes = self.diff_config(controllers, compensators)
+            for context, number, field, desired, current in changes:
+                setter = getattr(self, f"set_{context}_{field}")
+                if field == "auto":
+                    #The TCB toggles auto compensation so only send it when it needs to flip
+                    setter(number)
+                else:
+                    setter(number, desired)
+            self.refresh()
+            mismatches = self.diff_config(controllers, compensators, include_unreported = False)
+        if not self.silent:
+            print(f"Applied config: {len(changes)} fields sent, {len(mismatches)} not matching")
+        for context, number, field, desired, current in mismatches:
+            print(f"{context} {number} {field} is {current} expected {desired}")
+        return mismatches
+
     #reset the TCB
     def reset(self):
-        self.send_command("bounce")
-        sleep(10)
+        with self.lock:
+            self.change_context("main")
+            self.send_command("bounce")
+            sleep(10)
+            #The TCB comes back up in the main menu
+            self.current_context = "main"
+            self.selected_channel = None
+            #and with its power on settings so the last dump no longer applies
+            self.last_update = None
         return
 
     
     #Request the Raw Data from the TCB
     def read_raw_data(self):
-        return self.send_command("r")
-
-
-    #parse the Controller data and update the Controller
-    def parse_controller_data(self, raw_data:list[str]):
-        #For each line in the data find the Controller and update the data
+        return self.send_command("r", timeout = self.raw_data_timeout, quiet_time = self.raw_data_quiet_time)
 
-        for line in raw_data:
-            terms = line.split("\t")
-            
-            #Go through each Controller and check if the line is for that Controller
-            for controller in self.Controllers:
-                if str(controller.number) in terms[0]:
-                    controller.update_data(terms)
-                    break
-        return
-
-    #parse the Compensator data and update the Compensator
-    def parse_compensator_data(self, raw_data:list[str]):
-        #For each line in the data find the Compensator and update the data
-        for line in raw_data:
-            terms = line.split("\t")
-            #Go through each Compensator and check if the line is for that Compensator
-            
-            for compensator in self.Compensators:
-                if str(compensator.number) in terms[0]:
-                    compensator.update_data(terms)
-                    break
-        return
-
-    def parse_gpio_data(self, raw_data:list[str]):
-        #For each line in the data find the GPIO and update the data
-        for line in raw_data:
-            terms = line.split(" ")
-            #Go through each GPIO and check if the line is for that GPIO
-            for gpio in self.GPIOs:
-                if str(gpio.number) in terms[0]:
-                    gpio.update_data(terms)
-                    break
-        return
-    
-    def parse_bipolar_data(self, raw_data:list[str]):
-        #For each line in the data find the Bipolar and update the data
-        for line in raw_data:
-            terms = line.split(" ")
-            #Go through each Bipolar and check if the line is for that Bipolar
-            for bipolar in self.Bipolars:
-                if str(bipolar.number) in terms[0]:
-                    bipolar.update_data(terms)
-                    break
-        return
-
-    #Parse the Raw Data. 
-    def parse_raw_data(self, raw_data:str):
-        try:
-            #remove the first row which is the header
-            raw_data = raw_data.split("\n")
-            
-            #Find the line that contains the header of the Controller
-            for i in range(len(raw_data)):
-                if self.Controllers[0].header in raw_data[i]:
-                    break
-            ControllerHeaderLine = i
-            #Find the line that contains the header of the Compensator
-            for i in range(len(raw_data)):
-                if self.Compensators[0].header in raw_data[i]:
-                    break
-            CompensatorHeaderLine = i
-            #find the line that contains the header of the GPIO 
-            for i in range(len(raw_data)):
-                if "GPIO" in raw_data[i]:
-                    break
-            GPIOHeaderLine = i
-            #find the line that contains the header of the Bipolar
-            for i in range(len(raw_data)):
-                if "Bipolar" in raw_data[i]:
-                    break
-            BipolarHeaderLine = i
-
-            #Get all the lines between the Controller and Compensator Header
-            controller_raw_data = raw_data[ControllerHeaderLine+1:CompensatorHeaderLine]
-            self.parse_controller_data(controller_raw_data)
-            #Get all the lines between the Compensator and the end of the file
-            compensator_raw_data = raw_data[CompensatorHeaderLine+1:GPIOHeaderLine]
-            self.parse_compensator_data(compensator_raw_data)
-            #Get all the lines between the GPIO and the end of the file
-            #gpio_raw_data = raw_data[GPIOHeaderLine+1:BipolarHeaderLine]
-            #self.parse_gpio_data(gpio_raw_data)
-            #Get all the lines between the Bipolar and the end of the file
-            #bipolar_raw_data = raw_data[BipolarHeaderLine+1:]
-            #self.parse_bipolar_data(bipolar_raw_data)
-            
-            return 0
-
-        except IndexError as e:
-            print(f"possible Desync Error with TCB output {e}")
-            return(-1)
 
     #get the data from the TCB
     def update_data(self):
@@ -751,27 +1153,186 @@ class LFDI_TCB(object):
         #Parse the Raw Data
         self.parse_raw_data(raw_data)
         return
+
+    #Go to the main menu and update all the data
+    def refresh(self):
+        with self.lock:
+            self.change_context("main")
+            self.update_data()
+        return
     
-    #return a crap ton of info in string format    
+    #return a crap ton of info in string format
+    #If the background poller is running this is the latest poll and the port is not touched
     def get_info(self):
+        snapshot = self.get_latest_snapshot()
+        if snapshot is not None:
+            return snapshot.info
         #Update all the Data
-        self.change_context("main")
-        self.update_data()
+        self.refresh()
         #make a string wilth all the info
-        #Get the Current Date Time in tab seperated format
-        info = datetime.now().strftime("%m/%d/%Y\t%H:%M:%S")
-        info = info + '\t'
-        #Get the info from all the controllers
-        for controller in self.Controllers:
-            info += controller.get_info() + '\t'
-        #Get the info from all the compensators
-        for compensator in self.Compensators:
-            info += compensator.get_info() + '\t'
-        for gpio in self.GPIOs:
-            info += gpio.get_info() + '\t'
-        for bipolar in self.Bipolars:
-            info += bipolar.get_info() + '\t'
-        return info
+        return self.format_info()
+
+    #Command latency histograms, retries, desyncs, traffic and time spent changing menus as a dict
+    def get_stats(self):
+        stats = self.metrics.get_stats()
+        stats["recoveries"] = dict(self.recovery_counts)
+        return stats
+
+    #Human readable table of get_stats
+    def format_stats(self):
+        return self.metrics.format_stats()
+
+    #Write get_stats to a JSON file, ie at the end of a run
+    def dump_stats(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.get_stats(), f, indent = 2)
+        return
+
+    def reset_stats(self):
+        self.metrics.reset()
+        self.recovery_counts = {"drain": 0, "resync": 0, "reopen": 0, "failed": 0}
+        return
+
+    #Start a background thread that reads the raw data every interval seconds
+    #The last history snapshots are kept in a ring buffer (an hour of history at the default rate)
+    #A poll is not free: the dump is only available from the main menu so every poll leaves the controller/compensator menu
+    #the next command needs, and it holds the port while the dump comes back (about 1s at 9600 baud). Foreground commands
+    #wait behind it and pay two extra menu commands afterwards. Keep the interval well above the dump time
+    def start_polling(self, interval = 5, history = 720):
+        if self.poll_thread is not None:
+            print("Already Polling")
+            return
+        self.snapshots = Snapshot_Buffer(history)
+        self.poll_period = interval
+        self.stop_polling_event.clear()
+        self.poll_thread = threading.Thread(target = self.poll_loop, daemon = True)
+        self.poll_thread.start()
+        return
+
+    def stop_polling(self):
+        if self.poll_thread is None:
+            return
+        self.stop_polling_event.set()
+        self.poll_thread.join()
+        self.poll_thread = None
+        return
+
+    def poll_loop(self):
+        while not self.stop_polling_event.is_set():
+            start = time.monotonic()
+            try:
+                #The snapshot is taken before anything else can get at the TCB so a snapshot stamped after a command
+                #was sent is always from a dump read after it
+                with self.lock:
+                    self.refresh()
+                    snapshot = self.take_snapshot()
+                self.snapshots.append(snapshot)
+            except Exception as e:
+                print(f"Could not poll the TCB {e}")
+            #Wait out the rest of the interval, wakes up right away if we are stopped
+            self.stop_polling_event.wait(max(0, self.poll_period - (time.monotonic() - start)))
+        return
+
+    #The latest snapshot from the background poller or None if it is not running
+    def get_latest_snapshot(self):
+        if self.poll_thread is None or self.snapshots is None:
+            return None
+        return self.snapshots.latest()
+
+    #The first snapshot read after the time after (time.time()), ie the state once a command sent at that time took effect
+    #Waits for the poller if it is running, otherwise reads the TCB now. None if the poller has nothing in timeout seconds
+    def wait_for_snapshot(self, after, timeout = None):
+        if self.poll_thread is None or self.snapshots is None:
+            with self.lock:
+                self.refresh()
+                return self.take_snapshot()
+        if timeout is None:
+            timeout = self.poll_period * 2 + self.raw_data_timeout
+        deadline = time.monotonic() + timeout
+        seen = 0
+        while True:
+            snapshot = self.snapshots.latest()
+            if snapshot is not None and snapshot.timestamp > after:
+                return snapshot
+            wait = deadline - time.monotonic()
+            if wait <= 0:
+                return None
+            seen = self.snapshots.wait_for_new(seen, wait)
+
+    #All the snapshots in the ring buffer from oldest to newest
+    def get_history(self):
+        if self.snapshots is None:
+            return []
+        return self.snapshots.get_history()
+
+    #True if the controller's average temperature has been within tolerance of the setpoint for the last stability_window seconds
+    #and is not drifting by more than max_slope (C/s, defaults to a drift of one tolerance over the window)
+    #Only looks at the poller's ring buffer so it never touches the port and is cheap enough to call every frame
+    def is_settled(self, controller_number, setpoint, tolerance, stability_window, max_slope = None):
+        if max_slope is None:
+            max_slope = tolerance / stability_window
+        history = self.get_history()
+        if len(history) < 2:
+            return False
+        newest = history[-1].timestamp
+        #Need at least a full window of data
+        if newest - history[0].timestamp < stability_window:
+            return False
+        timestamps = []
+        averages = []
+        for snapshot in reversed(history):
+            if newest - snapshot.timestamp > stability_window:
+                break
+            try:
+                average = float(snapshot.averages[controller_number-1])
+            except (TypeError, ValueError):
+                return False
+            if abs(average - setpoint) > tolerance:
+                return False
+            timestamps.append(snapshot.timestamp)
+            averages.append(average)
+        if len(averages) < 2:
+            return False
+        #Least squares slope of the window
+        mean_t = sum(timestamps) / len(timestamps)
+        mean_a = sum(averages) / len(averages)
+        spread = sum((t - mean_t)**2 for t in timestamps)
+        if spread == 0:
+            return False
+        slope = sum((t - mean_t) * (a - mean_a) for t, a in zip(timestamps, averages)) / spread
+        return abs(slope) <= max_slope
+
+    #Block until is_settled is true, checking every time the poller takes a new snapshot
+    #If the poller is not running it is started for the wait and stopped again before returning
+    #Returns True once settled, False if timeout seconds pass or stop_event is set
+    #Run it in its own thread (or use is_settled as an end trigger) to keep acquiring while waiting
+    def wait_until_settled(self, controller_number, setpoint, tolerance, stability_window, max_slope = None, timeout = None, stop_event:threading.Event = None):
+        started_polling = self.poll_thread is None
+        if started_polling:
+            self.start_polling()
+        try:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            seen = 0
+            while stop_event is None or not stop_event.is_set():
+                if self.is_settled(controller_number, setpoint, tolerance, stability_window, max_slope):
+                    return True
+                wait = self.poll_period * 2
+                if deadline is not None:
+                    wait = min(wait, deadline - time.monotonic())
+                    if wait <= 0:
+                        return False
+                seen = self.snapshots.wait_for_new(seen, wait)
+            return False
+        finally:
+            if started_polling:
+                self.stop_polling()
+
+    #Temperature history of a controller from the ring buffer as two lists (timestamps, averages)
+    def get_temperature_history(self, controller_number):
+        history = self.get_history()
+        timestamps = [snapshot.timestamp for snapshot in history]
+        averages = [snapshot.averages[controller_number-1] for snapshot in history]
+        return timestamps, averages
 
 
 
@@ -794,20 +1355,9 @@ if __name__ == "__main__":
         #Test the Controller
         for controller in lfdi.Controllers:
             print(f"Testing Controller {controller.number}")
-            print(f"Setting Controller {controller.number} PID to 1,1,1")
-            lfdi.set_controller_kp(controller.number, 1)
-            lfdi.set_controller_ki(controller.number, 1)
-            lfdi.set_controller_kd(controller.number, 1)
-            print(f"Setting Controller {controller.number} Setpoint to 30 (light on)")
-            lfdi.set_controller_setpoint(controller.number, 30)
-            print(f"Setting Controller {controller.number} Frequency to 200")
-            lfdi.set_controller_frequency(controller.number,200)
-            print(f"Setting Controller {controller.number} History to 26")
-            lfdi.set_controller_hist(controller.number,26)
-            print(f"Setting Controller {controller.number} i2c to 0")
-            lfdi.set_controller_i2c(controller.number,0)
-            print(f"Enabling Controller {controller.number} Heater Light Should be on")
-            lfdi.set_controller_enable(controller.number,True)
+            print(f"Setting Controller {controller.number} PID to 1,1,1, Setpoint to 30, Frequency to 200, History to 26, i2c to 0 and Enabling it (light on)")
+            lfdi.apply_config(controllers={controller.number: {"kp": 1, "ki": 1, "kd": 1, "setpoint": 30, "frequency": 200,
+                                                               "hist": 26, "i2c": 0, "enable": True}})
             print(f"Getting Controller {controller.number} Info and Writing to File Test.tsv")
             file = open('Test.tsv', "a")
             file.write(f"{lfdi.get_info()}\n")
@@ -833,14 +1383,9 @@ if __name__ == "__main__":
 
         for compensator in lfdi.Compensators:
             print(f"Testing Compensator {compensator.number}")
-            print(f"Setting Compensator {compensator.number} I2C to 00")
-            lfdi.set_compensator_i2c(compensator.number,00) #Set the i2c address of the sensor
-            print(f"Setting Compensator {compensator.number} Voltage to 10")
-            lfdi.set_compensator_voltage(compensator.number,10) #Set the voltage peak to peak of the compensator
-            print(f"Setting Compensator {compensator.number} Wavelength to 100")
-            lfdi.set_compensator_wavelength(compensator.number,100) #Set the wavelength of the compensator
-            print(f"Enabling Compensator {compensator.number}")
-            lfdi.set_compensator_enable(compensator.number, True) #Enable the compensator
+            print(f"Setting Compensator {compensator.number} I2C to 00, Voltage to 10, Wavelength to 100 and Enabling it")
+            #i2c address of the sensor, peak to peak voltage and wavelength of the compensator
+            lfdi.apply_config(compensators={compensator.number: {"i2c": 0, "voltage": 10, "wavelength": 100, "enable": True}})
             file = open('Test.tsv', "a") #Open the file
             file.write(f"{lfdi.get_info()}\n") #Write the data to the file
             file.close() #Close the file
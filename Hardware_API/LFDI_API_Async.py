@@ -0,0 +1,382 @@
+#asyncio version of LFDI_TCB
+#Commands are put on a queue, written to the TCB back to back and matched to their responses as they stream back
+#This lets the experiment loop, the web status page and a logger share one port without any of them blocking a thread
+#
+#Example:
+#   tcb = LFDI_TCB_Async("COM6")
+#   await tcb.connect()
+#   await tcb.set_controller_setpoint(1, 25)
+#   print(await tcb.get_info())
+#   await tcb.close()
+#
+#A response only ends at the prompt the TCB prints after it, so commands are only pipelined once we have seen the prompt.
+#Until then (or on a TCB that never prints one) commands go one at a time and a response ends when the port goes quiet
+#Timeouts count from when a command gets to the front of the read queue, not from when it was written, so commands
+#queued behind a slow raw dump still get their full timeout
+import asyncio
+import collections
+import time
+import serial_asyncio
+try:
+    from Hardware_API.LFDI_API import TCB_Data, TCB_Desync_Error
+except:
+    from LFDI_API import TCB_Data, TCB_Desync_Error
+
+
+#A command waiting on the queue or waiting for its response
+class Pending_Command(object):
+
+    def __init__(self, command, expected_response = None, timeout = 1, quiet_time = 0.05):
+        self.command = command
+        self.expected_response = expected_response
+        self.timeout = timeout
+        self.quiet_time = quiet_time
+        self.future = asyncio.get_running_loop().create_future()
+        self.sent_at = None
+        self.started_at = None #When it got to the front of the read queue
+        self.deadline = None
+        return
+
+    #Finish the command with whatever response we have
+    def complete(self, response):
+        if not self.future.done():
+            self.future.set_result(response)
+        return
+
+
+#Reader and writer for a pyserial like port (ie the Virtual_TCB) with the parts of the asyncio streams we use
+class Serial_Stream(object):
+
+    def __init__(self, port, poll_interval = 0.001):
+        self.port = port
+        self.poll_interval = poll_interval
+        return
+
+    async def read(self, size):
+        while True:
+            waiting = self.port.in_waiting
+            if waiting:
+                return self.port.read(min(waiting, size))
+            await asyncio.sleep(self.poll_interval)
+
+    def write(self, data):
+        self.port.write(data)
+        return
+
+    async def drain(self):
+        return
+
+    def close(self):
+        self.port.close()
+        return
+
+
+class LFDI_TCB_Async(TCB_Data):
+
+    def __init__(self, com_port, baud_rate = 9600, silent = False, max_in_flight = 4):
+        TCB_Data.__init__(self)
+        self.com_port = com_port
+        self.baud_rate = baud_rate
+        self.silent = silent
+        self.max_in_flight = max_in_flight #How many commands can be written before their responses come back
+        #Same read timing as LFDI_TCB
+        self.prompt = ">"
+        self.command_timeout = 1
+        self.raw_data_timeout = 3
+        self.quiet_time = 0.05
+        self.raw_data_quiet_time = 0.25
+        self.poll_interval = 0.01
+        #Cached menu state of the TCB. This is where the TCB will be once everything on the queue has run
+        self.current_context = "main"
+        self.selected_channel = None
+        self.valid_contexts = ["main", "controller", "compensator"]
+        self.prompt_seen = False
+        self.auto_toggled_at = None #time.time() the last comp went out, the auto state in the dump before it is stale
+        self.reader = None
+        self.writer = None
+        self.tasks = []
+        return
+
+    #Open the port and start the reader and writer tasks
+    #A Virtual_TCB from TCB_Simulator can be passed in place of the com port name
+    async def connect(self):
+        if isinstance(self.com_port, str):
+            self.reader, self.writer = await serial_asyncio.open_serial_connection(url = self.com_port, baudrate = self.baud_rate)
+        else:
+            self.com_port.open()
+            self.reader = self.writer = Serial_Stream(self.com_port)
+        self.queue = asyncio.Queue()
+        self.in_flight = collections.deque()
+        self.slots = asyncio.Semaphore(self.max_in_flight)
+        self.idle = asyncio.Event() #Set when nothing is waiting on a response
+        self.idle.set()
+        self.sequence_lock = asyncio.Lock() #Keeps one coroutine's menu changes and command together on the queue
+        self.toggle_lock = asyncio.Lock() #One auto toggle at a time so each one knows the state it started from
+        self.rx_buffer = ""
+        self.last_rx = None
+        self.tasks = [asyncio.ensure_future(self._write_loop()), asyncio.ensure_future(self._read_loop())]
+        #The TCB could have been left in any menu so start from a known state
+        await self.resync()
+        return
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        if self.writer is not None:
+            self.writer.close()
+        self.writer = None
+        return
+
+    #Takes commands off the queue and writes them to the TCB
+    async def _write_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = await self.queue.get()
+            await self.slots.acquire()
+            #Without the prompt there is no way to tell where one response ends and the next starts so go one at a time
+            if not self.prompt_seen:
+                await self.idle.wait()
+            if not self.silent:
+                print(f"{pending.command}")
+            pending.sent_at = loop.time()
+            self.in_flight.append(pending)
+            self.idle.clear()
+            self.writer.write(f"{pending.command}\r".encode('utf-8'))
+            await self.writer.drain()
+
+    #Reads everything the TCB sends and hands it out to the commands waiting on it in order
+    async def _read_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                data = await asyncio.wait_for(self.reader.read(1024), self.poll_interval)
+            except asyncio.TimeoutError:
+                data = b""
+            now = loop.time()
+            if data:
+                self.rx_buffer += data.decode('utf-8', errors = 'ignore')
+                self.last_rx = now
+            self._match_responses(now)
+
+    #Finish as many of the in flight commands as we can with what is in the receive buffer
+    def _match_responses(self, now):
+        while len(self.in_flight) > 0:
+            pending = self.in_flight[0]
+            #The timeout starts once everything ahead of it has come back
+            if pending.started_at is None:
+                pending.started_at = max(now, pending.sent_at)
+                pending.deadline = pending.started_at + pending.timeout
+            end = self._response_end(pending, now)
+            if end is None:
+                return
+            response = self.rx_buffer[:end]
+            self.rx_buffer = self.rx_buffer[end:]
+            self.in_flight.popleft()
+            self.slots.release()
+            if len(self.in_flight) == 0:
+                self.idle.set()
+            pending.complete(response)
+        return
+
+    #Find where the response for the command at the front ends in the receive buffer or None if it is not done yet
+    def _response_end(self, pending, now):
+        rx = self.rx_buffer
+        #The Prompt means the TCB is done with this command. Nothing else can end a response once we know it prints one
+        #or the prompt that comes in later would finish the next command with this one's tail
+        prompt_index = rx.find(self.prompt) if self.prompt is not None else -1
+        if prompt_index != -1:
+            self.prompt_seen = True
+            return prompt_index + len(self.prompt)
+        #No prompt seen yet so only one command is in flight. It is done once its response is in and the port goes quiet
+        if not self.prompt_seen and rx != "" and self.last_rx is not None and now - max(self.last_rx, pending.started_at) > pending.quiet_time:
+            if pending.expected_response is None:
+                return len(rx)
+            index = rx.find(pending.expected_response)
+            if index != -1 and rx.find("\n", index) != -1:
+                return len(rx)
+        #Nothing complete came back, there is no prompt in what is left so it can't hold a later command's response
+        if now > pending.deadline:
+            return len(rx)
+        return None
+
+    #Put a command on the queue. Returns the Pending_Command, await its future for the response
+    def enqueue(self, command, expected_response = None, timeout = None, quiet_time = None):
+        if timeout is None:
+            timeout = self.command_timeout
+        if quiet_time is None:
+            quiet_time = self.quiet_time
+        pending = Pending_Command(command, expected_response, timeout, quiet_time)
+        self.queue.put_nowait(pending)
+        return pending
+
+    #Send a single command and wait for its response
+    async def send_command(self, command, expected_response = None, timeout = None, quiet_time = None):
+        async with self.sequence_lock:
+            pending = self.enqueue(command, expected_response, timeout, quiet_time)
+        return await pending.future
+
+    #The menu changes needed to get from the cached menu state to the context and channel. Updates the cache
+    def plan_context(self, context:str, number = None):
+        commands = []
+        if context != self.current_context:
+            if self.current_context != "main":
+                commands.append("m")
+            if context != "main":
+                commands.append(context)
+            self.current_context = context
+            self.selected_channel = None
+        if number is not None and self.selected_channel != number:
+            commands.append(f"c{number}")
+            self.selected_channel = number
+        return commands
+
+    #Queue the menu changes and the command together so nothing from another coroutine ends up in between
+    def _enqueue_in_context(self, context, number, command, expected_response, timeout = None, quiet_time = None):
+        for menu_command in self.plan_context(context, number):
+            self.enqueue(menu_command)
+        return self.enqueue(command, expected_response, timeout, quiet_time)
+
+    #Forget the cached menu state and put the TCB back in the main menu
+    async def resync(self):
+        async with self.sequence_lock:
+            self.current_context = "main"
+            self.selected_channel = None
+            pending = self.enqueue("m")
+        return await pending.future
+
+    #Send a command to a single Controller or Compensator
+    #If the expected response never comes back the cached menu state is probably wrong so resync and try once more
+    #retry: False for commands that change state every time they are sent (comp). After the resync TCB_Desync_Error is
+    #raised without sending it again since the board may have run it, the caller has to read the state back
+    async def send_channel_command(self, context:str, number:int, command, expected_response = None, retry = True):
+        async with self.sequence_lock:
+            pending = self._enqueue_in_context(context, number, command, expected_response)
+        r = await pending.future
+        if expected_response is not None and expected_response not in r:
+            print(f"Expected response: {expected_response} not Response: {r}\nLost track of the TCB menu resyncing")
+            await self.resync()
+            if not retry:
+                raise TCB_Desync_Error(command, expected_response, r)
+            async with self.sequence_lock:
+                pending = self._enqueue_in_context(context, number, command, expected_response)
+            r = await pending.future
+            if expected_response not in r:
+                #We have no idea what menu the TCB is in so the next command starts from main
+                self.current_context = None
+                self.selected_channel = None
+                raise TCB_Desync_Error(command, expected_response, r)
+        return r
+
+    #set the Controller kp
+    async def set_controller_kp(self, controller_number, kp):
+        controller = self.Controllers[controller_number-1]
+        return await self.send_channel_command("controller", controller_number, controller.get_kp_command(kp), controller.get_kp_response())
+
+    #set the Controller ki
+    async def set_controller_ki(self, controller_number, ki):
+        controller = self.Controllers[controller_number-1]
+        return await self.send_channel_command("controller", controller_number, controller.get_ki_command(ki), controller.get_ki_response())
+
+    #set the Controller kd
+    async def set_controller_kd(self, controller_number, kd):
+        controller = self.Controllers[controller_number-1]
+        return await self.send_channel_command("controller", controller_number, controller.get_kd_command(kd), controller.get_kd_response())
+
+    #set the Controller hist
+    async def set_controller_hist(self, controller_number, hist):
+        controller = self.Controllers[controller_number-1]
+        return await self.send_channel_command("controller", controller_number, controller.get_hist_command(hist), controller.get_hist_response())
+
+    #set the Controller frequency
+    async def set_controller_frequency(self, controller_number, frequency):
+        controller = self.Controllers[controller_number-1]
+        return await self.send_channel_command("controller", controller_number, controller.get_frequency_command(frequency), controller.get_frequency_response())
+
+    #set the Controller setpoint
+    async def set_controller_setpoint(self, controller_number, setpoint):
+        controller = self.Controllers[controller_number-1]
+        return await self.send_channel_command("controller", controller_number, controller.get_setpoint_command(setpoint), controller.get_setpoint_response())
+
+    #set the Controller i2c address
+    async def set_controller_i2c(self, controller_number, i2c):
+        controller = self.Controllers[controller_number-1]
+        return await self.send_channel_command("controller", controller_number, controller.get_i2c_command(i2c), controller.get_i2c_response())
+
+    #Set the Controller enable
+    async def set_controller_enable(self, controller_number, enable:bool):
+        controller = self.Controllers[controller_number-1]
+        return await self.send_channel_command("controller", controller_number, controller.get_enable_command(enable), controller.get_enable_response(enable))
+
+    #comp flips auto compensation so it is never sent again blindly. If its response is lost the auto state is read back
+    #after the resync and comp only goes out again if the state did not flip (same as LFDI_TCB.send_auto_toggle)
+    async def send_auto_toggle(self, compensator_number):
+        compensator = self.Compensators[compensator_number-1]
+        command = compensator.get_auto_command()
+        expected_response = compensator.get_auto_response()
+        async with self.toggle_lock:
+            #Need the state from before the toggle to tell if it went through
+            if self.last_update is None or (self.auto_toggled_at is not None and self.last_update < self.auto_toggled_at):
+                await self.update_data()
+            before = compensator.auto
+            try:
+                r = await self.send_channel_command("compensator", compensator_number, command, expected_response, retry = False)
+            except TCB_Desync_Error as e:
+                await self.update_data()
+                if compensator.auto != before:
+                    print(f"Compensator {compensator_number} auto compensation toggled, its response was lost")
+                    r = e.response
+                else:
+                    print(f"Compensator {compensator_number} auto compensation did not toggle, sending {command} again")
+                    r = await self.send_channel_command("compensator", compensator_number, command, expected_response, retry = False)
+            self.auto_toggled_at = time.time()
+        return r
+
+    #set the Compensator Auto
+    async def set_compensator_auto(self, compensator_number):
+        return await self.send_auto_toggle(compensator_number)
+
+    #Set the Compensator compensate
+    async def toggle_compensator_auto(self, compensator_number):
+        return await self.set_compensator_auto(compensator_number)
+
+    #set the Compensator Voltage
+    async def set_compensator_voltage(self, compensator_number, voltage):
+        compensator = self.Compensators[compensator_number-1]
+        return await self.send_channel_command("compensator", compensator_number, compensator.get_voltage_command(voltage), compensator.get_voltage_response())
+
+    #set the Compensator Wavelength
+    async def set_compensator_wavelength(self, compensator_number, wavelength):
+        compensator = self.Compensators[compensator_number-1]
+        return await self.send_channel_command("compensator", compensator_number, compensator.get_wavelength_command(wavelength), compensator.get_wavelength_response())
+
+    #set the Compensator i2c address
+    async def set_compensator_i2c(self, compensator_number, i2c):
+        compensator = self.Compensators[compensator_number-1]
+        return await self.send_channel_command("compensator", compensator_number, compensator.get_i2c_command(i2c), compensator.get_i2c_response())
+
+    #set the Compensator enable
+    async def set_compensator_enable(self, compensator_number, enable:bool):
+        if not enable:
+            await self.set_compensator_voltage(compensator_number, 0)
+        compensator = self.Compensators[compensator_number-1]
+        return await self.send_channel_command("compensator", compensator_number, compensator.get_enable_command(enable), compensator.get_enable_response(enable))
+
+    #Request the Raw Data from the TCB
+    async def read_raw_data(self):
+        async with self.sequence_lock:
+            for menu_command in self.plan_context("main"):
+                self.enqueue(menu_command)
+            pending = self.enqueue("r", timeout = self.raw_data_timeout, quiet_time = self.raw_data_quiet_time)
+        return await pending.future
+
+    #get the data from the TCB
+    async def update_data(self):
+        raw_data = await self.read_raw_data()
+        self.parse_raw_data(raw_data)
+        return
+
+    #return a crap ton of info in string format
+    async def get_info(self):
+        await self.update_data()
+        return self.format_info()
@@ -0,0 +1,157 @@
+#Live view of the spectrometer output
+#One figure is made and kept. Each update only swaps the data in the existing image and line and blits them
+#instead of clearing the axes and drawing everything again. The image is decimated before it is shown and
+#renders are rate limited so capture can run faster than the screen
+#
+#Example:
+#   view = Live_View(decimation=4, refresh_interval=0.5)
+#   while view.is_open():
+#       image = spectrometer.take_image()
+#       view.update(image, spectrometer.get_image_crosssection(image))
+import time
+import numpy as np
+import matplotlib.pyplot as plt
+
+
+class Live_View:
+    #decimation: show every nth pixel of the image
+    #refresh_interval: shortest time between renders (s). Frames that come in faster are not drawn
+    #crosssection_row: row the cross section is taken from (None for the middle)
+    def __init__(self, decimation=4, refresh_interval=0.5, crosssection_row=None):
+        self.decimation = max(1, int(decimation))
+        self.refresh_interval = refresh_interval
+        self.crosssection_row = crosssection_row
+        self.last_render = 0
+        self.frames_drawn = 0
+        self.frames_skipped = 0
+        self.background = None
+        self.image_shape = None
+        plt.ion()
+        self.fig = plt.figure()
+        #Create 2 Subplots in the figure with 1 row and 2 columns
+        self.ax = self.fig.add_subplot(1, 2, 1)
+        self.ax2 = self.fig.add_subplot(1, 2, 2)
+        self.label_axes()
+        #The artists are made on the first frame once we know the image size
+        self.image_artist = None
+        self.row_marker = None
+        self.line = None
+        self.peak_marker = None
+        self.fig.canvas.mpl_connect('draw_event', self.on_draw)
+        self.fig.canvas.mpl_connect('resize_event', self.on_resize)
+        return
+
+    def label_axes(self):
+        self.ax.set_title('Spectrometer Output')
+        self.ax.set_xlabel('Pixel X')
+        self.ax.set_ylabel('Pixel Y')
+        self.ax2.set_title('Cross Section')
+        self.ax2.set_xlabel('Pixel X')
+        self.ax2.set_ylabel('Intensity')
+        return
+
+    def is_open(self):
+        return plt.fignum_exists(self.fig.number)
+
+    #Set up the artists for an image of this size
+    def create_artists(self, image, crosssection):
+        self.image_shape = image.shape
+        height, width = image.shape[:2]
+        row = height / 2 if self.crosssection_row is None else self.crosssection_row
+        #extent keeps the axes in full resolution pixels even though fewer are drawn
+        self.image_artist = self.ax.imshow(self.decimate(image), extent=(0, width, height, 0), animated=True)
+        self.row_marker = self.ax.axhline(row, color='r', linestyle='-', animated=True)
+        self.line, = self.ax2.plot(np.arange(len(crosssection)), crosssection, animated=True)
+        self.peak_marker = self.ax2.axvline(np.argmax(crosssection), color='r', animated=True)
+        self.ax2.set_xlim(0, len(crosssection))
+        self.set_intensity_limits(crosssection)
+        self.fig.canvas.draw()
+        return
+
+    def decimate(self, image):
+        return image[::self.decimation, ::self.decimation]
+
+    def set_intensity_limits(self, crosssection):
+        low = float(np.min(crosssection))
+        high = float(np.max(crosssection))
+        margin = max((high - low) * 0.1, 1)
+        self.ax2.set_ylim(low - margin, high + margin)
+        return
+
+    #The background without the animated artists is saved after every full draw
+    def on_draw(self, event):
+        if self.image_artist is None:
+            return
+        self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        self.draw_artists()
+        return
+
+    def on_resize(self, event):
+        self.background = None
+        return
+
+    def draw_artists(self):
+        self.ax.draw_artist(self.image_artist)
+        self.ax.draw_artist(self.row_marker)
+        self.ax2.draw_artist(self.line)
+        self.ax2.draw_artist(self.peak_marker)
+        return
+
+    #Show a frame. Skipped if the last render was less than refresh_interval ago unless force is set
+    #row: row of the cross section in this image if it moved (ie switching between band and full frames)
+    #Returns True if it was drawn
+    def update(self, image, crosssection, force=False, row=None):
+        now = time.monotonic()
+        if not force and now - self.last_render < self.refresh_interval:
+            self.frames_skipped += 1
+            return False
+        self.last_render = now
+        if self.image_artist is None or image.shape != self.image_shape or len(crosssection) != len(self.line.get_xdata()):
+            if self.image_artist is not None:
+                self.ax.clear()
+                self.ax2.clear()
+                self.label_axes()
+            self.create_artists(image, crosssection)
+        if row is not None:
+            self.crosssection_row = row
+            self.row_marker.set_ydata([row, row])
+        shown = self.decimate(image)
+        self.image_artist.set_data(shown)
+        self.image_artist.set_clim(float(np.min(shown)), float(np.max(shown)))
+        self.line.set_ydata(crosssection)
+        peak = np.argmax(crosssection)
+        self.peak_marker.set_xdata([peak, peak])
+        #The axes have to be redrawn if the cross section no longer fits
+        low, high = self.ax2.get_ylim()
+        if np.min(crosssection) < low or np.max(crosssection) > high:
+            self.set_intensity_limits(crosssection)
+            self.background = None
+        if self.background is None or not getattr(self.fig.canvas, 'supports_blit', True):
+            self.fig.canvas.draw()
+        else:
+            self.fig.canvas.restore_region(self.background)
+            self.draw_artists()
+            self.fig.canvas.blit(self.fig.bbox)
+        self.fig.canvas.flush_events()
+        self.frames_drawn += 1
+        return True
+
+    #Let the window handle events (moving, resizing, closing) between frames
+    def flush_events(self):
+        self.fig.canvas.flush_events()
+        return
+
+    #Animated artists are left out of a normal draw so they are switched back on while saving
+    def save(self, filename):
+        artists = [artist for artist in (self.image_artist, self.row_marker, self.line, self.peak_marker) if artist is not None]
+        for artist in artists:
+            artist.set_animated(False)
+        self.fig.savefig(filename)
+        for artist in artists:
+            artist.set_animated(True)
+        self.background = None
+        return
+
+    def close(self):
+        plt.close(self.fig)
+        return
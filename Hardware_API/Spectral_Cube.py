@@ -0,0 +1,232 @@
+#Append only container for the spectra of a run
+#Replaces a PNG per frame with the metadata only in the filename. Every frame is one fixed width record holding its
+#metadata and its pixels so the file can be memory mapped and any frame or the whole metadata table read by index
+#without decoding anything
+#
+#File Layout:
+#   8 bytes   magic "LFDICUB1"
+#   4 bytes   length of the schema (little endian uint32)
+#   schema    JSON with the frame shape and dtype, the metadata fields and the ROI of the first frame. Padded with spaces
+#             so the records are 64 byte aligned
+#   records   one per frame, written a chunk of frames at a time
+#
+#All the frames in a cube have the same shape, ie all bands or all full frames
+#
+#Example:
+#   cube = Cube_Writer("Spectra.cube")
+#   cube.append(image, "Hold_....png", voltage = 3, temperature = 25.1, exposure = 0.1)
+#   cube.close()
+#   schema, records = read_cube("Spectra.cube")
+#   plt.plot(records["voltage"])
+#   image = records["image"][10]
+import os
+import json
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+
+
+magic = b"LFDICUB1"
+alignment = 64
+name_length = 96
+
+#Metadata stored with every frame. Numbers that are not known are NaN (or -1 for the integers)
+metadata_fields = [("timestamp", "<f8"), ("setpoint", "<f8"), ("temperature", "<f8"), ("voltage", "<f8"),
+                   ("compensator", "<i4"), ("compensated", "u1"), ("wavelength", "<f8"), ("exposure", "<f8"), ("gain", "<f8"),
+                   ("start_x", "<i4"), ("start_y", "<i4"), ("bins", "<i4")]
+unknown = {"<f8": np.nan, "<i4": -1, "u1": 0}
+
+
+#The record layout is stored as a numpy dtype description so the cube can be read without this file
+#The name is the old PNG filename so Level2 can still get everything from it
+#Records are padded so every record (and every image) stays aligned
+def build_schema(image, roi=None):
+    fields = metadata_fields + [("name", f"S{name_length}"), ("image", image.dtype.str, list(image.shape))]
+    size = np.dtype([tuple(field) for field in fields]).itemsize
+    padding = (-size) % alignment
+    if padding:
+        fields.append(("padding", f"V{padding}"))
+    return {"version": 1, "shape": list(image.shape), "dtype": image.dtype.str, "metadata": metadata_fields, "roi": roi,
+            "descr": fields}
+
+
+def schema_dtype(schema):
+    return np.dtype([tuple(field) for field in schema["descr"]])
+
+
+def read_header(filename):
+    with open(filename, "rb") as f:
+        if f.read(len(magic)) != magic:
+            raise ValueError(f"{filename} is not a spectral cube")
+        length = struct.unpack("<I", f.read(4))[0]
+        schema = json.loads(f.read(length).decode('utf-8'))
+    return schema, len(magic) + 4 + length
+
+
+#Frames are copied into a chunk in memory and each full chunk is written by a background thread
+#Only whole chunks (and whatever is left at flush or close) reach the file so a crash loses at most one chunk
+class Cube_Writer(object):
+
+    #chunk_bytes: about how much is written at once, at least one frame
+    #max_pending: chunks waiting to be written before append waits for the disk
+    def __init__(self, filename, chunk_bytes = 32*1024*1024, max_pending = 4):
+        self.filename = filename
+        self.chunk_bytes = chunk_bytes
+        self.lock = threading.Lock()
+        self.disk = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = "Cube_Writer")
+        self.slots = threading.Semaphore(max_pending)
+        self.schema = None
+        self.dtype = None
+        self.chunk = None
+        self.filled = 0
+        self.count = 0
+        self.file = None
+        #Keep adding to an existing cube
+        if os.path.exists(filename) and os.path.getsize(filename) > 0:
+            self.schema, offset = read_header(filename)
+            self.dtype = schema_dtype(self.schema)
+            #Drop a partial record left by a crash so the records stay aligned
+            size = os.path.getsize(filename)
+            self.count = (size - offset) // self.dtype.itemsize
+            if offset + self.count * self.dtype.itemsize != size:
+                with open(filename, "r+b") as f:
+                    f.truncate(offset + self.count * self.dtype.itemsize)
+            self.open()
+        return
+
+    def __len__(self):
+        return self.count
+
+    #The layout comes from the first frame
+    def write_header(self, image, roi):
+        self.schema = build_schema(image, roi)
+        self.dtype = schema_dtype(self.schema)
+        header = json.dumps(self.schema).encode('utf-8')
+        padding = (-(len(magic) + 4 + len(header))) % alignment
+        header += b" " * padding
+        with open(self.filename, "wb") as f:
+            f.write(magic)
+            f.write(struct.pack("<I", len(header)))
+            f.write(header)
+        self.open()
+        return
+
+    def open(self):
+        self.file = open(self.filename, "ab")
+        self.chunk = np.zeros(max(1, self.chunk_bytes // self.dtype.itemsize), dtype = self.dtype)
+        self.filled = 0
+        return
+
+    #True if the image has the shape and type of the frames in the cube (or the cube is still empty)
+    def fits(self, image):
+        return self.schema is None or (list(image.shape) == self.schema["shape"] and image.dtype.str == self.schema["dtype"])
+
+    #Add a frame. name is the filename it would have had as a PNG, metadata are any of metadata_fields
+    #roi is the ROI geometry of the frame, its position is stored with the frame. Returns the index of the frame
+    def append(self, image, name = "", roi = None, **metadata):
+        with self.lock:
+            if self.schema is None:
+                self.write_header(image, roi)
+            if not self.fits(image):
+                raise ValueError(f"Frame is {image.shape} {image.dtype} the cube holds {tuple(self.schema['shape'])} {self.schema['dtype']}")
+            record = self.chunk[self.filled]
+            for field, dtype in metadata_fields:
+                record[field] = unknown[dtype]
+            if roi is not None:
+                record["start_x"] = roi["start_x"]
+                record["start_y"] = roi["start_y"]
+                record["bins"] = roi["bins"]
+            for field, value in metadata.items():
+                #Anything that did not parse (ie a voltage of "OFF") is left unknown
+                try:
+                    record[field] = value
+                except (TypeError, ValueError):
+                    pass
+            record["name"] = os.path.basename(name).encode('ascii', errors = 'replace')[:name_length]
+            record["image"] = image
+            self.filled += 1
+            index = self.count
+            self.count += 1
+            if self.filled == len(self.chunk):
+                self.write_chunk()
+        return index
+
+    #Hand the chunk to the disk thread and start a new one
+    def write_chunk(self):
+        if self.filled == 0:
+            return None
+        chunk = self.chunk[:self.filled]
+        self.chunk = np.zeros(len(self.chunk), dtype = self.dtype)
+        self.filled = 0
+        self.slots.acquire()
+        future = self.disk.submit(self._write, chunk)
+        future.add_done_callback(lambda future: self.slots.release())
+        return future
+
+    def _write(self, chunk):
+        try:
+            self.file.write(memoryview(chunk).cast('B'))
+            self.file.flush()
+        except Exception as e:
+            print(f"Could not write to {self.filename} {e}")
+            raise
+        return
+
+    #Write everything appended so far and wait until it is on disk
+    def flush(self):
+        with self.lock:
+            future = self.write_chunk()
+        if future is not None:
+            future.result()
+        return
+
+    def close(self):
+        if self.file is None:
+            return
+        self.flush()
+        self.disk.shutdown(wait = True)
+        self.file.close()
+        self.file = None
+        return
+
+
+#Memory map the records of a cube as a numpy structured array (nothing is copied)
+#records["image"][i] is frame i, records["voltage"] is the voltage of every frame
+def read_cube(filename):
+    schema, offset = read_header(filename)
+    dtype = schema_dtype(schema)
+    count = (os.path.getsize(filename) - offset) // dtype.itemsize
+    if count == 0:
+        return schema, np.zeros(0, dtype = dtype)
+    return schema, np.memmap(filename, dtype = dtype, mode = 'r', offset = offset, shape = (count,))
+
+
+#The metadata of every frame without the pixels as a normal array, {field: values}
+def read_metadata(filename):
+    schema, records = read_cube(filename)
+    table = {field: np.array(records[field]) for field, dtype in schema["metadata"]}
+    table["name"] = [name.decode('ascii') for name in records["name"]]
+    return table
+
+
+#Write every frame back out as a PNG with its old filename. Float frames (stacks, calibrated) are rounded to 16 bit
+def export_png(filename, folder):
+    schema, records = read_cube(filename)
+    for record in records:
+        image = record["image"]
+        if np.issubdtype(image.dtype, np.floating):
+            image = np.clip(np.rint(image), 0, 65535).astype(np.uint16)
+        Image.fromarray(np.ascontiguousarray(image)).save(os.path.join(folder, record["name"].decode('ascii')))
+    return
+
+
+if __name__ == "__main__":
+    #Unpack a cube into PNGs: python Spectral_Cube.py Spectra.cube [folder]
+    import sys
+    if len(sys.argv) < 2:
+        print("Usage: python Spectral_Cube.py <cube file> [folder]")
+        exit()
+    folder = sys.argv[2] if len(sys.argv) > 2 else os.path.dirname(os.path.abspath(sys.argv[1]))
+    export_png(sys.argv[1], folder)
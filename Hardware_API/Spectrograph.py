@@ -8,12 +8,27 @@
 
 try:
     import Hardware_API.ZWO as ZWO
+    import Hardware_API.Frame_Writer as Frame_Writer
+    import Hardware_API.Live_View as Live_View
+    import Hardware_API.Frame_Stack as Frame_Stack
+    import Hardware_API.Camera_Calibration as Camera_Calibration
+    import Hardware_API.Auto_Exposure as Auto_Exposure
+    import Hardware_API.Spectral_Cube as Spectral_Cube
+    import Hardware_API.Crosssection as Crosssection
 except:
     import ZWO
+    import Frame_Writer
+    import Live_View
+    import Frame_Stack
+    import Camera_Calibration
+    import Auto_Exposure
+    import Spectral_Cube
+    import Crosssection
 import matplotlib.pyplot as plt
 import numpy as np
 from PIL import Image
 import time
+import os
 from functools import partial
 import gc
 
@@ -34,38 +49,302 @@ class Spectrometer:
         self.current_image = '_temp_image.png'
         self.current_graph = '_temp_graph.png'
         self.current_crosssection = '_temp_crosssection.csv'
+        self.current_frame = None #The last image taken as a numpy array
+        #Writes images in the background so saving never holds up the next capture
+        self.writer = Frame_Writer.Frame_Writer()
+        #Live view used by continuous_output. Shows every nth pixel and redraws at most every live_view_refresh seconds
+        self.live_view = None
+        self.live_view_decimation = 4
+        self.live_view_refresh = 0.5
+        #Band capture only reads out band_rows rows around the cross section, see enable_band_capture
+        #64 rows covers crosssection_width and the 1% of the image width Level2 averages over
+        self.band_capture = False
+        self.band_rows = 64
+        self.band_roi = None
+        self.full_frame_every = 0
+        self.frames_since_full_frame = 0
+        self.current_roi = None #ROI geometry of current_frame
+        self.alignment_frame = None #The last full frame taken in band capture
+        #Stacking, see take_stack. current_variance is the variance of current_frame when it is a stack
+        self.stack_sigma = 3
+        self.current_stack = None
+        self.current_variance = None
+        #Dark and flat correction applied to every frame as it is taken, see load_calibration
+        self.calibration = None
+        self.current_calibration = None #What was corrected in current_frame
+        #current_frame before calibration and the level it saturates at. Calibrated frames are float so saturation is
+        #counted on this instead
+        self.current_raw = None
+        self.current_saturation = None
+        #Result of the last auto_expose, recorded with every frame taken at that exposure
+        self.auto_exposure = None
+        #Run container the frames go in instead of a PNG each, see start_cube
+        self.cube = None
+        #Band the last cross section came from with its saturation counts and noise (Crosssection.Band)
+        self.last_band = None
 
         return
     
-    #Takes an Image with the ZWO camera and saves it to the filename
-    def take_image(self, filename):
-        self.camera.capture(filename)
+    #Takes an Image with the ZWO camera and returns it as a numpy array
+    #The image is only encoded to disk if a filename is given
+    #In band capture every full_frame_every-th image (or any image with full_frame set) is a full frame for alignment
+    #calibrate applies the dark and flat if there is a calibration
+    def take_image(self, filename=None, full_frame=False, calibrate=True):
+        if self.band_capture and self.full_frame_every > 0 and self.frames_since_full_frame >= self.full_frame_every:
+            full_frame = True
+        if self.band_capture and full_frame:
+            self.camera.set_full_roi()
+            try:
+                image = self.camera.capture_array()
+                self.current_roi = self.camera.get_roi_geometry()
+            finally:
+                self.set_band_roi()
+            self.frames_since_full_frame = 1
+        else:
+            image = self.camera.capture_array()
+            self.current_roi = self.camera.get_roi_geometry()
+            self.frames_since_full_frame += 1
+        if calibrate:
+            image, self.current_calibration = self.calibrate_image(image, self.current_roi)
+        else:
+            self.current_raw = image
+            self.current_saturation = None
+            self.current_calibration = None
+        self.current_frame = image
+        if self.band_capture and full_frame:
+            self.alignment_frame = image
+        self.current_stack = None
+        self.current_variance = None
+        if filename is not None:
+            self.save_image(self.current_frame, filename)
+        return self.current_frame
+
+    #Co-add count images in memory and return the combined image (float32). Its variance is in current_variance
+    #method: 'mean', 'median' or 'sigma_clip' (see Frame_Stack)
+    #frames: a queue from camera.subscribe() to stack streamed frames instead of taking single images
+    #Full frames taken for alignment in band capture are not added. Returns None if the stream gave nothing within timeout
+    def take_stack(self, count, method='mean', frames=None, timeout=None):
+        stack = Frame_Stack.Frame_Stack(count, method, self.stack_sigma)
+        roi = None
+        saturation = None
+        while not stack.is_full():
+            if frames is not None:
+                frame = frames.get(timeout)
+                if frame is None:
+                    break
+                image, image_roi = frame.image, frame.roi
+            else:
+                image = self.take_image(calibrate=False)
+                image_roi = self.current_roi
+            if self.band_capture and image is self.alignment_frame:
+                continue
+            if len(stack) == 0:
+                roi = image_roi
+                saturation = Crosssection.saturation_level(image.dtype)
+            stack.add(image)
+        if len(stack) == 0:
+            return None
+        #The raw frames are stacked and the stack is calibrated once
+        #The stack is float already so it is calibrated in place, keep a copy to count saturation on
+        image, variance = stack.combine()
+        raw = image.copy() if self.calibration is not None else image
+        self.current_frame, self.current_calibration = self.calibrate_image(image, roi, raw, saturation)
+        if self.calibration is not None:
+            self.calibration.apply_variance(variance, roi)
+        self.current_variance = variance
+        self.current_roi = roi
+        self.current_stack = {"frames": len(stack), "method": method}
+        return self.current_frame
+
+    #Find the exposure that puts the cross section rows at target (fraction of full scale) without saturating them
+    #Only the band around the cross section is read out while it searches. Takes the raw frames so saturation is seen
+    #Any options for Auto_Exposure can be passed (tolerance, max_saturated, max_exposure, ...). Returns the exposure (s)
+    def auto_expose(self, target=0.6, **options):
+        controller = Auto_Exposure.Auto_Exposure(target, **options)
+        if self.camera.auto_exposure:
+            self.camera.set_auto_exposure(False)
+        band_capture = self.band_capture
+        if not band_capture:
+            self.set_band_roi()
+        exposure = self.camera.get_camera_exposure()
+        try:
+            while not controller.done:
+                image = self.camera.capture_array()
+                row = self.get_crosssection_row(image, self.camera.get_roi_geometry())
+                pixels = image[max(row-int(self.crosssection_width/2), 0):row+int(self.crosssection_width/2), :]
+                new_exposure = controller.update(exposure, pixels)
+                if new_exposure != exposure:
+                    exposure = new_exposure
+                    self.camera.set_exposure(exposure)
+        finally:
+            if not band_capture:
+                self.camera.set_full_roi()
+        print(f"Auto exposure {'settled' if controller.converged else 'stopped'} at {exposure}s after {controller.iterations} frames, "
+              f"level {controller.level:.2f} saturated {controller.saturated:.4f}")
+        self.auto_exposure = {"exposure": self.camera.get_exposure_us(), "target": target, "level": round(controller.level, 4),
+                              "saturated": float(controller.saturated), "converged": controller.converged, "frames": controller.iterations}
+        return exposure
+
+    #Load master darks and flats saved with Camera_Calibration.Calibration_Manager.save
+    def load_calibration(self, folder):
+        self.calibration = Camera_Calibration.Calibration_Manager().load(folder)
+        return self.calibration
+
+    #(frame - dark) / flat if there is a calibration. Returns (image, what was corrected or None)
+    #The frame from before calibration is kept in current_raw (raw if given) with the level it saturates at
+    #(saturation, from the frame's type if not given) so saturation can still be counted
+    def calibrate_image(self, image, roi, raw=None, saturation=None):
+        self.current_raw = image if raw is None else raw
+        self.current_saturation = saturation
+        if self.calibration is None:
+            return image, None
+        return self.calibration.apply(image, self.camera.get_control_values(), roi)
+
+    #The variance of a stack is written next to it as a .npy
+    def get_variance_filename(self, filename):
+        return os.path.splitext(filename)[0] + '_variance.npy'
+
+    #Only read out the rows around the cross section. rows defaults to band_rows
+    #full_frame_every: take a full frame every this many images to check the alignment (0 for never). The first image is a full frame
+    def enable_band_capture(self, rows=None, full_frame_every=0):
+        if rows is not None:
+            self.band_rows = rows
+        self.full_frame_every = full_frame_every
+        self.band_capture = True
+        self.set_band_roi()
+        self.frames_since_full_frame = full_frame_every
+        return self.band_roi
+
+    def disable_band_capture(self):
+        self.band_capture = False
+        self.camera.set_full_roi()
         return
-    
-    def plot_image(self, filename, axis, include_crosssection=True):
+
+    def set_band_roi(self):
+        full_height = self.camera.get_full_size()[1]
+        rows = max(self.band_rows, self.crosssection_width + 2)
+        self.band_roi = self.camera.set_band_roi(self.get_crosssection_center(full_height), rows)
+        return
+
+    #ROI geometry of an image. Only known for current_frame, anything else is assumed to be a full frame
+    def get_image_roi(self, image):
+        if image is self.current_frame:
+            return self.current_roi
+        return None
+
+    #Save an image that is already in memory
+    #roi: geometry the image was taken with, defaults to the one of current_frame
+    #The variance of a stack is saved with it
+    def save_image(self, image, filename, roi=None):
+        settings = self.get_frame_settings(image, roi)
+        if image is self.current_frame and self.current_variance is not None:
+            np.save(self.get_variance_filename(filename), self.current_variance)
+        self.camera.save_image(to_encodable(image, filename), filename, settings)
+        return
+
+    #Camera settings of an image. A stack also records how many frames went into it
+    def get_frame_settings(self, image, roi=None):
+        if roi is None:
+            roi = self.get_image_roi(image)
+        settings = self.camera.get_frame_settings(roi)
+        if image is self.current_frame and self.current_stack is not None:
+            settings['Stack'] = self.current_stack
+        if image is self.current_frame and self.current_calibration is not None:
+            settings['Calibration'] = self.current_calibration
+        #Only while the camera is still at the exposure auto_expose picked
+        if self.auto_exposure is not None and settings.get('Exposure') == self.auto_exposure["exposure"]:
+            settings['Auto_Exposure'] = self.auto_exposure
+        return settings
+
+    #Queue an image to be written in the background. The format comes from the extension (.png, .tif, .raw, .npy)
+    #The camera settings are logged now so they match the image. callback(filename, error) is called once it is on disk
+    #The variance of a stack is queued with it
+    def save_image_async(self, image, filename, callback=None, roi=None):
+        sidecar = None
+        if self.camera is not None:
+            settings = self.get_frame_settings(image, roi)
+            if self.camera.journal is not None:
+                self.camera.record_frame_settings(filename, settings)
+            elif self.camera.save_control_values_on:
+                sidecar = self.camera.format_control_values(settings)
+        if image is self.current_frame and self.current_variance is not None:
+            self.writer.write(self.current_variance, self.get_variance_filename(filename))
+        return self.writer.write(to_encodable(image, filename), filename, callback=callback, sidecar=sidecar)
+
+    #Put the frames of a run in one spectral cube file instead of a PNG each
+    def start_cube(self, filename):
+        self.stop_cube()
+        self.cube = Spectral_Cube.Cube_Writer(filename)
+        return self.cube
+
+    def stop_cube(self):
+        if self.cube is not None:
+            self.cube.close()
+        self.cube = None
+        return
+
+    #Append an image to the cube with its metadata (setpoint, temperature, voltage, compensator, ... see Spectral_Cube)
+    #name is the filename the image would have had as a PNG. The exposure, gain and ROI come from the camera settings
+    #which also go in the settings journal if there is one. Returns the index of the frame in the cube
+    def save_to_cube(self, image, name, roi=None, **metadata):
+        settings = self.get_frame_settings(image, roi)
+        if self.camera.journal is not None:
+            self.camera.record_frame_settings(name, settings)
+        metadata.setdefault("exposure", settings['Exposure'] / 1000000)
+        metadata.setdefault("gain", settings['Gain'])
+        return self.cube.append(image, name, settings['ROI'], **metadata)
+
+    #Images can be passed as an array or as the filename of a saved image
+    def load_image(self, image):
+        if isinstance(image, np.ndarray):
+            return image
+        return np.array(Image.open(image))
+
+    def plot_image(self, image, axis, include_crosssection=True):
         axis.set_title('Spectrometer Output')
         axis.set_xlabel('Pixel X')
         axis.set_ylabel('Pixel Y')
-        image = Image.open(filename)
-        image = np.array(image)
+        roi = self.get_image_roi(image)
+        image = self.load_image(image)
         axis.imshow(image)
         if include_crosssection:
-            if self.crosssection_position == 'middle':
-                axis.axhline(int(image.shape[0]/2), color='r', linestyle='-')
-            else:
-                axis.axhline(int(self.crosssection_position), color='r', linestyle='-')
+            axis.axhline(self.get_crosssection_row(image, roi), color='r', linestyle='-')
         return
     
+    #Row of the cross section on a full frame that is full_height rows tall
+    def get_crosssection_center(self, full_height):
+        if self.crosssection_position == 'middle':
+            return int(full_height/2)
+        return int(self.crosssection_position)
+
+    #Row of the cross section in the image. roi is the ROI geometry the image was taken with (None for a full frame)
+    def get_crosssection_row(self, image, roi=None):
+        if roi is None:
+            return self.get_crosssection_center(image.shape[0])
+        return self.get_crosssection_center(roi["full_height"]) - roi["start_y"]
 
     #This will get a 1D array of the intensity profile of the image across the horizontal access
-    def get_image_crosssection(self, filename):
-        image = Image.open(filename)
-        image = np.array(image)
-        if self.crosssection_position == 'middle':
-            crosssection = np.mean(image[int(image.shape[0]/2)-int(self.crosssection_width/2):int(image.shape[0]/2)+int(self.crosssection_width/2), :], axis=0)
-        else:
-            crosssection = np.mean(image[int(self.crosssection_position)-int(self.crosssection_width/2):int(self.crosssection_position)+int(self.crosssection_width/2), :], axis=0)
-        return crosssection
+    #roi: ROI geometry the image was taken with, defaults to the one of current_frame. Needed for band images
+    def get_image_crosssection(self, image, roi=None):
+        if roi is None:
+            roi = self.get_image_roi(image)
+        self.last_band = self.get_crosssection_bands(image, roi=roi)[0]
+        return self.last_band.mean
+
+    #Several bands centred on the cross section row taken in one pass, one for each width (defaults to crosssection_width)
+    #Returns a Crosssection.Band for each with the mean, saturated pixels per column and the noise of the mean
+    def get_crosssection_bands(self, image, widths=None, roi=None):
+        if roi is None:
+            roi = self.get_image_roi(image)
+        #Saturation is counted on the frame from before calibration
+        raw, saturation = None, None
+        if image is self.current_frame:
+            raw, saturation = self.current_raw, self.current_saturation
+        image = self.load_image(image)
+        if widths is None:
+            widths = [self.crosssection_width]
+        row = self.get_crosssection_row(image, roi)
+        return Crosssection.extract_bands(image, [Crosssection.centered_band(row, width) for width in widths], saturation, raw)
 
         
     #This will plot the cross section of the image
@@ -83,73 +362,122 @@ class Spectrometer:
         peak_position = np.argmax(crosssection)
         return peak_position
 
+    #The live view window. Kept between calls to continuous_output so the figure is only made once
+    def get_live_view(self):
+        if self.live_view is None or not self.live_view.is_open():
+            row = None if self.crosssection_position == 'middle' else int(self.crosssection_position)
+            self.live_view = Live_View.Live_View(self.live_view_decimation, self.live_view_refresh, row)
+        return self.live_view
+
     #Run Continuous Output of the Plot all images will be saved to the Temp Files names the refresh rate is in seconds and the end trigger is a function that returns a boolean 
-    def continuous_output(self, refresh_rate=5, end_trigger=None):
+    #on_frame is called with the cross section of every frame (ie to track the peak position)
+    #refresh_rate is the time between captures. The screen is only redrawn every live_view_refresh seconds
+    #stream uses the camera's video mode. The newest frame is used as soon as it arrives and refresh_rate is not used
+    #save_temp_files writes the last image, graph and cross section to the temp files when it ends. Turn it off if you
+    #save current_frame yourself with save_image_async
+    #headless skips the plot completely, frames are still captured and on_frame is still called
+    #stack co-adds this many images into every frame with stack_method (see take_stack)
+    def continuous_output(self, refresh_rate=5, end_trigger=None, on_frame=None, stream=False, save_temp_files=True, headless=False,
+                          stack=1, stack_method='mean'):
         print('Starting Continuous Output')
-        print('Close the plot to Continue')
+        if not headless:
+            print('Close the plot to Continue')
         if end_trigger is not None:
             print(f'Or End will be Trigger When The End Trigger Returns True')
-        plt.ion()
-        fig = plt.figure()
-        #Create 2 Subplots in the figure with 1 row and 2 columns and white space inbetween
-        ax = fig.add_subplot(1, 2, 1)
-        ax2 = fig.add_subplot(1, 2, 2)
+        live_view = None if headless else self.get_live_view()
 
         #While the user has the window open keep updating the image. The user should have the ability to increase or decrease the exposure time
+        #Frames stay in memory. Only the last one is written to the temp files when the loop ends
+        stream = stream and self.camera is not None
+        if stream:
+            started_stream = not self.camera.is_streaming()
+            self.camera.start_stream()
+            frames = self.camera.subscribe(size=stack, policy='drop_oldest')
+        image = None
         while True:
-            if self.camera is not None:
-                image_name = self.current_image
-                self.take_image(self.current_image)
+            if stream:
+                timeout = self.camera.camera.default_timeout / 1000
+                if stack > 1:
+                    #The stack holds the new frame and its ROI
+                    received = self.take_stack(stack, stack_method, frames, timeout) is not None
+                else:
+                    frame = frames.get_latest(timeout=timeout)
+                    received = frame is not None
+                    if received:
+                        self.current_frame, self.current_calibration = self.calibrate_image(frame.image, frame.roi)
+                        self.current_roi = frame.roi
+                        self.current_stack = None
+                        self.current_variance = None
+                if not received:
+                    print("No frame from the stream")
+                    if image is None:
+                        if end_trigger is not None and end_trigger():
+                            break
+                        continue
+                else:
+                    image = self.current_frame
+            elif self.camera is not None and stack > 1:
+                image = self.take_stack(stack, stack_method)
+            elif self.camera is not None:
+                image = self.take_image()
             else:
-                image_name = 'Test1.png'
-            #clear axis 1
-            ax.clear()
-            #clear axis 2
-            ax2.clear()
-           
-            #Update the plot
-            self.plot_image(image_name, ax)
-            crosssection = self.get_image_crosssection(image_name)
-            self.plot_crosssection(crosssection, ax2)
-            
-            #Update the Canvas
-            fig.canvas.draw()
-            fig.canvas.flush_events()
-            time.sleep(refresh_rate)
-
-            #Save the Plot
-            fig.savefig(self.current_graph)
-            #Save the one dimensional cross section
-            np.savetxt(self.current_crosssection, crosssection, delimiter=',')
+                image = self.load_image('Test1.png')
+
+            crosssection = self.get_image_crosssection(image)
+            if on_frame is not None:
+                on_frame(crosssection)
+            #Only drawn if the last draw was long enough ago
+            if live_view is not None:
+                live_view.update(image, crosssection, row=self.get_crosssection_row(image, self.get_image_roi(image)))
+            if not stream:
+                time.sleep(refresh_rate)
+
             #Exit the loop if the user closes the plot or if lthe end trigger is met
             if end_trigger is not None:
                 if end_trigger():
                     print("End Triggered")
-                    plt.close()
                     break
-            if not plt.fignum_exists(fig.number):
+            if live_view is not None and not live_view.is_open():
                 print("Figure Closed")
                 break
-        fig.clf()
+        if stream:
+            self.camera.unsubscribe(frames)
+            if started_stream:
+                self.camera.stop_stream()
+        #Save the last image, the Plot and the one dimensional cross section
+        if image is not None and save_temp_files:
+            if self.camera is not None:
+                self.save_image(image, self.current_image)
+            if live_view is not None and live_view.is_open():
+                live_view.update(image, crosssection, force=True, row=self.get_crosssection_row(image, self.get_image_roi(image)))
+                live_view.save(self.current_graph)
+            np.savetxt(self.current_crosssection, crosssection, delimiter=',')
         gc.collect()
         return
 
 
     #Get a Single Output and save the image, graph, and cross section
-    def single_output(self, image_name_prefix = None, show = False):
+    #stack co-adds this many images with stack_method, the image is saved with its variance
+    #The image is written to current_image in the background. Save the returned image with save_image_async to keep it
+    #under another name instead of renaming current_image, it may not be on disk yet
+    def single_output(self, image_name_prefix = None, show = False, stack = 1, stack_method = 'mean'):
         if image_name_prefix == None:
             image_fn = self.current_image
             graph_fn = self.current_graph
             crosssection_fn = self.current_crosssection
 
-        self.take_image(image_fn)
+        if stack > 1:
+            image = self.take_stack(stack, stack_method)
+        else:
+            image = self.take_image()
+        self.save_image_async(image, image_fn)
         if show:
             fig = plt.figure()
             ax = fig.add_subplot(1, 2, 1)
             ax2 = fig.add_subplot(1, 2, 2)
         
-            self.plot_image(image_fn, ax)
-            crosssection = self.get_image_crosssection(image_fn)
+            self.plot_image(image, ax)
+            crosssection = self.get_image_crosssection(image)
             self.plot_crosssection(crosssection, ax2)
             fig.savefig(graph_fn)
             np.savetxt(crosssection_fn, crosssection, delimiter=',')
@@ -157,13 +485,19 @@ class Spectrometer:
             plt.show()
             fig.clf()
         gc.collect()
-        return
+        return image
 
     #Enable auto exposure for the ZWO Camera
     def enable_auto_exposure(self, enable):
         self.camera.set_auto_exposure(enable)
         return
 
+#A stack is float. PNG can't hold that so it is rounded back to 16 bit, use .tif or .npy to keep the fractions
+def to_encodable(image, filename):
+    if np.issubdtype(image.dtype, np.floating) and filename.lower().endswith('.png'):
+        return np.clip(np.rint(image), 0, 65535).astype(np.uint16)
+    return image
+
 #A function that will return true 25 seconds after the entered time Just to test Functionality
 def end_trigger(start):
     if  time.time()> start + 25:
@@ -0,0 +1,151 @@
+#Drives several TCBs at once, one per optical stack
+#Each board gets its own LFDI_TCB and its own worker thread so a slow response on one board never holds up the others
+#
+#Example:
+#   manager = TCB_Manager({"Stack1": "COM3", "Stack2": "COM6"})
+#   manager.call_all("set_controller_setpoint", 1, 25)     #every board to 25C at the same time
+#   manager.call("Stack2", "set_compensator_voltage", 4, 3).result()
+#   manager.start_polling()
+#   for timestamp, snapshots in manager.telemetry_stream(interval = 5):
+#       print(timestamp, {name: snapshot.averages[0] for name, snapshot in snapshots.items()})
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import Hardware_API.LFDI_API as LFDI
+except:
+    import LFDI_API as LFDI
+
+
+class TCB_Manager(object):
+
+    #boards: {name: com port} the com port can also be a Virtual_TCB
+    def __init__(self, boards:dict, baud_rate = 9600, silent = True):
+        self.names = list(boards.keys())
+        self.workers = {name: ThreadPoolExecutor(max_workers = 1, thread_name_prefix = f"TCB_{name}") for name in self.names}
+        #Connect to all the boards at once
+        futures = {name: self.workers[name].submit(LFDI.LFDI_TCB, boards[name], baud_rate, silent) for name in self.names}
+        self.boards = {}
+        error = None
+        for name, future in futures.items():
+            try:
+                self.boards[name] = future.result()
+            except Exception as e:
+                print(f"Could not connect to TCB {name} on {boards[name]} {e}")
+                if error is None:
+                    error = e
+        #Don't leave the other boards open or the worker threads running if one of them failed
+        if error is not None:
+            for name, lfdi in self.boards.items():
+                try:
+                    lfdi.close()
+                except Exception as e:
+                    print(f"Could not close TCB {name} {e}")
+            self.boards = {}
+            for worker in self.workers.values():
+                worker.shutdown(wait = True)
+            raise error
+        return
+
+    def __getitem__(self, name):
+        return self.boards[name]
+
+    #Run an LFDI_TCB method on one board's worker. Returns a Future
+    def call(self, name, method:str, *args, **kwargs):
+        return self.workers[name].submit(getattr(self.boards[name], method), *args, **kwargs)
+
+    #Run an LFDI_TCB method on every board at the same time and wait for all of them
+    #Returns {name: result}. If a board fails the exception is returned in its place so the other boards still finish
+    def call_all(self, method:str, *args, **kwargs):
+        futures = {name: self.call(name, method, *args, **kwargs) for name in self.names}
+        return self.wait_all(futures)
+
+    #Run function(lfdi, name) on every board's worker at the same time, ie a whole sweep per board
+    def run_parallel(self, function, wait = True):
+        futures = {name: self.workers[name].submit(function, self.boards[name], name) for name in self.names}
+        if not wait:
+            return futures
+        return self.wait_all(futures)
+
+    def wait_all(self, futures:dict):
+        results = {}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                print(f"TCB {name} failed {e}")
+                results[name] = e
+        return results
+
+    #Start the background poller on every board
+    def start_polling(self, interval = 5, history = 720):
+        for lfdi in self.boards.values():
+            lfdi.start_polling(interval, history)
+        return
+
+    def stop_polling(self):
+        for lfdi in self.boards.values():
+            lfdi.stop_polling()
+        return
+
+    #Latest snapshot of every board {name: TCB_Snapshot or None}
+    def get_latest_snapshots(self):
+        return {name: lfdi.get_latest_snapshot() for name, lfdi in self.boards.items()}
+
+    #Merged telemetry of all the boards on a common clock. Yields (timestamp, {name: latest snapshot}) every interval seconds
+    #Each snapshot keeps its own timestamp so you can tell how old it is. Stops when stop_event is set
+    def telemetry_stream(self, interval = 5, stop_event:threading.Event = None):
+        next_tick = time.time()
+        while stop_event is None or not stop_event.is_set():
+            yield next_tick, self.get_latest_snapshots()
+            next_tick += interval
+            delay = next_tick - time.time()
+            if delay > 0:
+                if stop_event is not None:
+                    stop_event.wait(delay)
+                else:
+                    time.sleep(delay)
+            else:
+                #Fell behind so skip the ticks we missed
+                next_tick = time.time()
+        return
+
+    #The ring buffer history of every board resampled onto one time grid (interval seconds apart)
+    #Each grid point gets the newest snapshot at or before it (None if the board had not been polled yet)
+    #Returns (grid timestamps, {name: [snapshot per grid point]})
+    def get_aligned_history(self, interval = 1):
+        histories = {name: lfdi.get_history() for name, lfdi in self.boards.items()}
+        starts = [history[0].timestamp for history in histories.values() if len(history) > 0]
+        ends = [history[-1].timestamp for history in histories.values() if len(history) > 0]
+        if len(starts) == 0:
+            return [], {name: [] for name in self.names}
+        grid = []
+        t = min(starts)
+        while t <= max(ends):
+            grid.append(t)
+            t += interval
+        aligned = {}
+        for name, history in histories.items():
+            aligned[name] = []
+            index = 0
+            latest = None
+            for t in grid:
+                while index < len(history) and history[index].timestamp <= t:
+                    latest = history[index]
+                    index += 1
+                aligned[name].append(latest)
+        return grid, aligned
+
+    #Stop polling, disable everything and close all the ports
+    def close(self):
+        self.stop_polling()
+        for name in self.names:
+            self.workers[name].shutdown(wait = True)
+        #Disables every controller and compensator and closes the port
+        for name, lfdi in self.boards.items():
+            try:
+                lfdi.close()
+            except Exception as e:
+                print(f"Could not close TCB {name} {e}")
+        self.boards = {}
+        return
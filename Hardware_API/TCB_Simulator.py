@@ -0,0 +1,413 @@
+#Virtual Tuning Control Board
+#Stands in for the serial port so LFDI_TCB can be run, timed and tested away from the bench
+#
+#Example:
+#   board = Virtual_TCB(latency = 0.005, time_scale = 60)
+#   lfdi = LFDI_TCB(board)
+#   lfdi.set_controller_setpoint(1, 30)
+#
+#It emulates the main/controller/compensator menus, the c{n} channel select, the responses the Controller and Compensator
+#classes expect and the "r" raw data dump with the same headers parse_raw_data looks for.
+#Latency, baud rate, a simple thermal response and desyncs can all be configured
+import math
+import random
+import threading
+import time
+try:
+    from Hardware_API.LFDI_API import Controller, Compensator, GPIO, Bipolar
+except:
+    from LFDI_API import Controller, Compensator, GPIO, Bipolar
+
+
+#State of a simulated heater controller
+class Virtual_Controller(object):
+
+    def __init__(self, number, ambient):
+        self.number = number
+        self.kp = 1.0
+        self.ki = 0.0
+        self.kd = 0.0
+        self.setpoint = 25.0
+        self.enabled = False
+        self.i2c = 0
+        self.history = 26
+        self.frequency = 200
+        self.temp = ambient
+        self.average = ambient
+        self.effort = 0.0
+        self.error_p = 0.0
+        self.error_i = 0.0
+        self.error_d = 0.0
+        return
+
+
+#State of a simulated compensator
+class Virtual_Compensator(object):
+
+    def __init__(self, number):
+        self.number = number
+        self.voltage = 0.0
+        self.wave = 0.0
+        self.auto = False
+        self.enabled = False
+        self.i2c = 0
+        return
+
+
+class Virtual_TCB(object):
+
+    #latency: seconds from the end of a command to the start of its response
+    #baud_rate: how fast the response comes back in bits per second. None sends it all at once (USB)
+    #time_scale: how many simulated seconds pass per real second for the thermal model
+    #thermal_time_constant: seconds for the stack to get 63% of the way to the setpoint
+    #drop_probability: chance a response is never sent
+    #desync_probability: chance the board falls back to the main menu right before a command
+    #garble_probability: chance a character in a response gets corrupted
+    #prompt: printed after every response, None for no prompt
+    def __init__(self, latency = 0.002, baud_rate = None, time_scale = 1.0, ambient = 22.0, thermal_time_constant = 300.0,
+                 average_time_constant = 30.0, noise = 0.01, drop_probability = 0.0, desync_probability = 0.0,
+                 garble_probability = 0.0, prompt = ">", seed = None):
+        self.latency = latency
+        self.baud_rate = baud_rate
+        self.time_scale = time_scale
+        self.ambient = ambient
+        self.thermal_time_constant = thermal_time_constant
+        self.average_time_constant = average_time_constant
+        self.noise = noise
+        self.drop_probability = drop_probability
+        self.desync_probability = desync_probability
+        self.garble_probability = garble_probability
+        self.prompt = prompt
+        self.random = random.Random(seed)
+
+        #pyserial attributes LFDI_TCB sets
+        self.timeout = 1
+        self.write_timeout = 1
+        self.is_open = False
+
+        self.lock = threading.Lock()
+        self.input_buffer = ""
+        self.output = [] #[start time, data, bytes already read]
+        self.forced_desyncs = 0
+
+        #Counters for benchmarks and tests
+        self.commands_received = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.desyncs = 0
+        self.drops = 0
+
+        self.power_on()
+        return
+
+    #Everything back to how the board boots
+    def power_on(self):
+        self.context = "main"
+        self.selected = {"controller": 1, "compensator": 1}
+        self.controllers = [Virtual_Controller(n, self.ambient) for n in range(1, 4)]
+        self.compensators = [Virtual_Compensator(n) for n in range(1, 7)]
+        self.gpios = [False] * 5
+        self.bipolars = [[0, 0, 0, False], [0, 0, 0, False]]
+        self.last_update = time.monotonic()
+        return
+
+    #Make the next command land in the main menu no matter where the client thinks it is
+    def inject_desync(self, count = 1):
+        self.forced_desyncs += count
+        return
+
+    ##############################
+    # pyserial interface
+    ##############################
+    def open(self):
+        with self.lock:
+            self.is_open = True
+            self.input_buffer = ""
+            self.output = []
+        return
+
+    def close(self):
+        self.is_open = False
+        return
+
+    #Bytes that have arrived and not been read
+    @property
+    def in_waiting(self):
+        with self.lock:
+            now = time.monotonic()
+            return sum(self._available(chunk, now) - chunk[2] for chunk in self.output)
+
+    def write(self, data):
+        if not self.is_open:
+            raise IOError("Virtual TCB port is closed")
+        with self.lock:
+            self.bytes_received += len(data)
+            self.input_buffer += data.decode('utf-8', errors = 'ignore')
+            #Commands are terminated with a carriage return
+            while "\r" in self.input_buffer:
+                command, self.input_buffer = self.input_buffer.split("\r", 1)
+                self._handle_command(command.strip())
+        return len(data)
+
+    #Waits up to timeout for size bytes like pyserial does
+    def read(self, size = 1):
+        deadline = time.monotonic() + (self.timeout if self.timeout is not None else 0)
+        data = b""
+        while True:
+            data += self._take(size - len(data))
+            if len(data) >= size or time.monotonic() >= deadline:
+                return data
+            time.sleep(0.001)
+
+    def read_all(self):
+        return self._take(None)
+
+    def flushInput(self):
+        with self.lock:
+            now = time.monotonic()
+            for chunk in self.output:
+                chunk[2] = self._available(chunk, now)
+            self._drop_read_chunks()
+        return
+
+    def flushOutput(self):
+        return
+
+    def reset_input_buffer(self):
+        self.flushInput()
+        return
+
+    def reset_output_buffer(self):
+        return
+
+    #How many bytes of a response chunk have come over the wire by now
+    def _available(self, chunk, now):
+        start, data, read = chunk
+        if now < start:
+            return 0
+        if self.baud_rate is None:
+            return len(data)
+        #10 bits per byte with the start and stop bits
+        return min(len(data), int((now - start) * self.baud_rate / 10))
+
+    def _take(self, size):
+        with self.lock:
+            now = time.monotonic()
+            data = b""
+            for chunk in self.output:
+                count = self._available(chunk, now) - chunk[2]
+                if size is not None:
+                    count = min(count, size - len(data))
+                data += chunk[1][chunk[2]:chunk[2] + count]
+                chunk[2] += count
+                if size is not None and len(data) >= size:
+                    break
+            self._drop_read_chunks()
+            return data
+
+    def _drop_read_chunks(self):
+        while len(self.output) > 0 and self.output[0][2] >= len(self.output[0][1]):
+            self.output.pop(0)
+        return
+
+    #Queue a response. It starts coming back after the latency and after anything already queued
+    def _respond(self, text):
+        if self.random.random() < self.drop_probability:
+            self.drops += 1
+            return
+        if self.garble_probability > 0 and len(text) > 0 and self.random.random() < self.garble_probability:
+            index = self.random.randrange(len(text))
+            text = text[:index] + chr(self.random.randrange(33, 127)) + text[index+1:]
+        if self.prompt is not None:
+            text += self.prompt
+        data = text.encode('utf-8')
+        now = time.monotonic()
+        start = now + self.latency
+        if len(self.output) > 0:
+            last_start, last_data, last_read = self.output[-1]
+            if self.baud_rate is not None:
+                start = max(start, last_start + len(last_data) * 10 / self.baud_rate)
+            else:
+                start = max(start, last_start)
+        self.output.append([start, data, 0])
+        self.bytes_sent += len(data)
+        return
+
+    ##############################
+    # Menus
+    ##############################
+    def _handle_command(self, command):
+        self.commands_received += 1
+        if self.forced_desyncs > 0 or (self.desync_probability > 0 and self.random.random() < self.desync_probability):
+            self.forced_desyncs = max(0, self.forced_desyncs - 1)
+            self.desyncs += 1
+            self.context = "main"
+        self._update_thermal()
+        if command == "":
+            self._respond("\r\n")
+        elif command == "m":
+            self.context = "main"
+            self._respond("Main Menu\r\n")
+        elif self.context == "main":
+            self._handle_main(command)
+        elif self.context == "controller":
+            self._handle_controller(command)
+        else:
+            self._handle_compensator(command)
+        return
+
+    def _handle_main(self, command):
+        if command == "controller":
+            self.context = "controller"
+            self._respond("Controller Menu\r\n")
+        elif command == "compensator":
+            self.context = "compensator"
+            self._respond("Compensator Menu\r\n")
+        elif command == "r":
+            self._respond(self.raw_data())
+        elif command == "bounce":
+            self._respond("Rebooting\r\n")
+            self.power_on()
+        else:
+            self._respond(f"Unknown command {command}\r\n")
+        return
+
+    #Number after a command prefix ie "kp1.5" -> 1.5. None if it is not a number
+    def _argument(self, command, prefix):
+        try:
+            return float(command[len(prefix):])
+        except ValueError:
+            return None
+
+    def _select(self, command, count):
+        number = self._argument(command, "c")
+        if number is None or number != int(number) or number < 1 or number > count:
+            self._respond(f"Invalid channel {command[1:]}\r\n")
+            return
+        self.selected[self.context] = int(number)
+        self._respond(f"{self.context.capitalize()} {int(number)} selected\r\n")
+        return
+
+    def _handle_controller(self, command):
+        controller = self.controllers[self.selected["controller"] - 1]
+        #prefix, attribute, response
+        setters = [("kp", "kp", "kp set to"), ("ki", "ki", "ki set to"), ("kd", "kd", "kd set to"),
+                   ("tg", "setpoint", "Target temperature set to"), ("a", "i2c", "Sensor Address Set to"),
+                   ("h", "history", "History set to"), ("f", "frequency", "Frequency set to")]
+        if command.startswith("c") and command[1:].isdigit():
+            self._select(command, len(self.controllers))
+            return
+        if command == "e":
+            controller.enabled = True
+            self._respond("Controller enabled.\r\n")
+            return
+        if command == "d":
+            controller.enabled = False
+            self._respond("Controller disabled.\r\n")
+            return
+        for prefix, attribute, response in setters:
+            if command.startswith(prefix):
+                value = self._argument(command, prefix)
+                if value is None:
+                    break
+                setattr(controller, attribute, value)
+                self._respond(f"{response} {value}\r\n")
+                return
+        self._respond(f"Unknown command {command}\r\n")
+        return
+
+    def _handle_compensator(self, command):
+        compensator = self.compensators[self.selected["compensator"] - 1]
+        number = compensator.number
+        if command == "comp":
+            compensator.auto = not compensator.auto
+            self._respond(f"Compensator {number} Auto Compensating\r\n")
+            return
+        if command.startswith("c") and command[1:].isdigit():
+            self._select(command, len(self.compensators))
+            return
+        if command == "e":
+            compensator.enabled = True
+            self._respond(f"Compensator {number} Enabled.\r\n")
+            return
+        if command == "d":
+            compensator.enabled = False
+            self._respond(f"Compensator {number} Disabled.\r\n")
+            return
+        setters = [("v", "voltage", f"Compensator {number} Voltage Set to"), ("a", "i2c", "Sensor Address Set to"),
+                   ("w", "wave", "Wavelength Set to")]
+        for prefix, attribute, response in setters:
+            if command.startswith(prefix):
+                value = self._argument(command, prefix)
+                if value is None:
+                    break
+                setattr(compensator, attribute, value)
+                self._respond(f"{response} {value}\r\n")
+                return
+        self._respond(f"Unknown command {command}\r\n")
+        return
+
+    ##############################
+    # Thermal Model
+    ##############################
+    #First order response of each stack toward its setpoint (heating only) or ambient when disabled
+    def _update_thermal(self):
+        now = time.monotonic()
+        dt = (now - self.last_update) * self.time_scale
+        self.last_update = now
+        if dt <= 0:
+            return
+        approach = 1 - math.exp(-dt / self.thermal_time_constant)
+        smoothing = 1 - math.exp(-dt / self.average_time_constant)
+        for controller in self.controllers:
+            if controller.enabled:
+                target = max(controller.setpoint, self.ambient)
+            else:
+                target = self.ambient
+            error = controller.setpoint - controller.temp
+            controller.error_d = error - controller.error_p
+            controller.error_p = error
+            controller.error_i += error * dt
+            if controller.enabled:
+                controller.effort = min(100.0, max(0.0, controller.kp * error))
+            else:
+                controller.effort = 0.0
+            controller.temp += (target - controller.temp) * approach
+            controller.average += (controller.temp - controller.average) * smoothing
+        return
+
+    #The "r" dump. Same layout the TCB prints
+    def raw_data(self):
+        lines = [Controller.header]
+        for c in self.controllers:
+            temp = c.temp + self.random.gauss(0, self.noise)
+            lines.append(f"Cont{c.number}\t{c.kp:.3f}\t{c.kd:.3f}\t{c.ki:.3f}\t0.000\t{c.error_p:.3f}\t{c.error_d:.3f}\t{c.error_i:.3f}\t"
+                         f"{c.effort:.2f}\t0.000\t{temp:.3f}C\t{c.average:.3f}C\t0.000\t{c.setpoint:.3f}C\t{int(c.i2c)}\t"
+                         f"{int(c.frequency)}\t0\t{c.enabled}\tTMP117")
+        lines.append(Compensator.header)
+        stack = self.controllers[0]
+        for c in self.compensators:
+            lines.append(f"Comp{c.number}\t{c.voltage:.3f}\t{c.wave:.3f}\t{stack.temp:.3f}C\t{stack.average:.3f}C\t{c.auto}\tFalse\t{int(c.i2c)}\t{c.enabled}\tTMP117")
+        lines.append(GPIO.header)
+        for n, state in enumerate(self.gpios):
+            lines.append(f"GPIO{n+1} {state}")
+        lines.append(Bipolar.header)
+        for n, (frequency, pulses, voltage, enabled) in enumerate(self.bipolars):
+            lines.append(f"Bipolar{n+1} {frequency} {pulses} {voltage} {enabled}")
+        return "\r\n".join(lines) + "\r\n"
+
+
+if __name__ == "__main__":
+    #Run the LFDI_TCB against the simulator with 1 minute of stack time every second
+    try:
+        from Hardware_API.LFDI_API import LFDI_TCB
+    except:
+        from LFDI_API import LFDI_TCB
+    board = Virtual_TCB(latency = 0.005, time_scale = 60)
+    lfdi = LFDI_TCB(board, silent = True)
+    lfdi.set_controller_setpoint(1, 30)
+    lfdi.set_controller_enable(1, True)
+    for i in range(10):
+        lfdi.get_info()
+        print(f"Temp {lfdi.Controllers[0].temp:.2f}C Average {lfdi.Controllers[0].average:.2f}C Effort {lfdi.Controllers[0].effort}")
+        time.sleep(1)
@@ -0,0 +1,225 @@
+#Binary telemetry log for the TCB
+#Replaces appending get_info() strings to TCB_Out.tsv. Every sample is one fixed width record so the file can be
+#memory mapped and loaded straight into numpy for plotting
+#
+#File Layout:
+#   8 bytes   magic "LFDITLM1"
+#   4 bytes   length of the schema (little endian uint32)
+#   schema    JSON with the numpy dtype of a record, the channel layout and the TSV header. Padded with spaces so the records are 64 byte aligned
+#   records   one per sample
+#
+#Example:
+#   telemetry = Telemetry_Writer("TCB_Out.tlm", lfdi)
+#   telemetry.record(lfdi)     #or telemetry.record(lfdi, snapshot) for a snapshot from the poller
+#   data = read_telemetry("TCB_Out.tlm")
+#   plt.plot(data["timestamp"], data["Cont1_average"])
+#   export_tsv("TCB_Out.tlm", "TCB_Out.tsv")
+import json
+import os
+import struct
+import time
+from datetime import datetime
+import numpy as np
+
+
+magic = b"LFDITLM1"
+alignment = 64
+
+#Fields stored for each channel. Same order as the get_info of the data classes so the TSV export matches
+controller_fields = [("kp", "<f8"), ("kd", "<f8"), ("ki", "<f8"), ("error_p", "<f8"), ("error_d", "<f8"), ("error_i", "<f8"),
+                     ("effort", "<f8"), ("temp", "<f8"), ("average", "<f8"), ("setpoint", "<f8"), ("i2c", "S8"),
+                     ("history", "<f8"), ("frequency", "<f8"), ("enabled", "S8"), ("sensor", "S16")]
+compensator_fields = [("voltage", "<f8"), ("wave", "<f8"), ("temp", "<f8"), ("avg", "<f8"), ("auto", "S8"),
+                      ("useAverage", "S8"), ("i2c", "S8"), ("enabled", "S8"), ("sensor", "S16")]
+gpio_fields = [("state", "S8")]
+bipolar_fields = [("frequency", "<f8"), ("pulses", "<f8"), ("voltage", "<f8"), ("enabled", "S8")]
+
+
+#The channels of the TCB as (label, object, fields)
+def get_channels(tcb):
+    channels = []
+    for controller in tcb.Controllers:
+        channels.append((f"Cont{controller.number}", controller, controller_fields))
+    for compensator in tcb.Compensators:
+        channels.append((f"Comp{compensator.number}", compensator, compensator_fields))
+    for gpio in tcb.GPIOs:
+        channels.append((f"GPIO{gpio.number}", gpio, gpio_fields))
+    for bipolar in tcb.Bipolars:
+        channels.append((f"Bipolar{bipolar.number}", bipolar, bipolar_fields))
+    return channels
+
+
+#Build the schema for a TCB. Record fields are named {label}_{field} ie "Cont1_average"
+def build_schema(tcb):
+    descr = [("timestamp", "<f8")]
+    layout = []
+    for label, channel, fields in get_channels(tcb):
+        descr += [(f"{label}_{name}", dtype) for name, dtype in fields]
+        layout.append([label, [name for name, dtype in fields]])
+    return {"version": 1, "descr": descr, "channels": layout, "tsv_header": tcb.header_format}
+
+
+def schema_dtype(schema):
+    return np.dtype([tuple(field) for field in schema["descr"]])
+
+
+#Numbers that did not parse (ie a setpoint of "OFF") are stored as NaN
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float("nan")
+
+
+def to_bytes(value):
+    return str(value).encode('ascii', errors = 'replace')
+
+
+#Read the schema from the start of a telemetry file. Returns the schema and where the records start
+def read_header(filename):
+    with open(filename, "rb") as f:
+        if f.read(len(magic)) != magic:
+            raise ValueError(f"{filename} is not a TCB telemetry log")
+        length = struct.unpack("<I", f.read(4))[0]
+        schema = json.loads(f.read(length).decode('utf-8'))
+    return schema, len(magic) + 4 + length
+
+
+#Appends a fixed width record per sample. The file is flushed after every record so nothing is lost if the run dies
+class Telemetry_Writer(object):
+
+    def __init__(self, filename, tcb):
+        self.filename = filename
+        self.schema = build_schema(tcb)
+        self.dtype = schema_dtype(self.schema)
+        #Keep adding to an existing log as long as it was written for the same TCB layout
+        if os.path.exists(filename) and os.path.getsize(filename) > 0:
+            schema, self.offset = read_header(filename)
+            if schema_dtype(schema) != self.dtype:
+                raise ValueError(f"{filename} was written with a different record layout")
+            #Drop a partial record left by a crash so the records stay aligned
+            size = os.path.getsize(filename)
+            count = (size - self.offset) // self.dtype.itemsize
+            if self.offset + count * self.dtype.itemsize != size:
+                with open(filename, "r+b") as f:
+                    f.truncate(self.offset + count * self.dtype.itemsize)
+        else:
+            self.write_header()
+        self.file = open(filename, "ab")
+        self.record_buffer = np.zeros(1, dtype = self.dtype)
+        return
+
+    def write_header(self):
+        header = json.dumps(self.schema).encode('utf-8')
+        #Pad so the first record is aligned
+        padding = (-(len(magic) + 4 + len(header))) % alignment
+        header += b" " * padding
+        with open(self.filename, "wb") as f:
+            f.write(magic)
+            f.write(struct.pack("<I", len(header)))
+            f.write(header)
+        self.offset = len(magic) + 4 + len(header)
+        return
+
+    #Append the current state of the TCB data objects
+    def append(self, tcb, timestamp = None):
+        if timestamp is None:
+            timestamp = time.time()
+        values = [timestamp]
+        for label, channel, fields in get_channels(tcb):
+            for name, dtype in fields:
+                values.append(getattr(channel, name))
+        self.write_values(values)
+        return
+
+    #Append a snapshot from the background poller with the time it was taken
+    #The values come from its info line (the same layout as get_info) so they are all from that one poll
+    def append_snapshot(self, snapshot):
+        columns = snapshot.info.split('\t')[2:] #After the date and time
+        values = [snapshot.timestamp]
+        index = 0
+        for label, fields in self.schema["channels"]:
+            if index + len(fields) >= len(columns) or columns[index] != label:
+                raise ValueError(f"Snapshot does not have the {label} fields where the log expects them")
+            values += columns[index+1:index+1+len(fields)]
+            index += 1 + len(fields)
+        self.write_values(values)
+        return
+
+    def write_values(self, values):
+        for i, (name, dtype) in enumerate(self.schema["descr"]):
+            values[i] = to_bytes(values[i]) if dtype.startswith("S") else to_float(values[i])
+        self.record_buffer[0] = tuple(values)
+        self.file.write(self.record_buffer.tobytes())
+        self.file.flush()
+        return
+
+    #Append the newest poll if the background poller is running, otherwise read the TCB and append that
+    #The live data objects are not read while the poller is running since it could be part way through updating them
+    def record(self, tcb, snapshot = None):
+        if snapshot is None:
+            snapshot = tcb.get_latest_snapshot()
+        if snapshot is not None:
+            self.append_snapshot(snapshot)
+            return
+        with tcb.lock:
+            tcb.refresh()
+            self.append(tcb)
+        return
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+        return
+
+    def __del__(self):
+        self.close()
+        return
+
+
+#Memory map the records of a telemetry file as a numpy structured array (nothing is copied)
+def read_telemetry(filename):
+    schema, offset = read_header(filename)
+    dtype = schema_dtype(schema)
+    count = (os.path.getsize(filename) - offset) // dtype.itemsize
+    if count == 0:
+        return np.zeros(0, dtype = dtype)
+    return np.memmap(filename, dtype = dtype, mode = 'r', offset = offset, shape = (count,))
+
+
+def format_tsv_value(value):
+    if isinstance(value, bytes):
+        return value.decode('ascii', errors = 'replace')
+    return str(float(value))
+
+
+#Write the telemetry out in the old TCB_Out.tsv format
+def export_tsv(filename, tsv_filename):
+    schema, offset = read_header(filename)
+    data = read_telemetry(filename)
+    with open(tsv_filename, "w") as f:
+        f.write(f"{schema['tsv_header']}\n")
+        for record in data:
+            info = datetime.fromtimestamp(record["timestamp"]).strftime("%m/%d/%Y\t%H:%M:%S") + '\t'
+            for label, fields in schema["channels"]:
+                info += label
+                for name in fields:
+                    info += '\t' + format_tsv_value(record[f"{label}_{name}"])
+                info += '\t'
+            f.write(f"{info}\n")
+    return
+
+
+if __name__ == "__main__":
+    #Convert a telemetry log to TSV: python TCB_Telemetry_Log.py TCB_Out.tlm [TCB_Out.tsv]
+    import sys
+    if len(sys.argv) < 2:
+        print("Usage: python TCB_Telemetry_Log.py <telemetry file> [tsv file]")
+        exit()
+    telemetry_file = sys.argv[1]
+    if len(sys.argv) > 2:
+        tsv_file = sys.argv[2]
+    else:
+        tsv_file = os.path.splitext(telemetry_file)[0] + ".tsv"
+    export_tsv(telemetry_file, tsv_file)
+    print(f"Wrote {len(read_telemetry(telemetry_file))} samples to {tsv_file}")
@@ -0,0 +1,200 @@
+#Thermal model of an optical stack fit to the TCB telemetry
+#Used to end the soak at each temperature step once the crystal is close to equilibrium instead of holding for a fixed time
+#
+#The stack is treated as two nodes. The sensor node is what the controller holds at the setpoint and the crystal sits behind
+#it and lags the sensor. Once the sensor is at the setpoint the heat flowing into the crystal is proportional to how far the
+#crystal still has to go, so the extra heater effort decays with the crystal's time constant (fit_exponential_decay).
+#That time constant tells us when the crystal is within a fraction of equilibrium.
+#The drift of the spectral peak is an independent check on the same thing
+#
+#Example:
+#   soak = Soak_Predictor(fraction = 0.02, max_hold = 1800)
+#   soak.start()
+#   while not soak.is_done(lfdi, controller_number = 1):
+#       soak.add_peak(time.time(), spectrometer.get_peak_position(crosssection))
+import time
+import math
+import numpy as np
+from scipy.optimize import curve_fit
+
+
+def exponential_decay(t, final, amplitude, tau):
+    return final + amplitude * np.exp(-t / tau)
+
+
+#Exponential decay toward a final value
+class Decay_Fit(object):
+    __slots__ = ("start_time", "final", "amplitude", "tau", "rms")
+
+    def __init__(self, start_time, final, amplitude, tau, rms):
+        self.start_time = start_time
+        self.final = final
+        self.amplitude = amplitude
+        self.tau = tau
+        self.rms = rms
+        return
+
+    #Time when what is left of the decay is fraction of where it started
+    def time_to_fraction(self, fraction):
+        return self.start_time + self.tau * math.log(1 / fraction)
+
+    #The decay is lost in the noise. Either there is nothing left to wait for or there is not enough data to see it yet
+    def is_flat(self):
+        return abs(self.amplitude) < 3 * self.rms
+
+
+#Fit an exponential decay starting at start_time. Returns None if there is not enough data or the fit fails
+def fit_exponential_decay(timestamps, values, start_time = None, max_tau = None):
+    t = np.asarray(timestamps, dtype = float)
+    y = np.asarray(values, dtype = float)
+    keep = np.isfinite(y)
+    t = t[keep]
+    y = y[keep]
+    if len(t) < 5:
+        return None
+    if start_time is None:
+        start_time = t[0]
+    t = t - start_time
+    span = max(t[-1], 1e-3)
+    if max_tau is None:
+        max_tau = 100 * span
+    try:
+        parameters, _ = curve_fit(exponential_decay, t, y, p0 = (y[-1], y[0] - y[-1], span / 3),
+                                  bounds = ([-np.inf, -np.inf, 1e-3], [np.inf, np.inf, max_tau]))
+    except (RuntimeError, ValueError):
+        return None
+    rms = float(np.sqrt(np.mean((exponential_decay(t, *parameters) - y)**2)))
+    return Decay_Fit(start_time, *[float(p) for p in parameters], rms)
+
+
+#Slope of a linear fit (units per second)
+def drift_rate(timestamps, values):
+    if len(timestamps) < 2:
+        return None
+    t = np.asarray(timestamps, dtype = float)
+    if t[-1] == t[0]:
+        return None
+    return float(np.polyfit(t - t[0], np.asarray(values, dtype = float), 1)[0])
+
+
+#Decides when the soak at a temperature step is done
+#fraction: how much of the crystal's step is allowed to be left (0.02 is within 2% of equilibrium)
+#min_hold/max_hold: bounds on the soak (s). max_hold is the old fixed hold so we are never slower than before
+#max_peak_drift: if peaks are added the peak also has to move less than this many pixels over peak_window seconds
+#refit_interval: seconds between model fits, the fit is cheap but there is no point doing it every frame
+#flat_fits/flat_window: a flat fit (no decay above the noise) only ends the soak once this many fits in a row have been flat
+#over at least this many seconds. Noisy effort early in the soak gives flat fits too
+class Soak_Predictor(object):
+
+    def __init__(self, fraction = 0.02, min_hold = 60, max_hold = 1800, max_peak_drift = 1, peak_window = 120, refit_interval = 10,
+                 flat_fits = 5, flat_window = 300):
+        self.fraction = fraction
+        self.min_hold = min_hold
+        self.max_hold = max_hold
+        self.max_peak_drift = max_peak_drift
+        self.peak_window = peak_window
+        self.refit_interval = refit_interval
+        self.flat_fits = flat_fits
+        self.flat_window = flat_window
+        self.start_time = None
+        self.fit = None
+        self.predicted_end = None
+        self.last_fit_time = None
+        self.flat_count = 0 #Flat fits in a row
+        self.flat_since = None #Time of the first of them
+        self.peak_times = []
+        self.peaks = []
+        return
+
+    #The sensor just reached the setpoint
+    def start(self, timestamp = None):
+        self.start_time = time.time() if timestamp is None else timestamp
+        self.fit = None
+        self.predicted_end = None
+        self.last_fit_time = None
+        self.flat_count = 0
+        self.flat_since = None
+        self.peak_times = []
+        self.peaks = []
+        return
+
+    #Spectral peak position (pixels) from a frame taken during the soak
+    def add_peak(self, timestamp, peak_position):
+        self.peak_times.append(timestamp)
+        self.peaks.append(peak_position)
+        return
+
+    #Refit the effort decay of the controller since the soak started. Returns the predicted end of the soak or None
+    def update(self, lfdi, controller_number, now = None):
+        timestamps = []
+        efforts = []
+        for snapshot in lfdi.get_history():
+            if snapshot.timestamp < self.start_time:
+                continue
+            try:
+                efforts.append(float(snapshot.efforts[controller_number-1]))
+            except (TypeError, ValueError):
+                continue
+            timestamps.append(snapshot.timestamp)
+        if now is None:
+            now = time.time()
+        self.last_fit_time = now
+        fit = fit_exponential_decay(timestamps, efforts, self.start_time, max_tau = 10 * self.max_hold)
+        if fit is None:
+            return self.predicted_end
+        self.fit = fit
+        if not fit.is_flat():
+            self.flat_count = 0
+            self.flat_since = None
+            self.predicted_end = fit.time_to_fraction(self.fraction)
+            return self.predicted_end
+        #Keep the last prediction (or keep waiting) until the fit has stayed flat long enough to trust it
+        if self.flat_since is None:
+            self.flat_since = now
+        self.flat_count += 1
+        if self.flat_count >= self.flat_fits and now - self.flat_since >= self.flat_window:
+            self.predicted_end = self.flat_since
+        return self.predicted_end
+
+    #Peak drift over the last peak_window seconds is small enough (True if there are no peaks to check)
+    def peak_is_stable(self):
+        if len(self.peaks) == 0 or self.max_peak_drift is None:
+            return True
+        newest = self.peak_times[-1]
+        if newest - self.start_time < self.peak_window:
+            return False
+        window = [(t, p) for t, p in zip(self.peak_times, self.peaks) if newest - t <= self.peak_window]
+        rate = drift_rate([t for t, p in window], [p for t, p in window])
+        if rate is None:
+            return False
+        return abs(rate) * self.peak_window <= self.max_peak_drift
+
+    #True once the model says the crystal is within fraction of equilibrium and the peak has stopped moving
+    #Always ends after max_hold
+    def is_done(self, lfdi, controller_number, now = None):
+        if now is None:
+            now = time.time()
+        elapsed = now - self.start_time
+        if elapsed >= self.max_hold:
+            return True
+        if elapsed < self.min_hold:
+            return False
+        if self.last_fit_time is None or now - self.last_fit_time >= self.refit_interval:
+            self.update(lfdi, controller_number, now)
+        if self.predicted_end is None or now < self.predicted_end:
+            return False
+        return self.peak_is_stable()
+
+    #One line about the current prediction
+    def format_status(self, now = None):
+        if now is None:
+            now = time.time()
+        elapsed = now - self.start_time
+        if self.fit is None:
+            return f"Soaking {elapsed:.0f}s, no model fit yet (hold ends by {self.max_hold}s)"
+        if self.predicted_end is None:
+            return f"Soaking {elapsed:.0f}s, no decay above the noise for {self.flat_count} fits (hold ends by {self.max_hold}s)"
+        end = min(self.predicted_end - self.start_time, self.max_hold)
+        if self.fit.is_flat():
+            return f"Soaking {elapsed:.0f}s, no decay above the noise for {self.flat_count} fits, predicted end {end:.0f}s"
+        return f"Soaking {elapsed:.0f}s, crystal time constant {self.fit.tau:.0f}s, predicted end {end:.0f}s"
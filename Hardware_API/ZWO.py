@@ -1,5 +1,153 @@
 import zwoasi as asi
 import os
+import json
+import time
+import threading
+import collections
+import numpy as np
+from PIL import Image
+
+
+#A frame from the video stream
+class Frame:
+    __slots__ = ("image", "timestamp", "index", "exposure", "roi")
+
+    def __init__(self, image, timestamp, index, exposure, roi=None):
+        self.image = image
+        self.timestamp = timestamp #time.time() when the frame came off the camera
+        self.index = index #Frame number since the stream started. Gaps mean frames were dropped
+        self.exposure = exposure #(s)
+        self.roi = roi #Where the image sits on the sensor, see ZWO_Camera.get_roi_geometry
+        return
+
+
+#Bounded queue of Frames between the stream thread and a consumer
+#policy 'drop_oldest' throws away the oldest frame when full so a slow consumer always gets the newest frames (live view)
+#policy 'block' makes the stream thread wait for space so no frame is ever lost (recording)
+class Frame_Queue:
+    def __init__(self, size=8, policy='drop_oldest'):
+        if policy not in ('drop_oldest', 'block'):
+            raise ValueError(f"Unknown queue policy {policy}")
+        self.size = size
+        self.policy = policy
+        self.frames = collections.deque()
+        self.condition = threading.Condition()
+        self.dropped = 0
+        self.closed = False
+        return
+
+    def __len__(self):
+        return len(self.frames)
+
+    #Returns False if the queue was closed while waiting for space
+    def put(self, frame):
+        with self.condition:
+            if self.policy == 'block':
+                self.condition.wait_for(lambda: len(self.frames) < self.size or self.closed)
+                if self.closed:
+                    return False
+            elif len(self.frames) >= self.size:
+                self.frames.popleft()
+                self.dropped += 1
+            self.frames.append(frame)
+            self.condition.notify_all()
+        return True
+
+    #The oldest frame in the queue or None if nothing came in within timeout seconds
+    def get(self, timeout=None):
+        with self.condition:
+            if not self.condition.wait_for(lambda: len(self.frames) > 0 or self.closed, timeout):
+                return None
+            if len(self.frames) == 0:
+                return None
+            frame = self.frames.popleft()
+            self.condition.notify_all()
+            return frame
+
+    #The newest frame, anything older is thrown away
+    def get_latest(self, timeout=None):
+        with self.condition:
+            if not self.condition.wait_for(lambda: len(self.frames) > 0 or self.closed, timeout):
+                return None
+            if len(self.frames) == 0:
+                return None
+            frame = self.frames.pop()
+            self.dropped += len(self.frames)
+            self.frames.clear()
+            self.condition.notify_all()
+            return frame
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        return
+
+#One file per run that records the camera settings every time they change and which settings each frame was taken with
+#Replaces a .txt file of Control Values next to every image. One JSON object per line:
+#   {"settings_id": 3, "timestamp": ..., "settings": {"Exposure": 50000, "Gain": 300, ...}}
+#   {"frame": "Hold_....png", "settings_id": 3, "timestamp": ...}
+class Settings_Journal:
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.settings_id = 0
+        self.last_settings = None
+        #Carry on numbering from an existing journal
+        if os.path.exists(filename):
+            with open(filename) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    if "settings" in entry:
+                        self.settings_id = entry["settings_id"]
+                        self.last_settings = entry["settings"]
+        self.file = open(filename, 'a')
+        return
+
+    def write_entry(self, entry):
+        self.file.write(json.dumps(entry) + '\n')
+        self.file.flush()
+        return
+
+    #Returns the id of the settings, a new entry is only written if they changed
+    def record_settings(self, settings):
+        settings = {k: settings[k] for k in sorted(settings.keys())}
+        with self.lock:
+            if settings != self.last_settings:
+                self.settings_id += 1
+                self.last_settings = settings
+                self.write_entry({"settings_id": self.settings_id, "timestamp": time.time(), "settings": settings})
+            return self.settings_id
+
+    def record_frame(self, filename, settings_id, timestamp=None):
+        with self.lock:
+            self.write_entry({"frame": os.path.basename(filename), "settings_id": settings_id,
+                              "timestamp": time.time() if timestamp is None else timestamp})
+        return
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.close()
+        return
+
+
+#Read a settings journal back. Returns ({settings_id: settings}, {frame filename: settings_id})
+def read_settings_journal(filename):
+    settings = {}
+    frames = {}
+    with open(filename) as f:
+        for line in f:
+            entry = json.loads(line)
+            if "settings" in entry:
+                settings[entry["settings_id"]] = entry["settings"]
+            else:
+                frames[entry["frame"]] = entry["settings_id"]
+    return settings, frames
+
 
 #Create a Encapsulation class for the ZWO Camera bc the other stuff is too complex
 class ZWO_Camera:
@@ -10,6 +158,22 @@ class ZWO_Camera:
         print("WARNING This Software Uses the First ASI Camera It finds when scanning Ports")
         self.camera = asi.Camera(0)
         self.camera_info = self.camera.get_camera_property()
+        #Host side copy of the Control Values so we don't ask the camera over USB for every frame
+        #The setters keep it up to date. With auto exposure on the camera changes them itself so they are always read
+        self.control_values = None
+        self.auto_exposure = False
+        self.exposure_us = None
+        #Per run settings journal, see start_journal
+        self.journal = None
+        #Current ROI (start_x, start_y, width, height) in binned pixels
+        self.roi = None
+        #Video stream state
+        self.stream_thread = None
+        self.stop_stream_event = threading.Event()
+        self.stream_queues = []
+        self.stream_lock = threading.Lock()
+        self.frames_captured = 0
+        self.stream_errors = 0
         
         #Set Default Values
         self.binning = 1
@@ -25,40 +189,145 @@ class ZWO_Camera:
 
     def set_gain(self, gain):
         self.camera.set_control_value(asi.ASI_GAIN, gain)
+        self.update_control_value('Gain', gain)
+
+    #Store a value we just set in the cache
+    def update_control_value(self, name, value):
+        if self.control_values is not None:
+            self.control_values[name] = value
+        return
+
+    #Forget the cached Control Values so the next read goes to the camera
+    def invalidate_control_values(self):
+        self.control_values = None
+        self.exposure_us = None
+        return
+
+    #The Control Values of the camera. Only read from the camera when the cache is empty or auto exposure is on
+    #Sensor readings like Temperature are only as fresh as the last read, use refresh_control_values to update them
+    def get_control_values(self):
+        if self.control_values is None or self.auto_exposure:
+            return self.refresh_control_values()
+        return dict(self.control_values)
+
+    def refresh_control_values(self):
+        self.control_values = self.camera.get_control_values()
+        self.exposure_us = self.control_values.get('Exposure')
+        return dict(self.control_values)
+
+    #Write every frame's settings to one journal file for the run instead of a .txt next to every image
+    def start_journal(self, filename):
+        self.stop_journal()
+        self.journal = Settings_Journal(filename)
+        return self.journal
+
+    def stop_journal(self):
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = None
+        return
+
+    #The Control Values plus the ROI geometry, everything needed to place a frame back on the sensor
+    #roi: geometry the frame was taken with if the ROI has changed since (defaults to the current one)
+    def get_frame_settings(self, roi=None):
+        settings = self.get_control_values()
+        settings['ROI'] = self.get_roi_geometry() if roi is None else roi
+        return settings
+
+    #Log the settings a frame was taken with. Uses the journal if there is one otherwise a .txt next to the image
+    #settings can be read ahead of time (ie on the capture thread when the image is written later)
+    def record_frame_settings(self, filename, settings=None):
+        if settings is None:
+            settings = self.get_frame_settings()
+        if self.journal is not None:
+            self.journal.record_frame(filename, self.journal.record_settings(settings))
+        elif self.save_control_values_on:
+            self.save_control_values(filename, settings)
+        return
     
-    def save_control_values(self, filename):
-        settings = self.camera.get_control_values()
+    #The Control Values of the camera one per line
+    def format_control_values(self, settings=None):
+        if settings is None:
+            settings = self.get_frame_settings()
+        return ''.join('%s: %s\n' % (k, str(settings[k])) for k in sorted(settings.keys()))
+
+    def save_control_values(self, filename, settings=None):
         #if the file name contains a .jpg, .png, .tif or .bmp remove it
         while filename.endswith('.jpg') or filename.endswith('.png') or filename.endswith('.tif') or filename.endswith('.bmp'):
             filename = filename[:-4]
         filename += '.txt'
         
         with open(filename, 'w') as f:
-            for k in sorted(settings.keys()):
-                f.write('%s: %s\n' % (k, str(settings[k])))
+            f.write(self.format_control_values(settings))
         print('Camera settings saved to %s' % filename)
     
     #Set Exposure in S
     def set_exposure(self, exposure):
         exposure = int(exposure * 1000000)
         self.camera.set_control_value(asi.ASI_EXPOSURE, exposure)
+        self.update_control_value('Exposure', exposure)
+        self.exposure_us = exposure
         self.set_timeout()
     
+    #Changing the binning resets the ROI to the full sensor
     def set_binning(self, binning):
         self.binning = binning
         self.camera.set_roi(bins=binning)
+        self.roi = tuple(self.camera.get_roi())
 
     def set_auto_exposure(self, enable):
         self.camera.set_control_value(asi.ASI_EXPOSURE, self.camera.get_controls()['Exposure']['DefaultValue'], auto=enable)
+        self.auto_exposure = enable
+        self.invalidate_control_values()
     
-    def set_roi(self, width, height):
+    #Size of the whole sensor in binned pixels
+    def get_full_size(self):
+        return self.camera_info['MaxWidth'] // self.binning, self.camera_info['MaxHeight'] // self.binning
+
+    #width and height in binned pixels. The camera needs the width to be a multiple of 8 and the height a multiple of 2
+    #so they are rounded down. start_x and start_y are the top left corner, None centres the ROI on the sensor
+    def set_roi(self, width, height, start_x=None, start_y=None):
+        if self.is_streaming():
+            print('Can not change the ROI while streaming')
+            return
+        full_width, full_height = self.get_full_size()
         #is the user input 'max' for the width or height set it to the max value
         if width == 'max':
-            width = self.camera_info['MaxWidth']
+            width = full_width
         if height == 'max':
-            height = self.camera_info['MaxHeight']
+            height = full_height
+        width = max(8, int(width) - int(width) % 8)
+        height = max(2, int(height) - int(height) % 2)
+
+        self.camera.set_roi(start_x=start_x, start_y=start_y, width=width, height=height, bins=self.binning)
+        self.roi = tuple(self.camera.get_roi())
+
+    #Read out only the rows around center_row (binned pixels on the full sensor) across the whole width
+    #The band is moved in from the edges of the sensor if it would hang off them
+    def set_band_roi(self, center_row, rows):
+        full_width, full_height = self.get_full_size()
+        rows = min(int(rows) + int(rows) % 2, full_height - full_height % 2)
+        start_y = min(max(int(center_row) - rows // 2, 0), full_height - rows)
+        self.set_roi(full_width, rows, 0, start_y)
+        return self.get_roi_geometry()
+
+    def set_full_roi(self):
+        self.set_roi('max', 'max', 0, 0)
+        return
+
+    #Where the images sit on the sensor. Everything is in binned pixels
+    #full_width and full_height are the size of a full frame so the rows of a band can be put back in place
+    def get_roi_geometry(self):
+        if self.roi is None:
+            self.roi = tuple(self.camera.get_roi())
+        start_x, start_y, width, height = self.roi
+        full_width, full_height = self.get_full_size()
+        return {"start_x": start_x, "start_y": start_y, "width": width, "height": height, "bins": self.binning,
+                "full_width": full_width, "full_height": full_height}
 
-        self.camera.set_roi(width=width, height=height)
+    def is_full_frame(self):
+        geometry = self.get_roi_geometry()
+        return geometry["width"] == geometry["full_width"] - geometry["full_width"] % 8 and geometry["height"] == geometry["full_height"] - geometry["full_height"] % 2
     
     
     def set_image_type(self, image_type):
@@ -75,31 +344,110 @@ class ZWO_Camera:
         return
 
 
-    #Capture an Image and save it to the given filename
+    #Capture an Image and return it as a numpy array (uint16 for RAW16) without touching the disk
+    def capture_array(self):
+        self.set_timeout()
+        return self.camera.capture()
+
+    #Encode a captured image to disk. The format comes from the extension (png, tif, ...)
+    #The Control Values go in the settings journal, or a text file next to the image if save control values is on
+    #settings: from get_frame_settings when the image was taken, if they may have changed since
+    def save_image(self, image, filename, settings=None):
+        Image.fromarray(np.ascontiguousarray(image)).save(filename)
+        self.record_frame_settings(filename, settings)
+        return
+
+    #Capture an Image and save it to the given filename. Returns the image
     #if the save Control values is turned on a text file will be created with the Control Values
     def capture(self, filename):
+        image = self.capture_array()
+        self.save_image(image, filename)
+        return image
+        
+    #Start video capture. A thread pushes every frame to the queues from subscribe()
+    #Frames come as fast as the exposure allows instead of paying the snapshot start up every frame
+    def start_stream(self):
+        if self.stream_thread is not None:
+            return
         self.set_timeout()
-        #self.camera.set_control_value(asi.ASI_EXPOSURE, self.auto_exposure)
-        self.camera.capture(filename=filename)
-        if self.save_control_values_on:
-            self.save_control_values(filename)
+        self.frames_captured = 0
+        self.stream_errors = 0
+        self.stop_stream_event.clear()
+        self.camera.start_video_capture()
+        self.stream_thread = threading.Thread(target=self.stream_loop, daemon=True)
+        self.stream_thread.start()
         return
-        
+
+    def stop_stream(self):
+        if self.stream_thread is None:
+            return
+        self.stop_stream_event.set()
+        with self.stream_lock:
+            for queue in self.stream_queues:
+                queue.close()
+        self.stream_thread.join()
+        self.stream_thread = None
+        self.stream_queues = []
+        self.camera.stop_video_capture()
+        return
+
+    def is_streaming(self):
+        return self.stream_thread is not None
+
+    #Get a queue of the streamed frames. Every subscriber gets every frame (subject to its own policy)
+    def subscribe(self, size=8, policy='drop_oldest'):
+        queue = Frame_Queue(size, policy)
+        with self.stream_lock:
+            self.stream_queues.append(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        queue.close()
+        with self.stream_lock:
+            if queue in self.stream_queues:
+                self.stream_queues.remove(queue)
+        return
+
+    def stream_loop(self):
+        exposure = self.get_camera_exposure()
+        #The ROI can not change while streaming
+        roi = self.get_roi_geometry()
+        while not self.stop_stream_event.is_set():
+            try:
+                image = self.camera.capture_video_frame()
+            except Exception as e:
+                #A frame timing out is not fatal, the next one usually comes through
+                self.stream_errors += 1
+                print(f"Video frame failed {e}")
+                continue
+            frame = Frame(image, time.time(), self.frames_captured, exposure, roi)
+            self.frames_captured += 1
+            with self.stream_lock:
+                queues = list(self.stream_queues)
+            for queue in queues:
+                queue.put(frame)
+        return
+
+    #Twice the exposure plus half a second (ms). Uses the cached exposure unless auto exposure can change it
     def set_timeout(self):
-        timeout = (self.camera.get_control_value(asi.ASI_EXPOSURE)[0] / 1000) * 2 + 500
+        timeout = (self.get_exposure_us() / 1000) * 2 + 500
         self.camera.default_timeout = timeout
     
     def get_camera_info(self):
         return self.camera_info
 
     def get_camera_width(self):
-        return self.camera.get_roi()[2]
+        return self.get_roi_geometry()["width"]
     def get_camera_height(self):
-        return self.camera.get_roi()[3]
+        return self.get_roi_geometry()["height"]
     def get_camera_image_type(self):
         return self.camera.get_image_type()
     def get_camera_exposure(self):
-        return self.camera.get_control_value(asi.ASI_EXPOSURE)[0] / 1000000
+        return self.get_exposure_us() / 1000000
+    def get_exposure_us(self):
+        if self.exposure_us is None or self.auto_exposure:
+            return self.camera.get_control_value(asi.ASI_EXPOSURE)[0]
+        return self.exposure_us
     def __str__(self):
         return f"Camera Info: {str(self.camera_info)}\nBinning: {str(self.binning)}\nWidth: {str(self.get_camera_width())}\nHeight: {str(self.get_camera_height())}\n\
             Image Type: {str(self.get_camera_image_type())}\nExposure: {str(self.get_camera_exposure())}\n"
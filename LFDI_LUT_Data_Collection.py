@@ -56,6 +56,8 @@
 
 import numpy as np
 import Hardware_API.LFDI_API as LFDI
+import Hardware_API.TCB_Telemetry_Log as TCB_Telemetry_Log
+import Hardware_API.TCB_Thermal_Model as TCB_Thermal_Model
 import time
 import Hardware_API.Spectrograph as Spectrograph
 import os
@@ -65,9 +67,13 @@ from functools import partial
 
 # Check to see if the TCB temp is at the set point
 def TCB_at_temp(temp, LFDI_TCB, tolerance):
-    #Get the current temperature
+    #Get the current temperature. Use the background poller if it is running so we don't touch the port
+    snapshot = LFDI_TCB.get_latest_snapshot()
     try:
-        current_temp = float(LFDI_TCB.Controllers[0].average)
+        if snapshot is not None:
+            current_temp = float(snapshot.averages[0])
+        else:
+            current_temp = float(LFDI_TCB.Controllers[0].average)
     except ValueError as e:
         print(f"Value Error {e} board request may have desynced")
         return False
@@ -90,6 +96,16 @@ def wait_time(start, wait_time):
         return False
 
 
+# Save a frame to the run's spectral cube, or as a PNG if there is no cube or the frame doesn't fit in it
+# (ie a full frame taken for alignment in band capture). The metadata goes in the cube, a PNG only has its filename
+def save_frame(spectrometer : Spectrograph.Spectrometer, image, filename, **metadata):
+    if spectrometer.cube is not None and image is not spectrometer.alignment_frame and spectrometer.cube.fits(image):
+        spectrometer.save_to_cube(image, filename, timestamp=time.time(), compensated=False, wavelength=0, **metadata)
+    else:
+        spectrometer.save_image_async(image, filename)
+    return
+
+
 # The Following Function is the Experiment that will be ran to Collect all the Data
 # @param spectrometer: The Spectrometer Object
 # @param LFDI_TCB: The LFDI_TCB Object
@@ -101,11 +117,16 @@ def wait_time(start, wait_time):
 # @param step_voltage: (Float) The Step Size for the Voltage Sweep
 # @param tolerance: (Float) The Tolerance for the Temperature
 # @param folder: (path) The Folder to save the data to
+# @param stability_window: (Float) How long the temperature has to stay within tolerance with a flat slope to count as settled (s)
+# @param soak_fraction: (Float) How close to equilibrium the crystal has to be before the hold ends (0.02 is within 2%)
+# @param seconds_to_wait: (Float) The longest the hold at each temperature can take (s)
+# @param use_cube: (Bool) Put the frames in one Spectra.cube file instead of a PNG each
 # @return None
 # This will go through the array of temperatures and the array of Voltages step by step and capture Spectra Output to the Experiment Folder
 def Total_Data_Collection(spectrometer : Spectrograph.Spectrometer,LFDI_TCB: LFDI.LFDI_TCB, start_temp: float, end_temp: float, 
                           step_temp: float, tolerance: float, start_voltage: float, end_voltage: float, 
-                          step_voltage : float, folder, compensator_number = 4, controller_number = 1):
+                          step_voltage : float, folder, compensator_number = 4, controller_number = 1, stability_window = 60,
+                          soak_fraction = 0.02, seconds_to_wait = 1800, use_cube = True):
     
     
     # print the parameters 
@@ -126,84 +147,118 @@ def Total_Data_Collection(spectrometer : Spectrograph.Spectrometer,LFDI_TCB: LFD
     voltages = np.arange(start_voltage, end_voltage, step_voltage)
     print(f"Voltages: {voltages}")
     
-    # Create a file to store the data
-    filename = f"{folder}\\TCB_Out.tsv"
-    file = open(filename, "w")
-    file.write(f"{LFDI_TCB.header_format}\n")
-    file.close()
+    # Create a binary log to store the TCB data
+    telemetry = TCB_Telemetry_Log.Telemetry_Writer(f"{folder}\\TCB_Out.tlm", LFDI_TCB)
+    # Log the camera settings once per change instead of a text file per image
+    spectrometer.camera.start_journal(f"{folder}\\Camera_Settings.jsonl")
+    if use_cube:
+        spectrometer.start_cube(f"{folder}\\Spectra.cube")
 
     # First go through the temperatures without the Compensation Algorythm
     # Cycle through the temperatures. Take a measurement while the temperature is moving hold at each temperature for 5 minutes
     #Tun on the output for the First Compensator
     
+    # Watch the temperature continuously so we know the moment each setpoint is reached
+    if LFDI_TCB.poll_thread is None:
+        LFDI_TCB.start_polling()
+
     # Go through the temperatures
+    # The voltage that goes with each frame is the one we commanded, the poller's last dump can be from before it was set
+    hold_voltage = 3
     LFDI_TCB.set_controller_enable(controller_number=controller_number, enable=True)
+    # Steps the TCB stopped answering for even after recovery are logged and skipped so one bad step doesn't end the run
+    skipped = []
     for temperature in temperatures:
-        # Change to a known state
-        LFDI_TCB.set_compensator_voltage(compensator_number, 3)
-        LFDI_TCB.set_compensator_enable(compensator_number, True)
-
-        
-        # Set the temperature
-        LFDI_TCB.set_controller_setpoint(controller_number=controller_number, setpoint=temperature)
+        try:
+            # Change to a known state
+            LFDI_TCB.set_compensator_voltage(compensator_number, hold_voltage)
+            LFDI_TCB.set_compensator_enable(compensator_number, True)
+
+            # Set the temperature
+            LFDI_TCB.set_controller_setpoint(controller_number=controller_number, setpoint=temperature)
+        except LFDI.TCB_Desync_Error as e:
+            print(f"Skipping {temperature}C, the TCB did not respond: {e}")
+            skipped.append((temperature, None))
+            continue
         
         
         temporal_resolution = 10*60 # 10 minute
-        #While we are waiting for the TCB to reach the Temperature take an image every Minute
-        while not TCB_at_temp(temperature, LFDI_TCB, tolerance):
-            # Get the Current time and output the spectrograph for a minute
+        settled = partial(LFDI_TCB.is_settled, controller_number, temperature, tolerance, stability_window)
+        #While we are waiting for the TCB to reach the Temperature save an image every 10 minutes
+        #The live output stops as soon as the temperature settles instead of at the end of the 10 minutes
+        while not settled():
+            # Get the Current time and output the spectrograph for 10 minutes or until we settle
             now = time.time()
-            spectrometer.continuous_output(refresh_rate=1, end_trigger=partial(wait_time, now, temporal_resolution))
+            spectrometer.continuous_output(refresh_rate=1, end_trigger=lambda: wait_time(now, temporal_resolution) or settled(), save_temp_files=False)
             # Take a measurement
-            # Get the Current Temp From LFDI
-            file = open(filename, "a")
-            file.write(f"{LFDI_TCB.get_info()}\n")
-            file.close()
-            current_temp = LFDI_TCB.Controllers[controller_number-1].average
-            current_temp = f"{float(current_temp):.2f}"
-            filename = f"{folder}\\Slew_{str(time.time())}_{LFDI_TCB.Compensators[compensator_number-1].voltage}V_{current_temp}C_CompOff_0nm.png"
-            os.rename(spectrometer.current_image, filename)
+            # Get the Current Temp From the poller's newest snapshot
+            snapshot = LFDI_TCB.get_latest_snapshot()
+            telemetry.record(LFDI_TCB, snapshot)
+            current_temp = f"{float(snapshot.averages[controller_number-1]):.2f}"
+            filename = f"{folder}\\Slew_{str(time.time())}_{hold_voltage}V_{current_temp}C_CompOff_0nm.png"
+            save_frame(spectrometer, spectrometer.current_frame, filename, setpoint=temperature, temperature=float(current_temp),
+                       voltage=hold_voltage, compensator=compensator_number)
         
 
         print(f"Reached {temperature}C")
-        print("Waiting 30 minutes")
-        #Wait For the Crystal to warm through out, Testing Shows for the Epoxied stage this should Take ~ 15 min 
-        now = time.time()
-        seconds_to_wait = 1800 #wait for 30 min
-        while not wait_time(now, seconds_to_wait):
+        print(f"Soaking for up to {seconds_to_wait/60:.0f} minutes")
+        #Wait For the Crystal to warm through out, Testing Shows for the Epoxied stage this should Take ~ 15 min
+        #The thermal model ends the soak once the crystal is within soak_fraction of equilibrium and the spectral peak has stopped drifting
+        soak = TCB_Thermal_Model.Soak_Predictor(fraction=soak_fraction, max_hold=seconds_to_wait)
+        soak.start()
+        soaked = partial(soak.is_done, LFDI_TCB, controller_number)
+        track_peak = lambda crosssection: soak.add_peak(time.time(), spectrometer.get_peak_position(crosssection))
+        while not soaked():
             current_time = time.time()
-            spectrometer.continuous_output(refresh_rate=1, end_trigger=partial(wait_time, current_time, temporal_resolution))
-            file = open(filename, "a")
-            file.write(f"{LFDI_TCB.get_info()}\n")
-            file.close()
-            current_temp = LFDI_TCB.Controllers[controller_number-1].average
-            current_temp = f"{float(current_temp):.2f}"
-            filename = f"{folder}\\Hold_{str(time.time())}_{LFDI_TCB.Compensators[compensator_number-1].voltage}V_{current_temp}C_CompOff_0nm.png"
-            os.rename(spectrometer.current_image, filename)
+            spectrometer.continuous_output(refresh_rate=1, end_trigger=lambda: wait_time(current_time, temporal_resolution) or soaked(), on_frame=track_peak,
+                                           save_temp_files=False)
+            print(soak.format_status())
+            snapshot = LFDI_TCB.get_latest_snapshot()
+            telemetry.record(LFDI_TCB, snapshot)
+            current_temp = f"{float(snapshot.averages[controller_number-1]):.2f}"
+            filename = f"{folder}\\Hold_{str(time.time())}_{hold_voltage}V_{current_temp}C_CompOff_0nm.png"
+            save_frame(spectrometer, spectrometer.current_frame, filename, setpoint=temperature, temperature=float(current_temp),
+                       voltage=hold_voltage, compensator=compensator_number)
 
         print("Finished Waiting")
         print("Cycling through Voltages")
         for voltage in voltages:
             # Set the voltage
-            LFDI_TCB.set_compensator_voltage(compensator_number, voltage)
+            try:
+                LFDI_TCB.set_compensator_voltage(compensator_number, voltage)
+            except LFDI.TCB_Desync_Error as e:
+                print(f"Skipping {voltage}V at {temperature}C, the TCB did not respond: {e}")
+                skipped.append((temperature, voltage))
+                continue
+            set_time = time.time()
+            # The TCB reports the voltage to 3 decimals
+            voltage = round(float(voltage), 3)
             # Wait for the voltage to settle
             time.sleep(1)
-            # Take a measurement
-            now = time.time()
-            spectrometer.single_output()
-            file = open(filename, "a")
-            file.write(f"{LFDI_TCB.get_info()}\n")
-            file.close()
-            current_temp = LFDI_TCB.Controllers[controller_number-1].average
-            voltage = LFDI_TCB.Compensators[compensator_number-1].voltage
-            current_temp = f"{float(current_temp):.2f}"
+            # Take a measurement and write it in the background
+            image = spectrometer.take_image()
+            # The temperature from a dump read after the voltage was set. At 9600 baud a dump takes longer than the
+            # sleep so the newest one can still be from the last step
+            snapshot = LFDI_TCB.wait_for_snapshot(set_time)
+            if snapshot is None:
+                print(f"No TCB reading since {voltage}V was set, using the last one")
+                snapshot = LFDI_TCB.get_latest_snapshot()
+            telemetry.record(LFDI_TCB, snapshot)
+            current_temp = f"{float(snapshot.averages[controller_number-1]):.2f}"
             filename = f"{folder}\\Hold_{str(time.time())}_{voltage}V_{current_temp}C_CompOff_0nm.png"
-            while not os.path.exists(spectrometer.current_image):
-                time.sleep(5)
-            os.rename(spectrometer.current_image, filename)
+            save_frame(spectrometer, image, filename, setpoint=temperature, temperature=float(current_temp), voltage=voltage,
+                       compensator=compensator_number)
 
         print(f"Finished {temperature}C")
     print("Finished Temp Cycle")
+    for temperature, voltage in skipped:
+        print(f"Skipped {temperature}C" + ("" if voltage is None else f" {voltage}V"))
+    # Make sure every image is on disk
+    spectrometer.writer.flush()
+    spectrometer.stop_cube()
+    telemetry.close()
+    spectrometer.camera.stop_journal()
+    LFDI_TCB.dump_stats(f"{folder}\\TCB_Stats.json")
 
 
 
@@ -226,9 +281,7 @@ if __name__ == "__main__":
     try:
         lfdi = LFDI.LFDI_TCB("COM6", 9600)
         # Setup Initial PID Values
-        lfdi.set_controller_kd(controller_number=1, kd=0.75)
-        lfdi.set_controller_ki(controller_number=1, ki=0)
-        lfdi.set_controller_kp(controller_number=1, kp=5)
+        lfdi.apply_config(controllers={1: {"kp": 5, "ki": 0, "kd": 0.75}})
     # Except if we can't connect to the LFDI_TCB
     except Exception as e:
         print(f"Could not connect to LFDI_TCB On Com6 {e}")
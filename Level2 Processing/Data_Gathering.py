@@ -16,6 +16,16 @@ def get_all_scans(scans_path, stage_size):
                     scans.append(pickle.load(f))
             else:
                 scans.append(Scan.Scan(File, scans_path, stage_size))
+        #Frames collected into spectral cubes instead of pngs
+        for cube in [cube for cube in os.listdir(scans_path) if cube.endswith(".cube")]:
+            schema, records = Scan.read_cube(os.path.join(scans_path, cube))
+            for index, name in enumerate(records["name"]):
+                name = name.decode('ascii')
+                if os.path.exists(f"{scans_path}\\{name[:-4]}.pkl"):
+                    with open(f"{scans_path}\\{name[:-4]}.pkl", 'rb') as f:
+                        scans.append(pickle.load(f))
+                else:
+                    scans.append(Scan.Scan(name, scans_path, stage_size, cube, index))
         return scans
 
 
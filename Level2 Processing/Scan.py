@@ -11,6 +11,16 @@ from PIL import Image
 import os
 from scipy import signal
 import pickle
+import json
+import sys
+try:
+    import Hardware_API.Crosssection as Crosssection
+    import Hardware_API.Spectral_Cube as Spectral_Cube
+except ImportError:
+    # Level2 is run from its own folder so the Hardware_API folder next to it is not on the path
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Hardware_API"))
+    import Crosssection
+    import Spectral_Cube
 
 
 px_per_nm_at_4656 = -924
@@ -38,6 +48,44 @@ def ConversionEquation(x, image_xaxis_size):
     y_intercept = halpha_nm_position - (1/px_per_nm_at_4656)*halpha_px_position_at_4656
     return (1/px_per_nm_at_4656)*x*(4656/image_xaxis_size) + y_intercept
 
+# The camera settings journal written next to the images during collection
+settings_journal_name = "Camera_Settings.jsonl"
+settings_journal_cache = {}
+
+# Get the ROI geometry an image was taken with from the settings journal in its folder
+# Returns None if there is no journal or it has no ROI for the image (full frame images from before band capture)
+def get_image_roi(parentFolder, filename):
+    journal = os.path.join(parentFolder, settings_journal_name)
+    if journal not in settings_journal_cache:
+        settings = {}
+        frames = {}
+        if os.path.exists(journal):
+            with open(journal) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    if "settings" in entry:
+                        settings[entry["settings_id"]] = entry["settings"]
+                    else:
+                        frames[entry["frame"]] = entry["settings_id"]
+        settings_journal_cache[journal] = (settings, frames)
+    settings, frames = settings_journal_cache[journal]
+    if filename not in frames:
+        return None
+    return settings.get(frames[filename], {}).get("ROI")
+
+# Spectral cubes written during collection (Hardware_API/Spectral_Cube.py). Memory mapped once per file
+cube_cache = {}
+
+# Memory map the frames of a spectral cube. Returns the schema and the records
+# records["image"][i] is frame i and records["name"][i] is the png filename it would have had
+def read_cube(filename):
+    if filename not in cube_cache:
+        cube_cache[filename] = Spectral_Cube.read_cube(filename)
+    return cube_cache[filename]
+
 # The Expected name format is for images is
 scanformat = "[PREFIX]_[TimeStamp]_[Voltage]V_[Temperature]C_Comp[Status]_[Wavelength]nm.png"
 
@@ -49,8 +97,9 @@ scanformat = "[PREFIX]_[TimeStamp]_[Voltage]V_[Temperature]C_Comp[Status]_[Wavel
 # Voltage should be the Voltage applied to the optic at the Time
 
 
+# Scans can also come from a frame of a spectral cube, the cube and index of the frame are given
 class Scan:
-    def __init__(self, filename, parentFolder, stage_size):
+    def __init__(self, filename, parentFolder, stage_size, cube=None, cube_index=None):
         # Set the filename
         # Information pulled from file name
         self.parentFolder = parentFolder
@@ -62,6 +111,8 @@ class Scan:
         self.voltage = float(filename.split("_")[2].replace("V", "").replace(" ", ""))  # set voltage to the fourth value in the filename, split by the "_" [remove the "V" from the voltage and the space from the voltage
         self.wavelength = float(filename.split("_")[5].split("nm")[0])  # set wavelength to the fifth value in the filename, split by the "_"
         self.compensated = filename.split("_")[4] == "CompOn"  # set compensated to the sixth value in the filename, split by the "_"
+        self.cube = cube  # Spectral cube file the image is in (None for a png)
+        self.cube_index = cube_index
         
         # Possible data asets
         self.stage = Stage(stage_size)
@@ -69,6 +120,8 @@ class Scan:
         self.peak_distance = None  # 203*(2.7/stage_size)*(image_size/4656) (Found Peak Distance of the 2.7mm Stage)*(Calcite thickness)
         self.Filter_Frequncy = None  # Cutoff Frequency for the Butterworth Filter used to smooth the data
         self.cross_section = None
+        self.cross_section_saturated = None  # Saturated pixels in each column of the cross section
+        self.cross_section_noise = None  # Noise of each column of the cross section
         self.smoothed_cross_section = None
         self.cross_section_location = float(1/2)  # Get From the Middle
         self.span = 0.01  # Percent Coverage of the Final Image. Cover all rows would be 100
@@ -104,32 +157,48 @@ class Scan:
     # a specific location and average across the specified span
     def get_CrossSection(self, parentFolder, crosssection, span):
         
-        # Get the Image
-        image = Image.open(os.path.join(parentFolder, self.filename))
+        # Get the Image, decoded once
+        image, roi = self.get_image(parentFolder)
+        image = np.asarray(image)
         # Get the Cross Section
-        self.image_xaxis = np.array(image).shape[1]
+        self.image_xaxis = image.shape[1]
         print(f"Xaxis {self.image_xaxis}")
-        crossSectionPixels = round(np.array(image).shape[0]*crosssection) 
+        # Band images only hold some of the rows of the sensor so the position is taken on the full frame
+        # and moved into the band
+        if roi is not None:
+            crossSectionPixels = round(roi["full_height"]*crosssection) - roi["start_y"]
+        else:
+            crossSectionPixels = round(image.shape[0]*crosssection) 
         
         # Get the Y Dimension of the image and multiply by the span to get the 
         # number of rows to average
-        bounds = round(np.array(image).shape[1]*span)
-        PixelValuesToMean = []
+        bounds = round(image.shape[1]*span)
         
-        # Loop through the Cross Section
+        # Average the rows around the Cross Section with the same kernel used during collection
         r = round(bounds/2)
-        print(f"Meaning {r} rows")
-        for i in range(r):
-            # Get the pixel values to average
-            PixelValuesToMean.append(np.array(image)[crossSectionPixels-(i), :])
-            PixelValuesToMean.append(np.array(image)[crossSectionPixels+(i), :])
-        # Average the pixel values
-        crosssection = np.mean(PixelValuesToMean, axis=0)
-
-        # Coaverage the Cross Section
+        print(f"Meaning {2*r} rows")
+        band = Crosssection.extract_bands(image, [Crosssection.centered_band(crossSectionPixels, 2*r)])[0]
+        self.cross_section_saturated = band.saturated
+        self.cross_section_noise = band.noise
+        if band.saturated is not None and band.saturated.any():
+            print(f"{np.count_nonzero(band.saturated)} columns of the Cross Section are saturated")
+
         # Return the Cross Section
-        return crosssection
+        return band.mean
     
+    # Get the image and the ROI geometry it was taken with (None for a full frame)
+    # Frames in a cube are read straight from the memory map, pngs are decoded
+    def get_image(self, parentFolder):
+        if self.cube is None:
+            return Image.open(os.path.join(parentFolder, self.filename)), get_image_roi(parentFolder, self.filename)
+        schema, records = read_cube(os.path.join(parentFolder, self.cube))
+        record = records[self.cube_index]
+        roi = None
+        if schema["roi"] is not None and record["start_y"] >= 0:
+            roi = dict(schema["roi"])
+            roi["start_y"] = int(record["start_y"])
+        return record["image"], roi
+
     # This Function will smooth the cross section using a Savitzky-Golay Filter
     # The assumed peak Distance is the FSR
     # The assumed frequency is 0.75
@@ -0,0 +1,182 @@
+#Latency and throughput benchmarks for the LFDI_TCB command path
+#Runs against the Virtual TCB (Hardware_API/TCB_Simulator.py) by default or a real board with --port
+#
+#Measures every public setter, get_info and a voltage sweep step shaped like the one in Total_Data_Collection
+#(set the compensator voltage then read the TCB). Results are written as JSON so runs can be compared:
+#   python TCB_Benchmark.py --output baseline.json
+#   python TCB_Benchmark.py --compare baseline.json
+import argparse
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime
+import numpy as np
+import Hardware_API.LFDI_API as LFDI
+from Hardware_API.TCB_Simulator import Virtual_TCB
+
+
+#The public setters with arguments to call them with. i is the iteration so values change every call
+def get_setters(lfdi):
+    return [
+        ("set_controller_kp", lambda i: lfdi.set_controller_kp(1, 1 + i % 2)),
+        ("set_controller_ki", lambda i: lfdi.set_controller_ki(1, i % 2)),
+        ("set_controller_kd", lambda i: lfdi.set_controller_kd(1, 0.5 + i % 2)),
+        ("set_controller_setpoint", lambda i: lfdi.set_controller_setpoint(1, 25 + (i % 10) / 10)),
+        ("set_controller_hist", lambda i: lfdi.set_controller_hist(1, 26)),
+        ("set_controller_frequency", lambda i: lfdi.set_controller_frequency(1, 200)),
+        ("set_controller_i2c", lambda i: lfdi.set_controller_i2c(1, 0)),
+        ("set_controller_enable", lambda i: lfdi.set_controller_enable(1, i % 2 == 0)),
+        ("set_compensator_voltage", lambda i: lfdi.set_compensator_voltage(4, (i % 180) / 10)),
+        ("set_compensator_wavelength", lambda i: lfdi.set_compensator_wavelength(4, 100 + i % 10)),
+        ("set_compensator_i2c", lambda i: lfdi.set_compensator_i2c(4, 0)),
+        ("set_compensator_enable", lambda i: lfdi.set_compensator_enable(4, True)),
+        ("set_compensator_auto", lambda i: lfdi.set_compensator_auto(4)),
+    ]
+
+
+#Summary statistics of a list of latencies in seconds
+def summarize(latencies, commands = None):
+    latencies = np.array(latencies)
+    stats = {
+        "count": int(len(latencies)),
+        "mean_ms": float(np.mean(latencies) * 1000),
+        "p50_ms": float(np.percentile(latencies, 50) * 1000),
+        "p90_ms": float(np.percentile(latencies, 90) * 1000),
+        "p99_ms": float(np.percentile(latencies, 99) * 1000),
+        "max_ms": float(np.max(latencies) * 1000),
+        "calls_per_second": float(len(latencies) / np.sum(latencies)),
+    }
+    #Serial exchanges per call tells you if a change saved round trips or just made them faster
+    if commands is not None:
+        stats["commands_per_call"] = commands / len(latencies)
+    return stats
+
+
+#Time a function over a number of iterations. board is the Virtual_TCB (None for a real board)
+def time_calls(function, iterations, board = None):
+    latencies = []
+    start_commands = board.commands_received if board is not None else None
+    for i in range(iterations):
+        start = time.perf_counter()
+        function(i)
+        latencies.append(time.perf_counter() - start)
+    commands = board.commands_received - start_commands if board is not None else None
+    return summarize(latencies, commands)
+
+
+#One step of the Total_Data_Collection voltage sweep without the camera or the settle time
+def sweep_step(lfdi, compensator_number, voltage):
+    lfdi.set_compensator_voltage(compensator_number, voltage)
+    lfdi.get_info()
+    return
+
+
+def run_benchmarks(lfdi, board, iterations, sweep_steps):
+    results = {}
+    for name, function in get_setters(lfdi):
+        results[name] = time_calls(function, iterations, board)
+    results["get_info"] = time_calls(lambda i: lfdi.get_info(), iterations, board)
+    results["sweep_step"] = time_calls(lambda i: sweep_step(lfdi, 4, (i % 180) / 10), sweep_steps, board)
+    return results
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr = subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+#Print the change in p50 and p99 against a baseline. Returns the names of benchmarks that got slower than the threshold
+def compare(results, baseline, threshold):
+    regressions = []
+    print(f"{'benchmark':<28}{'p50 ms':>10}{'base':>10}{'change':>9}{'p99 ms':>10}{'base':>10}{'change':>9}")
+    for name, stats in results.items():
+        if name not in baseline:
+            print(f"{name:<28}{stats['p50_ms']:>10.2f}{'-':>10}{'':>9}{stats['p99_ms']:>10.2f}{'-':>10}")
+            continue
+        base = baseline[name]
+        p50_change = stats["p50_ms"] / base["p50_ms"] - 1 if base["p50_ms"] > 0 else 0
+        p99_change = stats["p99_ms"] / base["p99_ms"] - 1 if base["p99_ms"] > 0 else 0
+        flag = ""
+        if p50_change > threshold:
+            regressions.append(name)
+            flag = "  <-- slower"
+        print(f"{name:<28}{stats['p50_ms']:>10.2f}{base['p50_ms']:>10.2f}{p50_change*100:>8.1f}%"
+              f"{stats['p99_ms']:>10.2f}{base['p99_ms']:>10.2f}{p99_change*100:>8.1f}%{flag}")
+    return regressions
+
+
+def print_results(results):
+    print(f"{'benchmark':<28}{'mean ms':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'calls/s':>10}{'cmds/call':>10}")
+    for name, stats in results.items():
+        commands = f"{stats['commands_per_call']:.2f}" if "commands_per_call" in stats else "-"
+        print(f"{name:<28}{stats['mean_ms']:>10.2f}{stats['p50_ms']:>10.2f}{stats['p90_ms']:>10.2f}{stats['p99_ms']:>10.2f}"
+              f"{stats['calls_per_second']:>10.1f}{commands:>10}")
+    return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmark the LFDI_TCB command path")
+    parser.add_argument("--port", default = None, help = "COM port of a real TCB. Uses the Virtual TCB if not given")
+    parser.add_argument("--latency", type = float, default = 0.005, help = "Virtual TCB response latency (s)")
+    parser.add_argument("--baud", type = int, default = None, help = "Virtual TCB baud rate. Default sends responses all at once like USB")
+    parser.add_argument("--no-prompt", action = "store_true", help = "Virtual TCB does not print a prompt after responses")
+    parser.add_argument("--iterations", type = int, default = 50, help = "Calls per setter and get_info")
+    parser.add_argument("--sweep-steps", type = int, default = 180, help = "Steps in the voltage sweep")
+    parser.add_argument("--output", default = None, help = "Write results to this JSON file")
+    parser.add_argument("--compare", default = None, help = "Compare against a JSON file from an earlier run")
+    parser.add_argument("--threshold", type = float, default = 0.2, help = "Fractional p50 slow down counted as a regression")
+    args = parser.parse_args()
+
+    if args.port is None:
+        board = Virtual_TCB(latency = args.latency, baud_rate = args.baud, prompt = None if args.no_prompt else ">", seed = 0)
+        connection = board
+    else:
+        board = None
+        connection = args.port
+
+    #The controller setters still print their responses. Keep that out of the terminal but still pay for it like a normal run would
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        lfdi = LFDI.LFDI_TCB(connection, 9600, silent = True)
+        results = run_benchmarks(lfdi, board, args.iterations, args.sweep_steps)
+        tcb_stats = lfdi.get_stats()
+        tcb_table = lfdi.format_stats()
+        #Disables everything on the way out
+        del lfdi
+
+    print_results(results)
+    print(f"\nPer command metrics from LFDI_TCB\n{tcb_table}")
+    run = {
+        "meta": {
+            "date": datetime.now().isoformat(),
+            "commit": get_git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "port": args.port if args.port is not None else "virtual",
+            "latency": args.latency,
+            "baud": args.baud,
+            "prompt": not args.no_prompt,
+            "iterations": args.iterations,
+            "sweep_steps": args.sweep_steps,
+        },
+        "results": results,
+        "tcb_stats": tcb_stats,
+    }
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(run, f, indent = 2)
+        print(f"Results written to {args.output}")
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"\nCompared to {args.compare} (commit {baseline['meta'].get('commit')})")
+        regressions = compare(results, baseline["results"], args.threshold)
+        if len(regressions) > 0:
+            print(f"Regressions: {', '.join(regressions)}")
+            sys.exit(1)
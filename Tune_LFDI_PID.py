@@ -40,13 +40,8 @@ if __name__ == "__main__":
     Spectrograph.camera.set_binning(4)
     Spectrograph.camera.set_gain(300)
     LFDI = LFDI_API.LFDI_TCB("COM6", 9600)
-    LFDI.set_controller_kd(1, .75)
-    LFDI.set_controller_ki(1, 0)
-    LFDI.set_controller_kp(1, 5)
-    LFDI.set_controller_setpoint(1, 25)
-    LFDI.set_compensator_voltage(3, 0)
-    LFDI.set_compensator_enable(3, True)
-    LFDI.set_controller_enable(1, True)
+    LFDI.apply_config(controllers={1: {"kp": 5, "ki": 0, "kd": .75, "setpoint": 25, "enable": True}},
+                      compensators={3: {"voltage": 0, "enable": True}})
     Temps = [25, 30, 25]
     # Create a Graph
     fig, ax = create_graph()
@@ -66,9 +61,9 @@ if __name__ == "__main__":
                 y.append(temp)
                 update_graph(fig, ax, x, y)
                 current_temp = f"{float(temp):.2f}"
-                Spectrograph.single_output()
+                image = Spectrograph.single_output()
                 filename = f"{folder}/Slew_{str(time.time())}_{LFDI.Compensators[5].voltage}V_{current_temp}C_CompOff_0nm.png"
-                os.rename(Spectrograph.current_image, f"{filename}")
+                Spectrograph.save_image_async(image, filename)
                 time.sleep(4)
             #only keep the last 1000 points
                 if len(x) > 1000:
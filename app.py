@@ -30,6 +30,8 @@ def init_hardware():
         lfdi.set_controller_kd(controller_number=1, kd=1)
         lfdi.set_controller_ki(controller_number=1, ki=0)
         lfdi.set_controller_kp(controller_number=1, kp=1)
+        #Keep the status page off the serial port. It reads the latest poll instead
+        lfdi.start_polling()
     except Exception as e:
         print(f"Could not connect to LFDI_TCB On Com3: {e}")
         return False
@@ -102,9 +104,14 @@ def get_status():
             'message': 'Hardware not connected'
         })
     
-    # Get current temperature and other relevant data
-    current_temp = lfdi.Controllers[0].average
-    current_voltage = lfdi.Compensators[2].voltage
+    # Get current temperature and other relevant data from the latest poll
+    snapshot = lfdi.get_latest_snapshot()
+    if snapshot is not None:
+        current_temp = snapshot.averages[0]
+        current_voltage = snapshot.voltages[2]
+    else:
+        current_temp = lfdi.Controllers[0].average
+        current_voltage = lfdi.Compensators[2].voltage
     
     return jsonify({
         'status': 'running' if current_experiment_running else 'idle',
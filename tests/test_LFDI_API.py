@@ -0,0 +1,318 @@
+#LFDI_TCB against the Virtual TCB
+import os
+import sys
+import time
+import pytest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from Hardware_API.LFDI_API import LFDI_TCB, TCB_Data, TCB_Desync_Error, TCB_Snapshot, Snapshot_Buffer
+from Hardware_API.TCB_Simulator import Virtual_TCB
+
+
+def connect(**options):
+    board = Virtual_TCB(**options)
+    lfdi = LFDI_TCB(board, silent = True)
+    #Lost responses are found out quicker
+    lfdi.command_timeout = 0.2
+    return board, lfdi
+
+
+#Every command the board gets from here on
+def record_commands(board):
+    commands = []
+    handle = board._handle_command
+    def handle_command(command):
+        commands.append(command)
+        handle(command)
+    board._handle_command = handle_command
+    return commands
+
+
+#The next count responses (prompt and all) never come back
+def drop_responses(board, count):
+    respond = board._respond
+    state = {"left": count}
+    def drop_response(text):
+        if state["left"] > 0:
+            state["left"] -= 1
+            board.drops += 1
+            return
+        respond(text)
+    board._respond = drop_response
+    return
+
+
+def snapshot(timestamp, average = 25.0):
+    return TCB_Snapshot(timestamp, f"{timestamp}", (average,), (average,), (0.0,), (25.0,), (0.0,))
+
+
+##############################
+# Parser
+##############################
+
+def test_parse_raw_data_fills_every_channel():
+    board = Virtual_TCB(seed = 0)
+    board.controllers[1].kp = 2.5
+    board.controllers[1].setpoint = 31
+    board.compensators[3].voltage = 4.25
+    board.compensators[3].wave = 656.3
+    data = TCB_Data()
+    assert data.parse_raw_data(board.raw_data()) == 0
+    assert data.parse_errors == []
+    assert data.Controllers[1].kp == 2.5
+    assert data.Controllers[1].setpoint == 31
+    assert data.Controllers[1].enabled == "False"
+    assert data.Controllers[1].sensor == "TMP117"
+    assert data.Compensators[3].voltage == 4.25
+    assert data.Compensators[3].wave == 656.3
+    assert data.last_update is not None
+
+
+#A row that stops early updates the columns it has and keeps the rest
+def test_short_row_keeps_the_missing_columns():
+    board = Virtual_TCB(seed = 0)
+    data = TCB_Data()
+    data.parse_raw_data(board.raw_data())
+    board.controllers[0].kp = 3
+    lines = board.raw_data().split("\r\n")
+    lines[1] = "\t".join(lines[1].split("\t")[:14])
+    assert data.parse_raw_data("\r\n".join(lines)) == 0
+    assert data.Controllers[0].kp == 3
+    assert data.Controllers[0].enabled == "False"
+    assert data.Controllers[0].sensor == "TMP117"
+
+
+#A garbled number is a possible desync. The line is reported and the channel keeps its last good values
+def test_garbled_row_keeps_the_last_values():
+    board = Virtual_TCB(seed = 0)
+    data = TCB_Data()
+    data.parse_raw_data(board.raw_data())
+    board.controllers[0].kp = 3
+    lines = board.raw_data().split("\r\n")
+    terms = lines[1].split("\t")
+    terms[1] = "3.0x0"
+    lines[1] = "\t".join(terms)
+    assert data.parse_raw_data("\r\n".join(lines)) == -1
+    assert len(data.parse_errors) == 1
+    assert data.Controllers[0].kp == 1
+
+
+def test_missing_section_is_a_desync():
+    board = Virtual_TCB(seed = 0)
+    data = TCB_Data()
+    raw_data = board.raw_data()
+    assert data.parse_raw_data(raw_data[:raw_data.index("Comp\t")]) == -1
+    assert data.parse_raw_data(None) == -1
+
+
+##############################
+# Menu cache
+##############################
+
+def test_menu_changes_are_only_sent_when_needed():
+    board, lfdi = connect(seed = 0)
+    lfdi.set_compensator_voltage(3, 1)
+    commands = record_commands(board)
+    lfdi.set_compensator_voltage(3, 2)
+    lfdi.set_compensator_wavelength(3, 656)
+    assert commands == ["v2", "w656"]
+    del commands[:]
+    lfdi.set_compensator_voltage(4, 1)
+    assert commands == ["c4", "v1"]
+    del commands[:]
+    lfdi.set_controller_kp(1, 2)
+    assert commands == ["m", "controller", "c1", "kp2"]
+    assert board.compensators[3].voltage == 1
+    assert board.controllers[0].kp == 2
+
+
+##############################
+# apply_config
+##############################
+
+def test_apply_config_only_sends_what_differs():
+    board, lfdi = connect(seed = 0)
+    controllers = {1: {"kp": 2, "setpoint": 30, "enable": True}}
+    compensators = {3: {"enable": True, "voltage": 2.5}}
+    assert lfdi.apply_config(controllers, compensators) == []
+    assert board.controllers[0].kp == 2
+    assert board.controllers[0].setpoint == 30
+    assert board.controllers[0].enabled
+    assert board.compensators[2].voltage == 2.5
+    #Nothing left to change, only the dumps go out
+    commands = record_commands(board)
+    assert lfdi.apply_config(controllers, compensators) == []
+    assert set(commands) <= {"m", "r"}
+
+
+#The board acknowledges kp but never sets it. The read back catches it
+def test_apply_config_reports_fields_the_board_did_not_take():
+    board, lfdi = connect(seed = 0)
+    handle = board._handle_controller
+    def handle_controller(command):
+        if command.startswith("kp"):
+            board._respond(f"kp set to {command[2:]}\r\n")
+            return
+        handle(command)
+    board._handle_controller = handle_controller
+    mismatches = lfdi.apply_config(controllers = {1: {"kp": 2, "ki": 0.5}})
+    assert mismatches == [("controller", 1, "kp", 2, 1.0)]
+    assert board.controllers[0].ki == 0.5
+
+
+##############################
+# Desync recovery
+##############################
+
+def test_lost_response_is_recovered_by_draining():
+    board, lfdi = connect(seed = 0)
+    lfdi.set_compensator_voltage(3, 1)
+    drop_responses(board, 1)
+    lfdi.set_compensator_voltage(3, 2)
+    assert lfdi.recovery_counts == {"drain": 1, "resync": 0, "reopen": 0, "failed": 0}
+    assert board.compensators[2].voltage == 2
+
+
+#The board falls back to the main menu so the command lands in the wrong menu
+def test_desync_is_recovered_by_resyncing():
+    board, lfdi = connect(seed = 0)
+    lfdi.set_compensator_voltage(3, 1)
+    board.inject_desync()
+    lfdi.set_compensator_voltage(3, 2)
+    assert board.desyncs == 1
+    assert lfdi.recovery_counts == {"drain": 0, "resync": 1, "reopen": 0, "failed": 0}
+    assert board.compensators[2].voltage == 2
+    #Back in the compensator menu with channel 3 selected
+    commands = record_commands(board)
+    lfdi.set_compensator_voltage(3, 3)
+    assert commands == ["v3"]
+
+
+#Enough desyncs to outlast the drain and the resync
+def test_reopen_when_resyncing_does_not_help():
+    board, lfdi = connect(seed = 0)
+    lfdi.set_compensator_voltage(3, 1)
+    board.inject_desync(6)
+    lfdi.set_compensator_voltage(3, 2)
+    assert lfdi.recovery_counts == {"drain": 0, "resync": 0, "reopen": 1, "failed": 0}
+    assert board.compensators[2].voltage == 2
+
+
+def test_desync_error_when_the_board_never_recovers():
+    board, lfdi = connect(seed = 0)
+    lfdi.set_compensator_voltage(3, 1)
+    board.desync_probability = 1
+    with pytest.raises(TCB_Desync_Error):
+        lfdi.set_compensator_voltage(3, 2)
+    assert lfdi.recovery_counts == {"drain": 0, "resync": 0, "reopen": 0, "failed": 1}
+    assert lfdi.current_context is None
+    #The next command starts from the main menu
+    board.desync_probability = 0
+    lfdi.set_compensator_voltage(3, 2)
+    assert board.compensators[2].voltage == 2
+
+
+##############################
+# Poller
+##############################
+
+def test_snapshot_buffer_keeps_the_newest():
+    buffer = Snapshot_Buffer(3)
+    assert buffer.latest() is None
+    assert buffer.get_history() == []
+    for timestamp in range(5):
+        buffer.append(snapshot(timestamp))
+    assert len(buffer) == 3
+    assert [entry.timestamp for entry in buffer.get_history()] == [2, 3, 4]
+    assert buffer.latest().timestamp == 4
+    #Returns right away when there is something new, waits out the timeout when there isn't
+    assert buffer.wait_for_new(4) == 5
+    start = time.monotonic()
+    assert buffer.wait_for_new(5, timeout = 0.05) == 5
+    assert time.monotonic() - start >= 0.05
+
+
+def test_poller_fills_the_ring_buffer():
+    board, lfdi = connect(seed = 0)
+    lfdi.start_polling(interval = 0.01, history = 4)
+    try:
+        lfdi.set_controller_setpoint(1, 30)
+        sent = time.time()
+        after = lfdi.wait_for_snapshot(sent, timeout = 2)
+        seen = 0
+        while lfdi.snapshots.appended < 6:
+            seen = lfdi.snapshots.wait_for_new(seen, 2)
+    finally:
+        lfdi.stop_polling()
+    assert after.timestamp > sent
+    assert after.setpoints[0] == 30
+    history = lfdi.get_history()
+    assert len(history) == 4
+    assert all(a.timestamp < b.timestamp for a, b in zip(history, history[1:]))
+    #Stopped, get_info reads the TCB again
+    assert lfdi.get_latest_snapshot() is None
+
+
+def test_is_settled_needs_a_flat_window_in_tolerance():
+    board, lfdi = connect(seed = 0)
+    lfdi.snapshots = Snapshot_Buffer(100)
+    for timestamp in range(0, 70, 5):
+        lfdi.snapshots.append(snapshot(timestamp, 25.01))
+    assert lfdi.is_settled(1, 25, tolerance = 0.1, stability_window = 60)
+    #Not a full window yet
+    assert not lfdi.is_settled(1, 25, tolerance = 0.1, stability_window = 120)
+    #Still inside the tolerance but heading out of it
+    lfdi.snapshots = Snapshot_Buffer(100)
+    for timestamp in range(0, 70, 5):
+        lfdi.snapshots.append(snapshot(timestamp, 24.91 + timestamp * 0.003))
+    assert not lfdi.is_settled(1, 25, tolerance = 0.1, stability_window = 60)
+
+
+def test_wait_until_settled_stops_the_poller_it_started():
+    board, lfdi = connect(seed = 0)
+    assert not lfdi.wait_until_settled(1, 25, tolerance = 0.1, stability_window = 60, timeout = 0.2)
+    assert lfdi.poll_thread is None
+    lfdi.start_polling(interval = 0.05)
+    try:
+        lfdi.wait_until_settled(1, 25, tolerance = 0.1, stability_window = 60, timeout = 0.2)
+        assert lfdi.poll_thread is not None
+    finally:
+        lfdi.stop_polling()
+
+
+##############################
+# Bench speed
+##############################
+
+#At 9600 baud the prompt comes in after the response line. If it is left on the port it ends the next command's read
+def test_setters_at_9600_baud_do_not_desync():
+    board, lfdi = connect(latency = 0.005, baud_rate = 9600, seed = 1)
+    lfdi.command_timeout = 1
+    for i in range(30):
+        lfdi.set_compensator_voltage(3, i / 10)
+    lfdi.set_controller_kp(1, 2)
+    lfdi.set_controller_setpoint(1, 30)
+    assert lfdi.recovery_counts == {"drain": 0, "resync": 0, "reopen": 0, "failed": 0}
+    assert sum(command["desyncs"] for command in lfdi.metrics.get_stats()["commands"].values()) == 0
+    assert board.compensators[2].voltage == 2.9
+    assert board.controllers[0].kp == 2
+    assert board.controllers[0].setpoint == 30
+
+
+#A raw dump takes over a second at 9600 baud. Setters sent while the poller is reading one wait for it instead of desyncing
+def test_poller_and_setters_at_9600_baud():
+    board, lfdi = connect(latency = 0.005, baud_rate = 9600, seed = 2)
+    lfdi.command_timeout = 1
+    lfdi.start_polling(interval = 0.5)
+    try:
+        for i in range(5):
+            lfdi.set_compensator_voltage(3, i)
+        lfdi.set_controller_setpoint(1, 30)
+        sent = time.time()
+        after = lfdi.wait_for_snapshot(sent)
+    finally:
+        lfdi.stop_polling()
+    assert lfdi.recovery_counts == {"drain": 0, "resync": 0, "reopen": 0, "failed": 0}
+    assert lfdi.parse_errors == []
+    assert after is not None
+    assert after.setpoints[0] == 30
+    assert after.voltages[2] == 4
@@ -0,0 +1,76 @@
+#Pipelined commands against the Virtual TCB at the bench's 9600 baud
+#A raw dump takes over a second to come back at this speed so anything queued behind it has to wait its turn
+#without timing out or taking another command's response
+import asyncio
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from Hardware_API.LFDI_API_Async import LFDI_TCB_Async
+from Hardware_API.TCB_Simulator import Virtual_TCB
+
+
+async def pipeline(board):
+    tcb = LFDI_TCB_Async(board, silent = True)
+    await tcb.connect()
+    try:
+        #All queued at once, the setters land behind the dumps
+        results = await asyncio.gather(tcb.get_info(), tcb.set_controller_setpoint(1, 30), tcb.set_compensator_voltage(3, 2.5),
+                                       tcb.set_controller_kp(2, 1.5), tcb.get_info(), tcb.set_compensator_wavelength(3, 656.3))
+    finally:
+        await tcb.close()
+    return tcb, results
+
+
+def test_pipelined_responses_at_9600_baud():
+    board = Virtual_TCB(latency = 0.005, baud_rate = 9600, seed = 0)
+    tcb, (info, setpoint, voltage, kp, info_again, wavelength) = asyncio.run(pipeline(board))
+    assert "Target temperature set to 30" in setpoint
+    assert "Compensator 3 Voltage Set to 2.5" in voltage
+    assert "kp set to 1.5" in kp
+    assert "Wavelength Set to 656.3" in wavelength
+    assert "Cont1" in info and "Comp3" in info_again
+    assert tcb.parse_errors == []
+    assert tcb.Controllers[0].setpoint == 30
+    assert tcb.Compensators[2].voltage == 2.5
+
+
+#The first comp is run but its response never comes back (run) or it is swallowed and never run
+def lossy_comp(board, run):
+    handle = board._handle_compensator
+    state = {"lost": False}
+    def handle_compensator(command):
+        if command == "comp" and not state["lost"]:
+            state["lost"] = True
+            if run:
+                board.drop_probability = 1
+                handle(command)
+                board.drop_probability = 0
+            return
+        handle(command)
+    board._handle_compensator = handle_compensator
+    return
+
+
+async def toggle(board):
+    tcb = LFDI_TCB_Async(board, silent = True)
+    tcb.command_timeout = 0.2
+    await tcb.connect()
+    try:
+        await tcb.toggle_compensator_auto(3)
+    finally:
+        await tcb.close()
+    return
+
+
+def test_lost_auto_toggle_is_not_sent_twice():
+    board = Virtual_TCB(baud_rate = 9600, seed = 0)
+    lossy_comp(board, run = True)
+    asyncio.run(toggle(board))
+    assert board.compensators[2].auto
+
+
+def test_auto_toggle_the_board_never_ran_is_sent_again():
+    board = Virtual_TCB(baud_rate = 9600, seed = 0)
+    lossy_comp(board, run = False)
+    asyncio.run(toggle(board))
+    assert board.compensators[2].auto